@@ -0,0 +1,30 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8, vim: expandtab:ts=4 -*-
+
+"""
+Minimal command-line pipeline of the benchmark modules (like the main.py of the applications built on xtsv)
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))  # The xtsv of this repository
+
+from xtsv import build_pipeline, parser_skeleton  # noqa: E402
+
+from bench_modules import benchmark_tools  # noqa: E402
+
+
+def main():
+    argparser = parser_skeleton(description='Benchmark pipeline for xtsv')
+    argparser.add_argument('--work', type=int, default=0, help='Hashing rounds per token in the modules')
+    opts = argparser.parse_args()
+    tools, presets = benchmark_tools(opts.work)
+    input_data = opts.input_text if opts.input_text is not None else opts.input_stream
+    used_tools = opts.task.split(',')
+    opts.output_stream.writelines(build_pipeline(input_data, used_tools, tools, presets, opts.conllu_comments,
+                                                 output_header=opts.output_header))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8, vim: expandtab:ts=4 -*-
+
+"""
+Deterministic synthetic corpora for benchmarking (the same seed gives the same corpus on every machine and version)
+"""
+
+import random
+import string
+
+_TAGS = ('noun', 'verb', 'adj', 'adv', 'det', 'punct')
+
+
+def _vocabulary(rnd, size=5000):
+    return [''.join(rnd.choice(string.ascii_letters) for _ in range(rnd.randint(1, 12))) for _ in range(size)]
+
+
+def generate_sentences(num_sentences, sentence_length, seed=42):
+    """
+    Generate sentences as lists of words (the length varies +-50% around sentence_length, the last token is '.')
+    """
+    rnd = random.Random(seed)
+    vocabulary = _vocabulary(rnd)
+    sentences = []
+    for _ in range(num_sentences):
+        length = max(1, rnd.randint(sentence_length // 2, sentence_length + sentence_length // 2))
+        sentences.append([rnd.choice(vocabulary) for _ in range(length - 1)] + ['.'])
+    return sentences
+
+
+def raw_text(sentences, sentences_per_line=5):
+    """ Free-format text for the tokenisers """
+    lines = []
+    for i in range(0, len(sentences), sentences_per_line):
+        lines.append(' '.join(' '.join(sen) for sen in sentences[i:i + sentences_per_line]))
+    return '\n'.join(lines) + '\n'
+
+
+def tsv_text(sentences, header=True):
+    """ TSV+header (form) for the internal modules and finalizers """
+    lines = ['form\n'] if header else []
+    for sen in sentences:
+        lines.extend('{0}\n'.format(word) for word in sen)
+        lines.append('\n')
+    return ''.join(lines)
+
+
+def fixed_order_tsv_text(sentences):
+    """ Fixed-order TSV without header (form, xpostag) for the fixed-order modules """
+    lines = []
+    for sen in sentences:
+        lines.extend('{0}\t{1}\n'.format(word, _TAGS[len(word) % len(_TAGS)]) for word in sen)
+        lines.append('\n')
+    return ''.join(lines)
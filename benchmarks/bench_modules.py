@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8, vim: expandtab:ts=4 -*-
+
+"""
+Synthetic xtsv modules for benchmarking: one for each of the five module types documented in process().
+ The per-token work is configurable (work=N means N rounds of hashing per token) to simulate heavier tools.
+ Only the mandatory API is used, so the modules work with every version of xtsv.
+"""
+
+import hashlib
+
+
+def _busy(text, work):
+    data = text.encode('UTF-8')
+    for _ in range(work):
+        data = hashlib.md5(data).digest()
+    return data
+
+
+class DummyTokeniser:
+    """ 1) Tokeniser: free-format text as input, TSV+header (form) output. Sentences end with '.', '!' or '?' """
+    def __init__(self, source_fields=None, target_fields=None, work=0):
+        self.source_fields = set()
+        self.target_fields = target_fields or ['form']
+        self._work = work
+
+    def process_sentence(self, stream):
+        in_sentence = False
+        for line in stream:
+            for word in line.split():
+                _busy(word, self._work)
+                yield '{0}\n'.format(word)
+                in_sentence = True
+                if word[-1] in '.!?':
+                    yield '\n'
+                    in_sentence = False
+        if in_sentence:
+            yield '\n'
+
+    @staticmethod
+    def prepare_fields(field_names):
+        return field_names
+
+
+class DummyTagger:
+    """ 2) Internal module: add a (lowercase) lemma-like column computed from the source field """
+    def __init__(self, source_fields=None, target_fields=None, work=0):
+        self.source_fields = source_fields or {'form'}
+        self.target_fields = target_fields or ['lemma']
+        self._work = work
+
+    def process_sentence(self, sen, field_values):
+        form_index = field_values[0]
+        for tok in sen:
+            _busy(tok[form_index], self._work)
+            tok.append(tok[form_index].lower())
+        return sen
+
+    def prepare_fields(self, field_names):
+        return [field_names[next(iter(self.source_fields))]]
+
+
+class DummyFinalizer:
+    """ 3) Finalizer: TSV+header input, free-format text (one sentence per line and a summary) as output """
+    def __init__(self, source_fields=None, target_fields=None, work=0):
+        self.source_fields = source_fields or {'form'}
+        self.target_fields = []
+        self.pass_header = False
+        self.add_newline_after_sentence = False
+        self._work = work
+        self._sentences = 0
+        self._tokens = 0
+
+    def process_sentence(self, sen, field_values):
+        form_index = field_values[0]
+        self._sentences += 1
+        self._tokens += len(sen)
+        _busy(str(len(sen)), self._work)
+        return [[' '.join(tok[form_index] for tok in sen)]]
+
+    def prepare_fields(self, field_names):
+        return [field_names[next(iter(self.source_fields))]]
+
+    def final_output(self):
+        yield '# sentences: {0}, tokens: {1}\n'.format(self._sentences, self._tokens)
+        self._sentences = 0
+        self._tokens = 0
+
+
+class DummyFixedOrderImporter:
+    """ 4) Fixed-order TSV importer: fixed-order TSV without header as input (form, xpostag), TSV+header output """
+    def __init__(self, source_fields=None, target_fields=None, work=0):
+        self.source_fields = set()
+        self.target_fields = target_fields or ['form', 'xpostag']
+        self.fixed_order_tsv_input = True
+        self._work = work
+
+    def process_sentence(self, sen, field_values):
+        for tok in sen:
+            _busy(tok[0], self._work)
+        return sen
+
+    @staticmethod
+    def prepare_fields(field_names):
+        return field_names
+
+
+class DummyFixedOrderProcessor:
+    """ 5) Fixed-order TSV processor: fixed-order TSV without header as input and output (uppercase the tags) """
+    def __init__(self, source_fields=None, target_fields=None, work=0):
+        self.source_fields = set()
+        self.target_fields = []
+        self.fixed_order_tsv_input = True
+        self.pass_header = False
+        self._work = work
+
+    def process_sentence(self, sen, field_values):
+        for tok in sen:
+            _busy(tok[0], self._work)
+            tok[-1] = tok[-1].upper()
+        return sen
+
+    @staticmethod
+    def prepare_fields(field_names):
+        return field_names
+
+
+def benchmark_tools(work=0):
+    """ The available_tools and presets of the benchmark modules """
+    kwargs = {'work': work}
+    tools = [(('bench_modules', 'DummyTokeniser', 'Dummy tokeniser', (), kwargs), ('tok',)),
+             (('bench_modules', 'DummyTagger', 'Dummy tagger', (), kwargs), ('tag',)),
+             (('bench_modules', 'DummyTagger', 'Dummy tagger (second)', (),
+               {'source_fields': {'lemma'}, 'target_fields': ['lemma2'], 'work': work}), ('tag2',)),
+             (('bench_modules', 'DummyFinalizer', 'Dummy finalizer', (), kwargs), ('fin',)),
+             (('bench_modules', 'DummyFixedOrderImporter', 'Dummy fixed-order importer', (), kwargs), ('import',)),
+             (('bench_modules', 'DummyFixedOrderProcessor', 'Dummy fixed-order processor', (), kwargs), ('fixed',))]
+    presets = {'full': ('Tokenise, tag and finalize', ['tok', 'tag', 'tag2', 'fin'])}
+    return tools, presets
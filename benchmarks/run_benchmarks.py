@@ -0,0 +1,264 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8, vim: expandtab:ts=4 -*-
+
+"""
+Benchmark suite for xtsv: the synthetic modules (bench_modules.py) are run on generated corpora (bench_corpus.py)
+ in-process (build_pipeline()), through the REST API (Flask test client, no network needed) and from the command line.
+ Every scenario runs in a fresh process to measure its peak memory. The results are written as JSON which can be
+ compared with the results of another version (checkout the version, run the suite again and use --compare).
+ Only the API available in every version is used.
+"""
+
+import os
+import sys
+import json
+import time
+import platform
+import subprocess
+from argparse import ArgumentParser
+from tempfile import TemporaryDirectory
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))  # The xtsv of this repository
+
+from bench_corpus import generate_sentences, raw_text, tsv_text, fixed_order_tsv_text  # noqa: E402
+from bench_modules import benchmark_tools  # noqa: E402
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Scenario name -> (used tools, input format)
+IN_PROCESS_SCENARIOS = {'tokenise': (['tok'], 'raw'),
+                        'internal': (['tag', 'tag2'], 'tsv'),
+                        'finalize': (['fin'], 'tsv'),
+                        'full-chain': (['full'], 'raw'),
+                        'fixed-order-import': (['import', 'tag'], 'fixed'),
+                        'fixed-order-process': (['fixed'], 'fixed')}
+OTHER_SCENARIOS = ('rest-requests', 'rest-stream', 'cli')
+ALL_SCENARIOS = tuple(IN_PROCESS_SCENARIOS.keys()) + OTHER_SCENARIOS
+
+
+def percentiles(values, points=(50, 90, 99)):
+    """ Nearest-rank percentiles """
+    values = sorted(values)
+    return {'p{0}'.format(p): values[max(0, min(len(values) - 1, -(-p * len(values) // 100) - 1))] for p in points}
+
+
+def peak_rss():
+    """ The peak resident set size of the current process in bytes (0 if not available) """
+    if resource is None:
+        return 0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def make_input(input_format, sentences):
+    if input_format == 'raw':
+        return raw_text(sentences)
+    if input_format == 'tsv':
+        return tsv_text(sentences)
+    return fixed_order_tsv_text(sentences)
+
+
+def run_in_process(name, opts, sentences):
+    from xtsv import build_pipeline, singleton_store_factory
+
+    used_tools, input_format = IN_PROCESS_SCENARIOS[name]
+    tools, presets = benchmark_tools(opts.work)
+    input_data = make_input(input_format, sentences)
+    singleton_store = singleton_store_factory()
+
+    start = time.perf_counter()
+    for _ in build_pipeline(input_data, used_tools, tools, presets, False, singleton_store):
+        pass
+    first_run = time.perf_counter() - start  # Including the initialisation of the tools
+
+    run_times = []
+    for _ in range(opts.repeat):
+        start = time.perf_counter()
+        for _ in build_pipeline(input_data, used_tools, tools, presets, False, singleton_store):
+            pass
+        run_times.append(time.perf_counter() - start)
+    return _summary(run_times, sentences, {'first_run': first_run, 'input_bytes': len(input_data.encode('UTF-8'))})
+
+
+def run_rest_requests(opts, sentences):
+    """ Many small documents one after the other: the latency of the requests """
+    from xtsv import pipeline_rest_api, singleton_store_factory
+
+    tools, presets = benchmark_tools(opts.work)
+    app = pipeline_rest_api('bench', tools, presets, False, singleton_store_factory())
+    client = app.test_client()
+    documents = [tsv_text(sentences[i:i + opts.request_sentences])
+                 for i in range(0, len(sentences), opts.request_sentences)]
+    client.post('/tag/tag2', data={'text': documents[0]})  # Initialise the tools
+
+    latencies = []
+    start = time.perf_counter()
+    for document in documents:
+        request_start = time.perf_counter()
+        response = client.post('/tag/tag2', data={'text': document})
+        response.get_data()
+        latencies.append(time.perf_counter() - request_start)
+        if response.status_code != 200:
+            raise RuntimeError('REST request failed with status {0}'.format(response.status_code))
+    total_time = time.perf_counter() - start
+    tokens = sum(len(sen) for sen in sentences)
+    result = {'requests': len(documents), 'sentences': len(sentences), 'tokens': tokens, 'total_time': total_time,
+              'requests_per_sec': len(documents) / total_time, 'tokens_per_sec': tokens / total_time}
+    result['latency'] = percentiles(latencies)
+    return result
+
+
+def run_rest_stream(opts, sentences):
+    """ The whole corpus in one request: the throughput of the streaming path """
+    from xtsv import pipeline_rest_api, singleton_store_factory
+
+    tools, presets = benchmark_tools(opts.work)
+    app = pipeline_rest_api('bench', tools, presets, False, singleton_store_factory())
+    client = app.test_client()
+    data = tsv_text(sentences)  # Form field instead of file upload which is broken with Flask >= 3.1 in old versions
+    client.post('/tag/tag2', data={'text': tsv_text(sentences[:1])})  # Initialise the tools
+
+    run_times = []
+    for _ in range(opts.repeat):
+        start = time.perf_counter()
+        response = client.post('/tag/tag2', data={'text': data})
+        for _ in response.response:
+            pass
+        run_times.append(time.perf_counter() - start)
+        if response.status_code != 200:
+            raise RuntimeError('REST request failed with status {0}'.format(response.status_code))
+    return _summary(run_times, sentences, {'input_bytes': len(data.encode('UTF-8'))})
+
+
+def run_cli(opts, sentences):
+    """ The command-line pipeline from start to exit (including the startup) """
+    run_times = []
+    with TemporaryDirectory() as tmp_dir:
+        input_path = os.path.join(tmp_dir, 'input.txt')
+        with open(input_path, 'w', encoding='UTF-8') as fh:
+            fh.write(raw_text(sentences))
+        command = [sys.executable, os.path.join(BENCH_DIR, 'bench_cli.py'), '--work', str(opts.work),
+                   '-i', input_path, '-o', os.path.join(tmp_dir, 'output.txt'), 'full']
+        for _ in range(opts.repeat):
+            start = time.perf_counter()
+            subprocess.run(command, check=True)
+            run_times.append(time.perf_counter() - start)
+    child_peak = 0
+    if resource is not None:
+        child_peak = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+        child_peak = child_peak if sys.platform == 'darwin' else child_peak * 1024
+    return _summary(run_times, sentences, {'cli_peak_rss': child_peak})
+
+
+def _summary(run_times, sentences, extra):
+    tokens = sum(len(sen) for sen in sentences)
+    median = percentiles(run_times, (50,))['p50']
+    result = {'runs': len(run_times), 'sentences': len(sentences), 'tokens': tokens,
+              'tokens_per_sec': tokens / median, 'sentences_per_sec': len(sentences) / median,
+              'run_time': percentiles(run_times)}
+    result.update(extra)
+    return result
+
+
+def run_scenario(name, opts):
+    sentences = generate_sentences(opts.sentences, opts.sentence_length, opts.seed)
+    if name in IN_PROCESS_SCENARIOS:
+        result = run_in_process(name, opts, sentences)
+    elif name == 'rest-requests':
+        result = run_rest_requests(opts, sentences)
+    elif name == 'rest-stream':
+        result = run_rest_stream(opts, sentences)
+    else:
+        result = run_cli(opts, sentences)
+    result['peak_rss'] = peak_rss()
+    return result
+
+
+def xtsv_version():
+    from xtsv import __version__
+    return __version__
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=BENCH_DIR, stdout=subprocess.PIPE,
+                              stderr=subprocess.DEVNULL, universal_newlines=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, old_results):
+    """ Print the throughput of the scenarios relative to the old results """
+    print('{0:<22} {1:>14} {2:>14} {3:>8}'.format('scenario', 'old tokens/s', 'new tokens/s', 'ratio'))
+    for name, result in results['results'].items():
+        old_result = old_results['results'].get(name)
+        if old_result is None or 'error' in old_result or 'error' in result:
+            continue
+        old_tps, new_tps = old_result['tokens_per_sec'], result['tokens_per_sec']
+        print('{0:<22} {1:>14.0f} {2:>14.0f} {3:>8.2f}'.format(name, old_tps, new_tps, new_tps / old_tps))
+
+
+def parse_args():
+    parser = ArgumentParser(description='Benchmark suite for xtsv')
+    parser.add_argument('--scenarios', default=','.join(ALL_SCENARIOS),
+                        help='Comma separated list of the scenarios (default: all of them: {0})'.
+                        format(', '.join(ALL_SCENARIOS)))
+    parser.add_argument('--sentences', type=int, default=20000, help='The number of sentences in the corpus')
+    parser.add_argument('--sentence-length', dest='sentence_length', type=int, default=15,
+                        help='The average number of tokens in a sentence')
+    parser.add_argument('--seed', type=int, default=42, help='The seed of the corpus generator')
+    parser.add_argument('--repeat', type=int, default=5, help='The number of measured runs per scenario')
+    parser.add_argument('--work', type=int, default=0, help='Hashing rounds per token in the modules')
+    parser.add_argument('--request-sentences', dest='request_sentences', type=int, default=10,
+                        help='The number of sentences in a document in the rest-requests scenario')
+    parser.add_argument('-o', '--output', default=None, help='Write the results to this JSON file')
+    parser.add_argument('--compare', default=None, metavar='JSON', help='Compare with the results of another run')
+    parser.add_argument('--run-scenario', dest='run_scenario', default=None, help='(Internal) Run one scenario')
+    return parser.parse_args()
+
+
+def main():
+    opts = parse_args()
+    if opts.run_scenario is not None:  # Child process: print the result
+        print(json.dumps(run_scenario(opts.run_scenario, opts)))
+        return
+
+    results = {'xtsv_version': xtsv_version(), 'git_revision': git_revision(), 'python': platform.python_version(),
+               'platform': platform.platform(), 'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+               'parameters': {'sentences': opts.sentences, 'sentence_length': opts.sentence_length,
+                              'seed': opts.seed, 'repeat': opts.repeat, 'work': opts.work,
+                              'request_sentences': opts.request_sentences},
+               'results': {}}
+    for name in opts.scenarios.split(','):
+        if name not in ALL_SCENARIOS:
+            raise ValueError('Unknown scenario: {0} (available: {1})'.format(name, ', '.join(ALL_SCENARIOS)))
+        command = [sys.executable, os.path.abspath(__file__), '--run-scenario', name] + sys.argv[1:]
+        try:
+            output = subprocess.run(command, stdout=subprocess.PIPE, universal_newlines=True, check=True).stdout
+        except subprocess.CalledProcessError as e:  # The other scenarios can still be compared
+            results['results'][name] = {'error': str(e)}
+            print('{0:<22} FAILED'.format(name), file=sys.stderr)
+            continue
+        result = json.loads(output.strip().splitlines()[-1])
+        results['results'][name] = result
+        print('{0:<22} {1:>12.0f} tokens/s  peak RSS {2:>7.1f} MB'.
+              format(name, result['tokens_per_sec'], result['peak_rss'] / (1 << 20)), file=sys.stderr)
+
+    if opts.output is not None:
+        with open(opts.output, 'w', encoding='UTF-8') as fh:
+            json.dump(results, fh, indent=2, sort_keys=True)
+    else:
+        print(json.dumps(results, indent=2, sort_keys=True))
+
+    if opts.compare is not None:
+        with open(opts.compare, encoding='UTF-8') as fh:
+            compare(results, json.load(fh))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8, vim: expandtab:ts=4 -*-
+
+"""
+The common fixtures of the tests: the tools of dummy_modules.py and the inputs
+"""
+
+import pytest
+
+from xtsv import build_pipeline
+
+TOOLS = [(('dummy_modules', 'Tokeniser', 'Tokeniser', (), {}), ('tok', 'tokenise')),
+         (('dummy_modules', 'Upper', 'Upper', (), {}), ('upper',)),
+         (('dummy_modules', 'Length', 'Length', (), {}), ('length',)),
+         (('dummy_modules', 'Length', 'Length of upper', (),
+           {'source_fields': {'upper'}, 'target_fields': ['upper_length']}), ('upper_length',)),
+         (('dummy_modules', 'Failing', 'Failing', (), {}), ('failing',)),
+         (('dummy_modules', 'InitPid', 'Process ids', (), {}), ('pid',)),
+         (('dummy_modules', 'Counter', 'Counter', (), {}), ('count',))]
+
+PRESETS = {'all': ('All', ['tok', 'upper', 'length', 'upper_length', 'count'])}
+
+# The chains run in every mode (see test_modes.py): a preset, independent modules, dependent modules with a finalizer
+#  and a chain not in the order of the dependencies
+CHAINS = (['all'], ['tok', 'upper', 'length'], ['tok', 'upper', 'upper_length', 'count'],
+          ['tok', 'length', 'upper', 'upper_length', 'count'])
+
+
+@pytest.fixture
+def tools():
+    return TOOLS
+
+
+@pytest.fixture
+def presets():
+    return PRESETS
+
+
+@pytest.fixture(params=CHAINS, ids='-'.join)
+def used_tools(request):
+    return request.param
+
+
+@pytest.fixture
+def raw_text():
+    return ''.join('Ez a {0}. mondat itt. '.format(i) for i in range(60)) + '\n'
+
+
+@pytest.fixture
+def tsv_text(raw_text):
+    """ The tokenised raw text: TSV with the form column only """
+    return ''.join(build_pipeline(raw_text, ['tok'], TOOLS, PRESETS))
@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8, vim: expandtab:ts=4 -*-
+
+"""
+Small xtsv modules for the tests (see conftest.py for the available_tools and the presets using them)
+"""
+
+import os
+import threading
+
+
+class Tokeniser:
+    """ Raw text in, one token per line out, the sentences end with '.' """
+    def __init__(self, source_fields=None, target_fields=None):
+        self.source_fields = set()
+        self.target_fields = target_fields or ['form']
+
+    @staticmethod
+    def process_sentence(stream):
+        in_sentence = False
+        for line in stream:
+            for word in line.split():
+                yield '{0}\n'.format(word)
+                in_sentence = True
+                if word.endswith('.'):
+                    yield '\n'
+                    in_sentence = False
+        if in_sentence:
+            yield '\n'
+
+    @staticmethod
+    def prepare_fields(field_names):
+        return field_names
+
+
+class Upper:
+    """ The uppercase form of the source field """
+    def __init__(self, source_fields=None, target_fields=None):
+        self.source_fields = source_fields or {'form'}
+        self.target_fields = target_fields or ['upper']
+
+    @staticmethod
+    def process_sentence(sen, field_values):
+        for tok in sen:
+            tok.append(tok[field_values[0]].upper())
+        return sen
+
+    def prepare_fields(self, field_names):
+        return [field_names[next(iter(self.source_fields))]]
+
+    @staticmethod
+    def process_token(token):
+        return token.upper()
+
+
+class Length:
+    """ The length of the source field (batched) """
+    def __init__(self, source_fields=None, target_fields=None):
+        self.source_fields = source_fields or {'form'}
+        self.target_fields = target_fields or ['length']
+
+    @staticmethod
+    def process_sentence(sen, field_values):
+        for tok in sen:
+            tok.append(str(len(tok[field_values[0]])))
+        return sen
+
+    def process_sentences(self, batch, field_values):
+        return [self.process_sentence(sen, field_values) for sen in batch]
+
+    def prepare_fields(self, field_names):
+        return [field_names[next(iter(self.source_fields))]]
+
+
+class Failing(Upper):
+    """ Fails on the sentences containing the given form """
+    def __init__(self, source_fields=None, target_fields=None, form='itt.'):
+        super().__init__(source_fields, target_fields or ['failing'])
+        self._form = form
+
+    def process_sentence(self, sen, field_values):
+        if any(tok[field_values[0]] == self._form for tok in sen):
+            raise ValueError('failing on {0}'.format(self._form))
+        return super().process_sentence(sen, field_values)
+
+
+class InitPid(Upper):
+    """ The process id where the module was initialised and where it processes the sentences """
+    def __init__(self, source_fields=None, target_fields=None):
+        super().__init__(source_fields, target_fields or ['init_pid', 'run_pid'])
+        self._init_pid = str(os.getpid())
+
+    def process_sentence(self, sen, field_values):
+        for tok in sen:
+            tok.extend((self._init_pid, str(os.getpid())))
+        return sen
+
+
+class SlowInit(Upper):
+    """ The initialisation waits until the release event is set (e.g. like loading a large model) """
+    started = threading.Event()
+    release = threading.Event()
+
+    def __init__(self, source_fields=None, target_fields=None):
+        super().__init__(source_fields, target_fields)
+        self.started.set()
+        self.release.wait(10)
+
+
+class Counter:
+    """ Finalizer: passes the sentences and writes the number of the tokens at the end """
+    def __init__(self, source_fields=None, target_fields=None):
+        self.source_fields = source_fields or {'form'}
+        self.target_fields = []
+        self._tokens = 0
+
+    def process_sentence(self, sen, _):
+        self._tokens += len(sen)
+        return sen
+
+    @staticmethod
+    def prepare_fields(_):
+        return None
+
+    def final_output(self):
+        yield '# tokens: {0}\n'.format(self._tokens)
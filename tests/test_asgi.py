@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8, vim: expandtab:ts=4 -*-
+
+import json
+import asyncio
+
+import pytest
+
+from xtsv import build_pipeline, pipeline_asgi_api
+
+TEXT = 'Ez egy mondat. Ez egy másik mondat.\n'
+
+
+async def call(app, method, path, body=b'', content_type=None, query_string=b'', send_delay=None):
+    """ A minimal ASGI server: one request with the whole body, the client disconnects after the response """
+    headers = [(b'content-length', str(len(body)).encode('latin1'))]
+    if content_type is not None:
+        headers.append((b'content-type', content_type.encode('latin1')))
+    scope = {'type': 'http', 'method': method, 'path': path, 'query_string': query_string, 'headers': headers}
+    response_done = asyncio.Event()
+    body_sent = False
+
+    async def receive():
+        nonlocal body_sent
+        if not body_sent:
+            body_sent = True
+            return {'type': 'http.request', 'body': body, 'more_body': False}
+        await response_done.wait()
+        return {'type': 'http.disconnect'}
+
+    response = {'status': None, 'headers': {}, 'body': b''}
+
+    async def send(message):
+        if message['type'] == 'http.response.start':
+            response['status'] = message['status']
+            response['headers'] = dict(message['headers'])
+        else:
+            if send_delay is not None:  # A slow client
+                await send_delay.wait()
+            response['body'] += message['body']
+            if not message.get('more_body', False):
+                response_done.set()
+
+    try:
+        await app(scope, receive, send)
+    finally:
+        response_done.set()
+    return response['status'], response['headers'], response['body'].decode('UTF-8')
+
+
+@pytest.fixture
+def app(tools, presets):
+    return pipeline_asgi_api(tools, presets, False, queue_size=2)
+
+
+def test_raw_body_and_json(app, tools, presets):
+    expected = ''.join(build_pipeline(TEXT, ['tok', 'upper'], tools, presets))
+    status, headers, body = asyncio.run(call(app, 'POST', '/tok/upper', TEXT.encode('UTF-8'), 'text/plain'))
+    assert (status, body) == (200, expected)
+    assert headers[b'content-type'] == b'text/plain; charset=utf-8'
+
+    status, _, body = asyncio.run(call(app, 'POST', '/tok/upper', json.dumps({'text': TEXT}).encode('UTF-8'),
+                                       'application/json'))
+    assert (status, body) == (200, expected)
+
+    status, _, body = asyncio.run(call(app, 'POST', '/tok/upper', TEXT.encode('UTF-8'), 'text/plain',
+                                       b'output_header=false'))
+    assert (status, body) == (200, expected[len('form\tupper\n'):])
+
+
+def test_bad_requests(app):
+    # The upper column is required by upper_length
+    status, _, _ = asyncio.run(call(app, 'POST', '/tok/upper_length', TEXT.encode('UTF-8'), 'text/plain'))
+    assert status == 400
+    status, _, _ = asyncio.run(call(app, 'POST', '/tok/upper', json.dumps({'text': 42}).encode('UTF-8'),
+                                    'application/json'))
+    assert status == 400
+    status, _, _ = asyncio.run(call(app, 'POST', '/tok/upper', TEXT.encode('UTF-8'), 'text/plain',
+                                    b'output_header=maybe'))
+    assert status == 400
+
+
+def test_failing_module(app):
+    status, _, body = asyncio.run(call(app, 'POST', '/tok/failing', b'Ez itt.\n', 'text/plain'))
+    assert (status, body) == (500, 'ERROR: Internal server error!')
+
+
+def test_get_endpoints(app):
+    status, _, body = asyncio.run(call(app, 'GET', '/'))
+    assert status == 200
+    assert json.loads(body)['presets'] == {'all': 'All'}
+    status, _, body = asyncio.run(call(app, 'GET', '/readyz'))
+    assert (status, json.loads(body)['ready']) == (200, True)
+
+
+def test_slow_client_does_not_hold_the_tools(app, tools, presets, raw_text):
+    long_text = raw_text * 20
+    expected = ''.join(build_pipeline(long_text, ['tok', 'upper'], tools, presets))
+
+    async def requests():
+        send_delay = asyncio.Event()
+        slow = asyncio.ensure_future(call(app, 'POST', '/tok/upper', long_text.encode('UTF-8'), 'text/plain',
+                                          send_delay=send_delay))
+        await asyncio.sleep(0.2)  # The slow request has the tools and does not read its output
+        fast = asyncio.ensure_future(call(app, 'POST', '/tok/upper', TEXT.encode('UTF-8'), 'text/plain'))
+        await asyncio.wait([fast], timeout=5)
+        fast_done, slow_done = fast.done(), slow.done()
+        send_delay.set()
+        assert fast_done and not slow_done
+        return await fast, await slow
+
+    (fast_status, _, _), (slow_status, _, slow_body) = asyncio.run(requests())
+    assert (fast_status, slow_status) == (200, 200)
+    assert slow_body == expected
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8, vim: expandtab:ts=4 -*-
+
+import os
+
+import pytest
+
+from xtsv import ToolPool, add_batch_args, build_pipeline, iter_process_files, parser_skeleton, process_files
+
+
+@pytest.fixture
+def inputs(tmp_path, raw_text):
+    input_dir = tmp_path / 'corpus'
+    (input_dir / 'sub').mkdir(parents=True)
+    for name in ('a.txt', 'b.txt', os.path.join('sub', 'c.txt')):
+        with open(str(input_dir / name), 'w', encoding='UTF-8') as fh:
+            fh.write(raw_text)
+    (input_dir / 'empty.txt').touch()
+    return str(input_dir), str(tmp_path / 'out')
+
+
+def read(path):
+    with open(path, encoding='UTF-8') as fh:
+        return fh.read()
+
+
+@pytest.mark.parametrize('num_workers, worker_type', ((1, 'auto'), (2, 'process'), (2, 'thread')))
+def test_process_files(tools, presets, raw_text, inputs, num_workers, worker_type):
+    input_dir, output_dir = inputs
+    expected = ''.join(build_pipeline(raw_text, ['tok', 'upper'], tools, presets))
+    results = process_files([input_dir], output_dir, ['tok', 'upper'], tools, presets, num_workers=num_workers,
+                            output_suffix='.tsv', worker_type=worker_type)
+    assert sorted((os.path.relpath(result.output_path, output_dir), result.status) for result in results) == \
+        [('a.txt.tsv', 'done'), ('b.txt.tsv', 'done'), ('empty.txt.tsv', 'done'),
+         (os.path.join('sub', 'c.txt.tsv'), 'done')]
+    assert read(os.path.join(output_dir, 'sub', 'c.txt.tsv')) == expected
+    assert read(os.path.join(output_dir, 'empty.txt.tsv')) == ''
+    assert [name for name in os.listdir(output_dir) if name.endswith('.tmp')] == []
+
+
+def test_iter_process_files_is_lazy(tools, presets, inputs):
+    input_dir, output_dir = inputs
+    results = iter_process_files([input_dir], output_dir, ['tok', 'upper'], tools, presets)
+    assert not os.path.exists(output_dir)
+    assert len(list(results)) == 4
+    assert os.path.exists(os.path.join(output_dir, 'a.txt'))
+
+
+def test_existing_outputs_are_skipped(tools, presets, inputs):
+    input_dir, output_dir = inputs
+    process_files([os.path.join(input_dir, '*.txt')], output_dir, ['tok', 'upper'], tools, presets)
+    os.remove(os.path.join(output_dir, 'b.txt'))
+    results = process_files([os.path.join(input_dir, '*.txt')], output_dir, ['tok', 'upper'], tools, presets)
+    assert sorted((os.path.basename(result.input_path), result.status) for result in results) == \
+        [('a.txt', 'skipped'), ('b.txt', 'done'), ('empty.txt', 'skipped')]
+
+
+def test_failed_file_does_not_stop_the_others(tools, presets, inputs):
+    input_dir, output_dir = inputs
+    with open(os.path.join(input_dir, 'a.txt'), 'w', encoding='UTF-8') as fh:
+        fh.write('Ez egy mondat.\n')
+    results = {os.path.basename(result.input_path): result
+               for result in process_files([input_dir], output_dir, ['tok', 'failing'], tools, presets,
+                                           num_workers=2, worker_type='thread', singleton_store=ToolPool(2))}
+    # The other non-empty inputs contain the failing form
+    assert {name: result.status for name, result in results.items()} == \
+        {'a.txt': 'done', 'b.txt': 'failed', 'c.txt': 'failed', 'empty.txt': 'done'}
+    assert results['b.txt'].error.endswith('failing on itt.')
+    assert not os.path.exists(os.path.join(output_dir, 'b.txt'))
+    assert read(os.path.join(output_dir, 'a.txt')) == 'form\tfailing\nEz\tEZ\negy\tEGY\nmondat.\tMONDAT.\n\n'
+
+
+def test_batch_args_are_opt_in():
+    argparser = parser_skeleton()
+    defaults = vars(argparser.parse_args([]))
+    add_batch_args(argparser)
+    opts = argparser.parse_args([])
+    assert {name: value for name, value in vars(opts).items() if name in defaults} == defaults
+    assert opts.input_files is None
+    opts = argparser.parse_args(['upper', '--input-files', 'corpus/', '*.txt', '--output-dir', 'out/',
+                                 '--file-workers', '4', '--overwrite'])
+    assert (opts.task, opts.input_files, opts.output_dir, opts.file_workers, opts.overwrite) == \
+        ('upper', ['corpus/', '*.txt'], 'out/', 4, True)
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8, vim: expandtab:ts=4 -*-
+
+import json
+
+from xtsv import ToolPool, build_pipeline, pipeline_rest_api, process_documents
+
+TSV = 'form\nEz\negy\nmondat.\n\n'
+UPPER = 'form\tupper\nEz\tEZ\negy\tEGY\nmondat.\tMONDAT.\n\n'
+
+
+def results(response):
+    assert response.status_code == 200
+    assert response.mimetype == 'application/x-ndjson'
+    return [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+
+
+def test_documents_with_errors(tools, presets):
+    client = pipeline_rest_api('test', tools, presets, False).test_client()
+    documents = [TSV, {'id': 'b', 'text': 'lemma\nez\n\n'}, 42, '', {'id': 5, 'text': 'form\nitt.\n\n'},
+                 {'text': TSV}]
+    lines = results(client.post('/batch/upper/failing', json=documents))
+    assert lines[1]['id'] == 'b' and 'form' in lines[1]['error']  # The header error of the document
+    assert lines == [
+        {'index': 0, 'output': 'form\tupper\tfailing\nEz\tEZ\tEZ\negy\tEGY\tEGY\nmondat.\tMONDAT.\tMONDAT.\n\n'},
+        {'index': 1, 'id': 'b', 'error': lines[1]['error']},
+        {'index': 2, 'error': 'ERROR: the document should be a string or an object with text field!'},
+        {'index': 3, 'error': 'ERROR: empty document!'},
+        {'index': 4, 'id': 5, 'error': 'In "no filename for stream" at 3: failing on itt.'},
+        {'index': 5, 'output': 'form\tupper\tfailing\nEz\tEZ\tEZ\negy\tEGY\tEGY\nmondat.\tMONDAT.\tMONDAT.\n\n'}]
+
+
+def test_ndjson_and_options(tools, presets, raw_text):
+    client = pipeline_rest_api('test', tools, presets, False).test_client()
+    body = '{0}\n\nnot json\n{1}\n'.format(json.dumps(raw_text), json.dumps({'id': 1, 'text': 'Ez egy mondat.'}))
+    response = client.post('/batch/tok/upper', data=body, content_type='application/x-ndjson')
+    lines = results(response)
+    assert lines[0] == {'index': 0, 'output': ''.join(build_pipeline(raw_text, ['tok', 'upper'], tools, presets))}
+    assert lines[1]['index'] == 1 and lines[1]['error'].startswith('ERROR: invalid JSON: ')
+    assert lines[2] == {'index': 2, 'id': 1, 'output': UPPER}
+
+    response = client.post('/batch/upper?output_header=false', json=[TSV])
+    assert results(response) == [{'index': 0, 'output': UPPER.split('\n', 1)[1]}]
+
+
+def test_invalid_requests(tools, presets):
+    client = pipeline_rest_api('test', tools, presets, False).test_client()
+    assert client.post('/batch/upper', json={'text': TSV}).status_code == 400  # Not an array
+    assert client.post('/batch/upper', data='not json').status_code == 400
+    assert client.post('/batch/upper?output_header=maybe', json=[TSV]).status_code == 400
+    assert client.post('/batch/missing', json=[TSV]).status_code == 400  # Unknown tool
+    assert client.get('/batch/upper').status_code == 405
+
+
+def test_tool_pool_is_shared_by_the_documents(tools, presets):
+    pool = ToolPool()
+    client = pipeline_rest_api('test', tools, presets, False, pool).test_client()
+    assert results(client.post('/batch/upper', json=[TSV] * 20)) == \
+        [{'index': i, 'output': UPPER} for i in range(20)]
+    assert pool.stats()['upper'] == {'instances': 1, 'idle': 1, 'busy': 0,
+                                     'estimated_memory': pool.stats()['upper']['estimated_memory']}
+
+
+def test_process_documents(tools, presets):
+    outputs = list(process_documents([TSV, ValueError('invalid'), 'form\nitt.\n\n', TSV], ['upper', 'failing'],
+                                     tools, presets))
+    assert [error for _, error in outputs] == [None, 'invalid', 'In "no filename for stream" at 3: failing on itt.',
+                                               None]
+    assert outputs[0] == outputs[3]
@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8, vim: expandtab:ts=4 -*-
+
+import io
+
+import pytest
+
+from xtsv import build_pipeline, encode_binary, read_binary, write_binary
+
+ANNOTATED = 'form\tlemma\n# sent_id = 1\nEz\tez\nárvíztűrő\tárvíztűrő\n\n\nmásik\tmásik\nmondat.\tmondat\n\n'
+
+
+@pytest.mark.parametrize('compress', (False, True, 1))
+@pytest.mark.parametrize('block_size', (1, 256))
+def test_round_trip(compress, block_size):
+    data = b''.join(encode_binary(io.StringIO(ANNOTATED), conll_comments=True, compress=compress,
+                                  block_size=block_size))
+    # The separator lines are normalised to one blank line
+    assert ''.join(read_binary(data)) == ANNOTATED.replace('\n\n\n', '\n\n')
+
+
+def test_round_trip_without_header():
+    tsv = 'a\tb\n\nc\td\n\n'
+    assert ''.join(read_binary(b''.join(encode_binary(tsv.splitlines(keepends=True), has_header=False)))) == tsv
+
+
+def test_write_binary_to_file(tmp_path):
+    path = tmp_path / 'annotated.xtsvb'
+    with open(path, 'wb') as fh:
+        write_binary(io.StringIO(ANNOTATED), fh, conll_comments=True, compress=True)
+    with open(path, 'rb') as fh:
+        assert ''.join(read_binary(fh)) == ANNOTATED.replace('\n\n\n', '\n\n')
+
+
+def test_binary_pipeline_output_and_input(tools, presets, raw_text):
+    expected = ''.join(build_pipeline(raw_text, ['tok', 'upper', 'length'], tools, presets))
+    for output_format in ('binary', 'binary-zlib'):
+        data = b''.join(build_pipeline(raw_text, ['tok', 'upper', 'length'], tools, presets,
+                                       output_format=output_format))
+        assert ''.join(read_binary(data)) == expected
+
+    tsv = b''.join(build_pipeline(raw_text, ['tok'], tools, presets, output_format='binary'))
+    output = ''.join(build_pipeline(io.BytesIO(tsv), ['upper', 'length'], tools, presets, input_format='binary'))
+    assert output == expected
+
+
+def test_truncated_input_is_an_error():
+    data = b''.join(encode_binary(io.StringIO(ANNOTATED), conll_comments=True))
+    with pytest.raises(ValueError):
+        list(read_binary(data[:-3]))
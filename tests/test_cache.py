@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8, vim: expandtab:ts=4 -*-
+
+from xtsv import ResultCache, build_pipeline
+from xtsv.cache import is_cacheable
+from xtsv.pipeline import lazy_init_tools
+
+
+def test_second_run_is_cached(tools, presets, raw_text, used_tools):
+    expected = ''.join(build_pipeline(raw_text, used_tools, tools, presets))
+    result_cache = ResultCache()
+    list(build_pipeline(raw_text, used_tools, tools, presets, result_cache=result_cache))  # See test_modes.py
+    misses = result_cache.stats()['misses']
+    assert ''.join(build_pipeline(raw_text, used_tools, tools, presets, result_cache=result_cache)) == expected
+    stats = result_cache.stats()
+    assert stats['misses'] == misses  # Everything is cached after the first run
+    assert stats['hits'] > 0
+
+
+def test_repeated_sentences_are_hits(tools, presets, tsv_text):
+    result_cache = ResultCache()
+    list(build_pipeline(tsv_text, ['upper'], tools, presets, result_cache=result_cache))
+    # Every second sentence is "mondat itt.", which is processed only until it is cached
+    stats = result_cache.stats()
+    assert stats['hits'] + stats['misses'] == 120
+    assert stats['hits'] > 0
+
+
+def test_evicted_entries_are_recomputed(tools, presets, tsv_text):
+    expected = ''.join(build_pipeline(tsv_text, ['upper', 'length'], tools, presets))
+    result_cache = ResultCache(max_entries=5)
+    for _ in range(2):
+        assert ''.join(build_pipeline(tsv_text, ['upper', 'length'], tools, presets,
+                                      result_cache=result_cache)) == expected
+    stats = result_cache.stats()
+    assert stats['entries'] == 5
+    assert stats['evictions'] > 0
+
+
+def test_disk_cache_is_persistent(tools, presets, tsv_text, tmp_path):
+    disk_path = str(tmp_path / 'cache.db')
+    expected = ''.join(build_pipeline(tsv_text, ['upper'], tools, presets))
+    result_cache = ResultCache(disk_path=disk_path)
+    list(build_pipeline(tsv_text, ['upper'], tools, presets, result_cache=result_cache))
+    result_cache.close()
+
+    result_cache = ResultCache(disk_path=disk_path)
+    assert ''.join(build_pipeline(tsv_text, ['upper'], tools, presets, result_cache=result_cache)) == expected
+    stats = result_cache.stats()
+    assert stats['misses'] == 0
+    assert stats['disk_hits'] > 0
+    result_cache.close()
+
+
+def test_only_sentence_modules_are_cacheable(tools, presets):
+    initialised_tools = lazy_init_tools(['tok', 'upper', 'count'], tools, presets)
+    assert not is_cacheable(initialised_tools['tok'])  # Raw text input
+    assert is_cacheable(initialised_tools['upper'])
+    assert not is_cacheable(initialised_tools['count'])  # Summary with final_output()
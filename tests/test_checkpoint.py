@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8, vim: expandtab:ts=4 -*-
+
+import json
+
+import pytest
+
+import dummy_modules
+from xtsv import build_pipeline, checkpoint, run_checkpointed
+
+USED_TOOLS = ['upper', 'length']
+
+
+class Crash(Exception):
+    pass
+
+
+@pytest.fixture
+def paths(tmp_path):
+    return str(tmp_path / 'input.tsv'), str(tmp_path / 'output.tsv')
+
+
+def test_checkpointed_output_is_sequential(tools, presets, tsv_text, paths):
+    input_path, output_path = paths
+    with open(input_path, 'w', encoding='UTF-8') as fh:
+        fh.write(tsv_text)
+    stats = run_checkpointed(input_path, output_path, USED_TOOLS, tools, presets, checkpoint_interval=25)
+    assert stats == {'sentences': 120, 'resumed_from': 0, 'checkpoints': 5}
+    with open(output_path, encoding='UTF-8') as fh:
+        assert fh.read() == ''.join(build_pipeline(tsv_text, USED_TOOLS, tools, presets))
+
+
+def test_resume_after_crash(tools, presets, tsv_text, paths, monkeypatch):
+    input_path, output_path = paths
+    with open(input_path, 'w', encoding='UTF-8') as fh:
+        fh.write(tsv_text)
+    expected = ''.join(build_pipeline(tsv_text, USED_TOOLS, tools, presets))
+
+    processed = []
+
+    def crashing(sen, field_values):
+        processed.append(sen)
+        if len(processed) == 60:
+            raise Crash()
+        return dummy_modules.Length.process_sentence(sen, field_values)
+
+    with monkeypatch.context() as patch:
+        patch.setattr(dummy_modules.Length, 'process_sentences',
+                      lambda self, batch, field_values: [crashing(sen, field_values) for sen in batch])
+        with pytest.raises(Crash):
+            run_checkpointed(input_path, output_path, USED_TOOLS, tools, presets, checkpoint_interval=25)
+    with open('{0}.checkpoint'.format(output_path), encoding='UTF-8') as fh:
+        assert json.load(fh)['sentences'] == 50
+    with open(output_path, 'a', encoding='UTF-8') as fh:
+        fh.write('partial output of the crashed chunk\n')
+
+    stats = run_checkpointed(input_path, output_path, USED_TOOLS, tools, presets, checkpoint_interval=25)
+    assert stats == {'sentences': 120, 'resumed_from': 50, 'checkpoints': 3}
+    with open(output_path, encoding='UTF-8') as fh:
+        assert fh.read() == expected
+    # Finished: nothing to do
+    stats = run_checkpointed(input_path, output_path, USED_TOOLS, tools, presets, checkpoint_interval=25)
+    assert stats == {'sentences': 120, 'resumed_from': 120, 'checkpoints': 0}
+
+
+def test_changed_input_starts_from_the_beginning(tools, presets, tsv_text, paths):
+    input_path, output_path = paths
+    with open(input_path, 'w', encoding='UTF-8') as fh:
+        fh.write(tsv_text)
+    run_checkpointed(input_path, output_path, USED_TOOLS, tools, presets, checkpoint_interval=25)
+    with open(input_path, 'a', encoding='UTF-8') as fh:
+        fh.write('utolsó\n\n')
+    stats = run_checkpointed(input_path, output_path, USED_TOOLS, tools, presets, checkpoint_interval=25)
+    assert stats['resumed_from'] == 0
+
+
+def test_raw_text_paragraphs(tools, presets, paths):
+    input_path, output_path = paths
+    # The sentences span two lines: they must reach the tokeniser in one chunk
+    raw_text = ''.join('Ez a\n{0}. mondat.\n\n'.format(i) for i in range(100))
+    with open(input_path, 'w', encoding='UTF-8') as fh:
+        fh.write(raw_text)
+    stats = run_checkpointed(input_path, output_path, ['tok', 'upper', 'count'], tools, presets,
+                             checkpoint_interval=7)
+    assert stats == {'sentences': 100, 'resumed_from': 0, 'checkpoints': 15}
+    with open(output_path, encoding='UTF-8') as fh:
+        output = fh.read()
+    assert output == ''.join(build_pipeline(raw_text, ['tok', 'upper', 'count'], tools, presets))
+    assert 'Ez\tEZ\na\tA\n0.\t0.\n\n' in output
+
+
+def test_raw_text_without_blank_lines(tools, presets, paths, monkeypatch):
+    input_path, output_path = paths
+    raw_text = ''.join('Ez a {0}. mondat itt.\n'.format(i) for i in range(100))
+    with open(input_path, 'w', encoding='UTF-8') as fh:
+        fh.write(raw_text)
+    # One paragraph: cut at the line boundaries above the size limit
+    monkeypatch.setattr(checkpoint, '_MAX_PARAGRAPH_BYTES', 50)
+    stats = run_checkpointed(input_path, output_path, ['tok', 'upper', 'count'], tools, presets,
+                             checkpoint_interval=10)
+    assert stats == {'sentences': 34, 'resumed_from': 0, 'checkpoints': 4}
+    with open(output_path, encoding='UTF-8') as fh:
+        output = fh.read()
+    # The summary of the finalizer is written once, at the end
+    assert output == ''.join(build_pipeline(raw_text, ['tok', 'upper', 'count'], tools, presets))
+    assert output.count('# tokens:') == 1
@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8, vim: expandtab:ts=4 -*-
+
+import pytest
+
+from xtsv import MmapCorpus, build_pipeline, sidecar_index_path
+
+LF_TSV = 'form\na\nb\n\nc\nd\n\ne\n\n'
+
+
+@pytest.fixture
+def corpus_path(tmp_path):
+    def write(text, newline='\n'):
+        path = str(tmp_path / 'corpus.tsv')
+        with open(path, 'w', encoding='UTF-8', newline=newline) as fh:
+            fh.write(text)
+        return path
+    return write
+
+
+@pytest.mark.parametrize('newline', ('\n', '\r\n'))
+def test_corpus_is_the_same_as_the_text(tools, presets, corpus_path, newline):
+    expected = ''.join(build_pipeline(LF_TSV, ['upper', 'length', 'count'], tools, presets))
+    with MmapCorpus(corpus_path(LF_TSV, newline)) as corpus:
+        assert len(corpus) == 3
+        assert corpus.header == 'form\n'
+        assert list(corpus.lines(1, 2)) == ['form\n', 'c\n', 'd\n', '\n']
+        assert ''.join(build_pipeline(corpus, ['upper', 'length', 'count'], tools, presets)) == expected
+
+
+def test_comments_and_missing_last_separator(corpus_path):
+    path = corpus_path('form\n# sent_id = 1\na\n\n\n# sent_id = 2\nb\nc', '\r\n')
+    with MmapCorpus(path, conll_comments=True) as corpus:
+        assert len(corpus) == 2
+        assert corpus.comment(1) == '# sent_id = 2\n'
+        assert list(corpus.lines(1, header=False)) == ['# sent_id = 2\n', 'b\n', 'c\n', '\n']
+
+
+def test_shards_and_sidecar_index(tools, presets, corpus_path, tsv_text):
+    path = corpus_path(tsv_text)
+    index_path = sidecar_index_path(path)
+    expected = ''.join(build_pipeline(tsv_text, ['upper'], tools, presets))
+    with MmapCorpus(path, index_path) as corpus:
+        output = [list(build_pipeline(corpus.lines(start, stop), ['upper'], tools, presets))
+                  for start, stop in corpus.shards(3)]
+    assert output[0][0] + ''.join(''.join(shard[1:]) for shard in output) == expected
+    with MmapCorpus(path, index_path) as corpus:  # Loaded from the sidecar file
+        assert len(corpus) == 120
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8, vim: expandtab:ts=4 -*-
+
+import io
+
+import pytest
+
+from xtsv import BinaryLineReader, build_pipeline, pipeline_rest_api, write_output
+from xtsv.fastio import coalesce_lines, encode_lines
+
+# Multibyte characters, CRLF, CR and a last line without newline
+TEXT = 'árvíztűrő\ttükörfúrógép\r\n\r\nŐ\rő\n\nutolsó'
+
+
+@pytest.mark.parametrize('chunk_size', (1, 2, 3, 7, 1 << 20))
+def test_binary_line_reader(chunk_size):
+    data = TEXT.encode('UTF-8')
+    expected = list(io.TextIOWrapper(io.BytesIO(data), encoding='UTF-8'))  # Universal newlines
+    assert expected[-1] == 'utolsó'
+    reader = BinaryLineReader(io.BytesIO(data), chunk_size=chunk_size)
+    assert list(reader) == expected
+    assert reader.name == 'no filename for stream'
+
+
+def test_binary_line_reader_max_line_length():
+    data = ('a' * 25 + '\nb\n').encode('UTF-8')
+    lines = list(BinaryLineReader(io.BytesIO(data), chunk_size=4, max_line_length=10))
+    assert ''.join(lines) == 'a' * 25 + '\nb\n'
+    assert all(len(line) <= 10 + 4 for line in lines)  # At most one chunk longer than the limit
+    assert sum(1 for line in lines if line.endswith('\n')) == 2  # The pieces have no newline
+
+
+def test_output_is_coalesced():
+    lines = ['{0}\n'.format(i % 10) * (i % 7) for i in range(100000)]
+    chunks = list(coalesce_lines(iter(lines)))
+    assert ''.join(chunks) == ''.join(lines)
+    assert all(len(chunk) >= 1 << 16 for chunk in chunks[:-1])  # 64 KB chunks (except the last one)
+    assert len(chunks) < 20
+
+    chunks = list(encode_lines(['ő\n'] * 10, buffer_size=4))
+    assert chunks == ['ő\nő\n'.encode('UTF-8')] * 5
+    assert list(coalesce_lines([])) == []
+
+
+class RecordingStream(io.BytesIO):
+    def __init__(self):
+        super().__init__()
+        self.writes = 0
+
+    def write(self, data):
+        self.writes += 1
+        return super().write(data)
+
+
+def test_write_output():
+    lines = ['ő\t{0}\n'.format(i) for i in range(100000)]
+    binary_stream = RecordingStream()
+    write_output(iter(lines), binary_stream)
+    assert binary_stream.getvalue() == ''.join(lines).encode('UTF-8')
+    assert binary_stream.writes < 20  # Not one write per line
+
+    text_stream = io.StringIO()
+    write_output(iter(lines), text_stream)
+    assert text_stream.getvalue() == ''.join(lines)
+
+    # Bytes (e.g. the binary format) are written to the binary buffer of the text streams
+    binary_stream = RecordingStream()
+    text_stream = io.TextIOWrapper(binary_stream, encoding='UTF-8')
+    text_stream.write('header\n')
+    write_output([b'\x00\x01', b'\x02'], text_stream)
+    assert binary_stream.getvalue() == b'header\n\x00\x01\x02'
+
+    write_output([], binary_stream)  # Empty output
+
+
+def test_binary_input_of_the_pipeline(tools, presets, raw_text):
+    expected = ''.join(build_pipeline(raw_text, ['tok', 'upper'], tools, presets))
+    output = ''.join(build_pipeline(io.BytesIO(raw_text.replace('\n', '\r\n').encode('UTF-8')), ['tok', 'upper'],
+                                    tools, presets))
+    assert output == expected
+
+    tsv = ''.join(build_pipeline(raw_text, ['tok'], tools, presets))
+    output = ''.join(build_pipeline(io.BytesIO(tsv.encode('UTF-8')), ['upper'], tools, presets))
+    assert output == expected
+
+
+def test_rest_api_upload(tools, presets, raw_text):
+    expected = ''.join(build_pipeline(raw_text, ['tok', 'upper'], tools, presets))
+    client = pipeline_rest_api('test', tools, presets, False).test_client()
+    data = raw_text.replace('\n', '\r\n').encode('UTF-8')
+    response = client.post('/tok/upper', data={'file': (io.BytesIO(data), 'input.txt')})
+    assert response.status_code == 200
+    assert response.get_data(as_text=True) == expected
@@ -0,0 +1,35 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8, vim: expandtab:ts=4 -*-
+
+from xtsv import build_pipeline
+
+USED_TOOLS = ['upper', 'upper_length', 'length']
+
+
+def test_incremental_output_is_full(tools, presets, tsv_text):
+    expected = ''.join(build_pipeline(tsv_text, USED_TOOLS, tools, presets))
+    annotated = ''.join(build_pipeline(tsv_text, ['upper'], tools, presets))
+    assert ''.join(build_pipeline(annotated, USED_TOOLS, tools, presets, incremental=True)) == expected
+
+
+def test_recomputed_columns_are_overwritten(tools, presets, tsv_text):
+    expected = ''.join(build_pipeline(tsv_text, USED_TOOLS, tools, presets))
+    # An outdated upper column: it and the upper_length depending on it must be recomputed in place
+    outdated = ''.join(build_pipeline(tsv_text, USED_TOOLS, tools, presets)).replace('MONDAT', 'OLD')
+    assert ''.join(build_pipeline(outdated, USED_TOOLS, tools, presets, recompute=['upper'])) == expected
+
+
+def test_recomputed_columns_keep_their_places(tools, presets, tsv_text):
+    annotated = ''.join(build_pipeline(tsv_text, ['length', 'upper'], tools, presets))
+    output = ''.join(build_pipeline(annotated.replace('MONDAT', 'OLD'), USED_TOOLS, tools, presets,
+                                    recompute=['upper']))
+    assert output.startswith('form\tlength\tupper\tupper_length\n')
+    assert output == ''.join(build_pipeline(annotated, ['upper_length'], tools, presets))
+
+
+def test_present_columns_are_not_computed(tools, presets, tsv_text):
+    # The failing module would raise on the input, but its column is already there
+    annotated = ''.join('{0}\tfailing\n'.format(line.rstrip('\n')) if line != '\n' else line
+                        for line in tsv_text.splitlines(keepends=True))
+    expected = ''.join(build_pipeline(annotated, ['length'], tools, presets))
+    assert ''.join(build_pipeline(annotated, ['failing', 'length'], tools, presets, incremental=True)) == expected
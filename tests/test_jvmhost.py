@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8, vim: expandtab:ts=4 -*-
+
+import os
+import stat
+import threading
+
+import pytest
+
+import dummy_modules
+from xtsv import RemoteTool, ToolHost, build_pipeline, start_tool_host
+
+
+@pytest.fixture
+def host_address(tmp_path):
+    """ A tool host running in a thread of the test process """
+    address = str(tmp_path / 'host.sock')
+    ready = threading.Event()
+    threading.Thread(target=ToolHost(address).serve_forever, args=(ready,), daemon=True).start()
+    assert ready.wait(5)
+    return address
+
+
+def remote_tools(address, used_tools):
+    return [(('xtsv.jvmhost', 'RemoteTool', 'Remote {0}'.format(name), (address, 'dummy_modules', class_name), {}),
+             (name,)) for name, class_name in used_tools]
+
+
+def test_remote_round_trip(tools, presets, tsv_text, host_address):
+    expected = ''.join(build_pipeline(tsv_text, ['upper', 'length', 'count'], tools, presets))
+    available_tools = remote_tools(host_address, [('upper', 'Upper'), ('length', 'Length'), ('count', 'Counter')])
+    assert ''.join(build_pipeline(tsv_text, ['upper', 'length', 'count'], available_tools, {})) == expected
+    assert stat.S_IMODE(os.stat(host_address).st_mode) == 0o600
+
+
+def test_remote_error_and_tokeniser(tsv_text, host_address):
+    available_tools = remote_tools(host_address, [('failing', 'Failing')])
+    with pytest.raises(ValueError, match='failing on itt.'):
+        list(build_pipeline(tsv_text, ['failing'], available_tools, {}))
+    with pytest.raises(ValueError, match='Tokenisers can not be hosted'):
+        RemoteTool(host_address, 'dummy_modules', 'Tokeniser')
+
+
+def test_slow_initialisation_does_not_block_the_other_tools(host_address):
+    dummy_modules.SlowInit.started.clear()
+    dummy_modules.SlowInit.release.clear()
+    remote_upper = RemoteTool(host_address, 'dummy_modules', 'Upper')
+    slow = []
+    slow_thread = threading.Thread(target=lambda: slow.append(RemoteTool(host_address, 'dummy_modules', 'SlowInit')))
+    slow_thread.start()
+    try:
+        assert dummy_modules.SlowInit.started.wait(5)
+        # Served while SlowInit is being initialised (a new tool and an already loaded one)
+        remote_length = RemoteTool(host_address, 'dummy_modules', 'Length')
+        assert remote_length.process_sentence([['ab']], [0]) == [['ab', '2']]
+        assert remote_upper.process_sentence([['ab']], [0]) == [['ab', 'AB']]
+        assert len(slow) == 0
+    finally:
+        dummy_modules.SlowInit.release.set()
+        slow_thread.join()
+    assert slow[0].process_sentence([['ab']], [0]) == [['ab', 'AB']]
+
+
+def test_tool_host_process(tools, presets, tsv_text, tmp_path):
+    address = str(tmp_path / 'host.sock')
+    host = start_tool_host(address, b'secret', preload=[('dummy_modules', 'Upper', (), {})])
+    try:
+        expected = ''.join(build_pipeline(tsv_text, ['upper'], tools, presets))
+        available_tools = [(('xtsv.jvmhost', 'RemoteTool', 'Remote upper',
+                             (address, 'dummy_modules', 'Upper'), {'authkey': b'secret'}), ('upper',))]
+        assert ''.join(build_pipeline(tsv_text, ['upper'], available_tools, {}, num_workers=2)) == expected
+    finally:
+        host.terminate()
+        host.join()
+
+
+def test_tcp_host_requires_authkey():
+    with pytest.raises(ValueError):
+        ToolHost(('127.0.0.1', 0))
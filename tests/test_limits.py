@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8, vim: expandtab:ts=4 -*-
+
+import io
+import os
+
+import pytest
+
+from xtsv import InputLimitError, InputLimits, PipelineMetrics, build_pipeline, check_admission, limit_input, \
+    pipeline_rest_api
+
+# The second sentence has 7 tokens (lines 4-10), the first token of the third one is 11 characters long (line 13)
+TSV = 'form\nEgy\n\na\nb\nc\nd\ne\nf\ng\n\n# sent_id = 3\nhosszú_szó_\nvégül\n\n'
+
+
+def upper(tsv, tools, presets, limits):
+    return ''.join(build_pipeline(tsv, ['upper'], tools, presets, conll_comments=True, input_limits=limits))
+
+
+def test_invalid_limits():
+    with pytest.raises(ValueError):
+        InputLimits(strategy='ignore')
+    with pytest.raises(ValueError):
+        InputLimits(max_sentence_tokens=0)
+    assert not InputLimits(max_request_bytes=10).checks_lines
+
+
+def test_reject(tools, presets):
+    with pytest.raises(InputLimitError) as e:
+        upper(TSV, tools, presets, InputLimits(max_sentence_tokens=5))
+    assert str(e.value).startswith('In "no filename for stream" at 9: the sentence has more than 5 tokens!')
+    with pytest.raises(InputLimitError) as e:
+        upper(TSV, tools, presets, InputLimits(max_line_length=10))
+    assert str(e.value).startswith('In "no filename for stream" at 13: the line is longer than 10 characters!')
+    # Within the limits
+    assert upper(TSV, tools, presets, InputLimits(7, 11)) == upper(TSV, tools, presets, None)
+
+
+def test_split(tools, presets):
+    output = upper(TSV, tools, presets, InputLimits(max_sentence_tokens=3, strategy='split'))
+    assert output == upper('form\nEgy\n\na\nb\nc\n\nd\ne\nf\n\ng\n\n# sent_id = 3\nhosszú_szó_\nvégül\n\n', tools,
+                           presets, None)
+    with pytest.raises(InputLimitError):  # The TSV lines can not be split
+        upper(TSV, tools, presets, InputLimits(max_line_length=10, strategy='split'))
+
+
+def test_spill(tools, presets, tmp_path):
+    spill_dir = str(tmp_path / 'spill')
+    output = upper(TSV, tools, presets, InputLimits(max_sentence_tokens=5, max_line_length=10, strategy='spill',
+                                                    spill_dir=spill_dir))
+    assert output == 'form\tupper\nEgy\tEGY\n\n'
+    spill_files = os.listdir(spill_dir)
+    assert len(spill_files) == 1
+    with open(os.path.join(spill_dir, spill_files[0]), encoding='UTF-8') as fh:
+        assert fh.read() == 'form\na\nb\nc\nd\ne\nf\ng\n\n# sent_id = 3\nhosszú_szó_\nvégül\n\n'
+
+
+def test_raw_text(tools, presets, tmp_path):
+    text = 'Ez egy nagyon hosszú bekezdés első sora.\nEz a második.\n\nRövid.\n'
+    expected = ''.join(build_pipeline(text, ['tok'], tools, presets))
+    assert ''.join(build_pipeline(text, ['tok'], tools, presets,
+                                  input_limits=InputLimits(max_line_length=12, strategy='split'))) == expected
+    # The words of the wrapped lines are the same
+    with pytest.raises(InputLimitError):
+        list(build_pipeline(text, ['tok'], tools, presets, input_limits=InputLimits(max_sentence_tokens=8)))
+    output = ''.join(build_pipeline(text, ['tok'], tools, presets,
+                                    input_limits=InputLimits(max_sentence_tokens=8, strategy='spill',
+                                                             spill_dir=str(tmp_path))))
+    assert output == 'form\nRövid.\n\n'
+
+    # The paragraphs are split at the line boundaries
+    lines = limit_input(iter(['a b\n', 'c d\n', 'e\n', '\n', 'f\n']),
+                        InputLimits(max_sentence_tokens=2, strategy='split'), raw_text=True)
+    assert list(lines) == ['a b\n', '\n', 'c d\n', '\n', 'e\n', '\n', 'f\n']
+    # The overlong lines are wrapped at whitespace (the words are not broken) or hard wrapped
+    lines = limit_input(iter(['aaa bbb ccc\n', 'dddddddd\n']), InputLimits(max_line_length=7, strategy='split'),
+                        raw_text=True)
+    assert list(lines) == ['aaa bbb\n', 'ccc\n', 'ddddddd\n', 'd\n']
+
+
+def test_pieces_of_an_overlong_line_have_its_line_number():
+    # The pieces of BinaryLineReader without newline
+    lines = limit_input(iter(['form\n', 'a\n', '\n', 'b\n', 'a' * 10, 'a' * 10, 'a\n', '\n']),
+                        InputLimits(max_line_length=8, strategy='spill'))
+    assert list(lines) == ['form\n', 'a\n', '\n']
+
+    lines = limit_input(iter(['form\n', 'a\n', '\n', 'b\n', 'a' * 10, 'a' * 10, 'a\n', '\n']),
+                        InputLimits(max_line_length=8))
+    with pytest.raises(InputLimitError) as e:
+        list(lines)
+    assert str(e.value).startswith('In "no filename for stream" at 5: the line is longer than 8 characters!')
+
+
+def test_binary_input_with_overlong_line(tools, presets):
+    data = ('form\n' + 'a' * (1 << 16) + '\n\n').encode('UTF-8')
+    with pytest.raises(InputLimitError):
+        list(build_pipeline(io.BytesIO(data), ['upper'], tools, presets, input_limits=InputLimits(max_line_length=100)))
+
+
+def test_check_admission():
+    metrics = PipelineMetrics()
+    assert check_admission(None, 1 << 30) is None
+    assert check_admission(InputLimits(max_request_bytes=10), 10) is None
+    assert check_admission(InputLimits(max_request_bytes=10), None) is None  # Unknown size (e.g. chunked)
+    assert check_admission(InputLimits(max_request_bytes=10), 11, metrics)[0] == 413
+    assert check_admission(InputLimits(max_rss=1), 11, metrics)[0] == 503  # Every process is larger
+    assert check_admission(InputLimits(max_rss=1 << 50), 11, metrics) is None
+    assert metrics.stats()['rejected'] == {'request_size': 1, 'memory': 1}
+
+
+def test_rest_api(tools, presets):
+    metrics = PipelineMetrics()
+    client = pipeline_rest_api('test', tools, presets, True, metrics=metrics,
+                               input_limits=InputLimits(max_sentence_tokens=5, max_request_bytes=1000)).test_client()
+    response = client.post('/upper', data={'text': 'form\nEgy\n\n'})
+    assert response.status_code == 200
+    assert response.get_data(as_text=True) == 'form\tupper\nEgy\tEGY\n\n'
+
+    response = client.post('/upper', data={'text': TSV})  # Rejected at the beginning: status code
+    assert response.status_code == 400
+    assert 'the sentence has more than 5 tokens' in response.get_data(as_text=True)
+
+    response = client.post('/upper', data={'text': 'form\n' + 'a\n' * 1000})
+    assert response.status_code == 413
+    assert metrics.stats()['rejected'] == {'request_size': 1}
+
+    client = pipeline_rest_api('test', tools, presets, True, metrics=metrics,
+                               input_limits=InputLimits(max_rss=1)).test_client()
+    assert client.post('/upper', data={'text': 'form\nEgy\n\n'}).status_code == 503
+    assert metrics.stats()['rejected'] == {'request_size': 1, 'memory': 1}
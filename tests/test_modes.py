@@ -0,0 +1,30 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8, vim: expandtab:ts=4 -*-
+
+"""
+Every mode of build_pipeline() gives the output of the sequential mode for the chains of conftest.py
+"""
+
+import pytest
+
+from xtsv import ResultCache, build_pipeline
+
+# Mode -> function returning the kwargs of build_pipeline() (the stateful objects are new for every test)
+MODES = {'cache': lambda: {'result_cache': ResultCache()},
+         'parallel-1': lambda: {'num_workers': 3, 'parallel_batch_size': 1},
+         'parallel-7': lambda: {'num_workers': 3, 'parallel_batch_size': 7},
+         'parallel-1000': lambda: {'num_workers': 3, 'parallel_batch_size': 1000},
+         'pipelined-thread': lambda: {'pipelined': True, 'stage_workers': 'thread', 'queue_size': 2,
+                                      'parallel_batch_size': 4},
+         'pipelined-process': lambda: {'pipelined': True, 'stage_workers': 'process', 'queue_size': 2,
+                                       'parallel_batch_size': 4},
+         'pipelined-auto': lambda: {'pipelined': True, 'stage_workers': 'auto', 'queue_size': 2,
+                                    'parallel_batch_size': 4},
+         'concurrent_branches': lambda: {'concurrent_branches': True}}
+
+
+@pytest.mark.parametrize('mode', sorted(MODES))
+def test_output_is_sequential(tools, presets, raw_text, used_tools, mode):
+    expected = ''.join(build_pipeline(raw_text, used_tools, tools, presets))
+    output = ''.join(build_pipeline(raw_text, used_tools, tools, presets, **MODES[mode]()))
+    assert output == expected
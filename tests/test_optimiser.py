@@ -0,0 +1,29 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8, vim: expandtab:ts=4 -*-
+
+from xtsv import build_pipeline, compile_pipeline
+
+
+def test_independent_modules_form_branches(tools, presets):
+    analysis = compile_pipeline(['tok', 'upper', 'length', 'upper_length'], tools, presets).analyse()
+    assert analysis['order'] == ['tok', 'upper', 'length', 'upper_length']
+    assert analysis['branches'] == [['upper', 'length']]
+    assert analysis['pruned'] == []
+
+
+def test_unneeded_modules_are_pruned(tools, presets, raw_text):
+    expected = ''.join(build_pipeline(raw_text, ['tok', 'upper', 'upper_length'], tools, presets))
+    output = ''.join(build_pipeline(raw_text, ['tok', 'upper', 'length', 'upper_length'], tools, presets,
+                                    output_fields=['form', 'upper_length'], concurrent_branches=True))
+    assert output == expected
+    analysis = compile_pipeline(['tok', 'upper', 'length', 'upper_length', 'count'], tools, presets).\
+        analyse(output_fields=['form', 'upper_length'])
+    assert analysis['pruned'] == ['length']
+    assert analysis['order'] == ['tok', 'upper', 'upper_length', 'count']  # The finalizer stays at the end
+
+
+def test_modules_are_ordered_by_dependencies(tools, presets, raw_text):
+    expected = ''.join(build_pipeline(raw_text, ['tok', 'upper', 'upper_length'], tools, presets))
+    output = ''.join(build_pipeline(raw_text, ['tok', 'upper_length', 'upper'], tools, presets,
+                                    output_fields=['form', 'upper', 'upper_length']))
+    assert output == expected
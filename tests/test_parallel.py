@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8, vim: expandtab:ts=4 -*-
+
+import pytest
+
+from xtsv import build_pipeline
+from xtsv.pipeline import lazy_init_tools
+from xtsv.parallel import is_sentence_parallel, longest_parallel_segment
+
+
+def test_sentence_parallel_without_output_header(tools, presets, tsv_text):
+    expected = ''.join(build_pipeline(tsv_text, ['upper', 'length'], tools, presets, output_header=False))
+    output = ''.join(build_pipeline(tsv_text, ['upper', 'length'], tools, presets, output_header=False,
+                                    num_workers=2, parallel_batch_size=5))
+    assert output == expected
+
+
+def test_tokens_with_line_boundary_characters(tools, presets):
+    # Only '\n' ends the lines: the other line boundary characters (e.g. '\x0c') are part of the tokens
+    tsv = 'form\nd\x0ce\nf\u2028g\n\nh\x85\n\n'
+    expected = ''.join(build_pipeline(tsv, ['upper', 'length', 'count'], tools, presets))
+    assert expected.endswith('# tokens: 3\n')
+    assert 'd\x0ce\tD\x0cE\t3\n' in expected
+    output = ''.join(build_pipeline(tsv, ['upper', 'length', 'count'], tools, presets, num_workers=2,
+                                    parallel_batch_size=1))
+    assert output == expected
+
+
+def test_longest_parallel_segment(tools, presets):
+    programs = ['tok', 'upper', 'length', 'count']
+    initialised_tools = lazy_init_tools(programs, tools, presets)
+    pipeline = [(program, initialised_tools[program]) for program in programs]
+    assert [is_sentence_parallel(pr) for _, pr in pipeline] == [False, True, True, False]
+    assert longest_parallel_segment(pipeline) == (1, 3)
+
+
+def test_sentence_parallel_error_is_raised(tools, presets, tsv_text):
+    with pytest.raises(ValueError, match='failing on itt.'):
+        list(build_pipeline(tsv_text, ['upper', 'failing'], tools, presets, num_workers=2, parallel_batch_size=5))
+
+
+def test_sentence_parallel_and_pipelined_are_exclusive(tools, presets, raw_text):
+    with pytest.raises(ValueError):
+        list(build_pipeline(raw_text, ['tok', 'upper'], tools, presets, num_workers=2, pipelined=True))
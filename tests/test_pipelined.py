@@ -0,0 +1,39 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8, vim: expandtab:ts=4 -*-
+
+import os
+
+import pytest
+
+from xtsv import StageMonitor, build_pipeline
+
+
+def test_stage_monitor(tools, presets, raw_text):
+    stage_monitor = StageMonitor()
+    list(build_pipeline(raw_text, ['tok', 'upper', 'length'], tools, presets, pipelined=True, stage_workers='thread',
+                        stage_monitor=stage_monitor))
+    assert list(stage_monitor.worker_types().items()) == [('tok', 'thread'), ('upper', 'thread'), ('length', 'thread')]
+    assert list(stage_monitor.queue_depths()) == ['tok', 'upper', 'length']
+
+
+def test_process_stages_use_the_initialised_tools(tools, presets, tsv_text):
+    output = list(build_pipeline(tsv_text, ['pid'], tools, presets, pipelined=True, stage_workers='process',
+                                 output_header=False))
+    pids = {tuple(line.rstrip('\n').split('\t')[1:]) for line in output if line != '\n'}
+    assert len(pids) == 1
+    init_pid, run_pid = pids.pop()
+    # The tool is initialised here (not again in the worker) and runs in the forked worker process
+    assert init_pid == str(os.getpid())
+    assert run_pid != init_pid
+
+
+@pytest.mark.parametrize('stage_workers', ('thread', 'process'))
+def test_pipelined_error_is_raised(tools, presets, tsv_text, stage_workers):
+    with pytest.raises(ValueError, match='failing on itt.'):
+        list(build_pipeline(tsv_text, ['upper', 'failing', 'length'], tools, presets, pipelined=True,
+                            stage_workers=stage_workers))
+
+
+def test_invalid_stage_workers(tools, presets, raw_text):
+    with pytest.raises(ValueError):
+        list(build_pipeline(raw_text, ['tok', 'upper'], tools, presets, pipelined=True, stage_workers='fiber'))
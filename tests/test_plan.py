@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8, vim: expandtab:ts=4 -*-
+
+import pytest
+
+from xtsv import ModuleError, PipelineOptions, PipelineProfile, build_pipeline, compile_pipeline, pipeline, \
+    singleton_store_factory
+
+TSV = 'form\nEz\negy\nmondat.\n\n'
+
+
+def test_plans_are_memoised(tools, presets, monkeypatch):
+    available_tools = list(tools)  # New tools: new plans
+    plan = compile_pipeline(['tok', 'upper'], available_tools, presets)
+    assert compile_pipeline(['tok', 'upper'], available_tools, presets) is plan
+    assert compile_pipeline(('tok', 'upper'), available_tools, presets) is plan
+    assert compile_pipeline(['tok', 'length'], available_tools, presets) is not plan
+    assert compile_pipeline(['tok', 'upper'], list(tools), presets) is not plan  # Other (equal) objects
+    assert plan.programs == ['tok', 'upper']
+    assert plan.friendly_names == ['Tokeniser', 'Upper']
+
+    preset_plan = compile_pipeline(['all'], available_tools, presets)
+    assert preset_plan.programs == ['tok', 'upper', 'length', 'upper_length', 'count']
+
+    monkeypatch.setattr(pipeline, '_MAX_COMPILED_PLANS', 2)
+    compile_pipeline(['length'], available_tools, presets)
+    compile_pipeline(['upper_length'], available_tools, presets)
+    assert compile_pipeline(['tok', 'upper'], available_tools, presets) is not plan  # Evicted (least recently used)
+
+
+def test_unknown_module(tools, presets):
+    with pytest.raises(ModuleError):
+        compile_pipeline(['tok', 'missing'], tools, presets)
+
+
+def test_field_bindings_are_memoised(tools, presets):
+    singleton_store = singleton_store_factory()
+    plan = compile_pipeline(['upper', 'length'], list(tools), presets)
+    initialised_tools = plan.init_tools(singleton_store)
+    calls = []
+    for program in ('upper', 'length'):
+        def prepare_fields(field_names, program=program, prepare=initialised_tools[program].prepare_fields):
+            calls.append(program)
+            return prepare(field_names)
+        initialised_tools[program].prepare_fields = prepare_fields
+
+    expected = ''.join(build_pipeline(TSV, ['upper', 'length'], tools, presets))
+    for _ in range(3):
+        assert ''.join(plan.run(TSV, singleton_store=singleton_store)) == expected
+    assert calls == ['upper', 'length']  # Bound at the first run only
+
+    output = ''.join(plan.run('id\tform\n1\tEz\n\n', singleton_store=singleton_store))
+    assert output == 'id\tform\tupper\tlength\n1\tEz\tEZ\t2\n\n'
+    assert calls == ['upper', 'length'] * 2  # Other header: bound again
+    assert ''.join(plan.run(TSV, singleton_store=singleton_store)) == expected
+    assert calls == ['upper', 'length'] * 3  # The last binding of the instance is kept
+
+
+def test_feasibility_is_checked_for_every_header(tools, presets):
+    singleton_store = singleton_store_factory()
+    plan = compile_pipeline(['upper_length'], list(tools), presets)
+    for _ in range(2):  # The infeasible chains are not memoised
+        with pytest.raises(ModuleError):
+            list(plan.run(TSV, singleton_store=singleton_store))
+    assert ''.join(plan.run('form\tupper\nEz\tEZ\n\n', singleton_store=singleton_store)) == \
+        'form\tupper\tupper_length\nEz\tEZ\t2\n\n'
+    with pytest.raises(ModuleError):
+        list(plan.run(TSV, singleton_store=singleton_store))
+
+
+def test_options(tools, presets):
+    with pytest.raises(ValueError):
+        PipelineOptions(num_workers=2, pipelined=True)
+    with pytest.raises(ValueError):
+        PipelineOptions(output_format='json')
+    with pytest.raises(TypeError):
+        build_pipeline(TSV, ['upper'], tools, presets, num_worker=2)
+
+    options = PipelineOptions(output_fields=['upper'], concurrent_branches=True)
+    expected = ''.join(build_pipeline(TSV, ['upper', 'length'], tools, presets, output_fields=['upper'],
+                                      concurrent_branches=True))
+    assert expected == 'form\tupper\nEz\tEZ\negy\tEGY\nmondat.\tMONDAT.\n\n'
+    assert ''.join(build_pipeline(TSV, ['upper', 'length'], tools, presets, options=options)) == expected
+
+    profile = PipelineProfile()  # The keyword arguments override the options (the options are not changed)
+    output = ''.join(build_pipeline(TSV, ['upper', 'length'], tools, presets, options=options, output_fields=None,
+                                    profile=profile))
+    assert output == ''.join(build_pipeline(TSV, ['upper', 'length'], tools, presets))
+    assert options.output_fields == ['upper'] and options.profile is None
+    assert [stage['name'] for stage in profile.report()['stages']] == ['upper', 'length']
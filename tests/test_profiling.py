@@ -0,0 +1,39 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8, vim: expandtab:ts=4 -*-
+
+from xtsv import PipelineMetrics, PipelineProfile, add_profiling_args, build_pipeline, parser_skeleton, \
+    prometheus_metrics
+from xtsv.memusage import current_rss, peak_rss
+
+
+def test_profile_report(tools, presets, raw_text):
+    profile = PipelineProfile()
+    expected = ''.join(build_pipeline(raw_text, ['tok', 'upper', 'length'], tools, presets))
+    assert ''.join(build_pipeline(raw_text, ['tok', 'upper', 'length'], tools, presets, profile=profile)) == expected
+    report = profile.report()
+    assert [stage['name'] for stage in report['stages']] == ['tok', 'upper', 'length']
+    assert [(stage['sentences'], stage['tokens']) for stage in report['stages'][1:]] == [(120, 300), (120, 300)]
+    assert report['wall_time'] > 0 and report['peak_rss'] > 0
+    assert profile.format_report().splitlines()[0].split()[0] == 'module'
+
+
+def test_peak_memory_is_not_below_the_current():
+    assert peak_rss() >= current_rss() > 0
+    metrics = PipelineMetrics()
+    values = {}
+    for line in prometheus_metrics(metrics).splitlines():
+        if not line.startswith('#'):
+            name, value = line.rsplit(' ', 1)
+            values[name] = float(value)
+    assert values['xtsv_process_peak_resident_memory_bytes'] >= values['xtsv_process_resident_memory_bytes']
+    assert values['xtsv_pipeline_runs_total'] == 0
+
+
+def test_profiling_args_are_opt_in():
+    argparser = parser_skeleton()
+    defaults = vars(argparser.parse_args([]))
+    add_profiling_args(argparser)
+    opts = argparser.parse_args([])
+    assert {name: value for name, value in vars(opts).items() if name in defaults} == defaults
+    assert not opts.profile
+    assert argparser.parse_args(['--profile', 'upper']).profile
@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8, vim: expandtab:ts=4 -*-
+
+import time
+import asyncio
+import threading
+
+import pytest
+
+from xtsv import AdmissionQueue, CancelToken, PipelineMetrics, RequestCancelled, build_pipeline, pipeline_rest_api
+
+
+def test_cancel_token():
+    cancel = CancelToken()
+    assert not cancel.cancelled
+    assert cancel.remaining() is None
+    cancel.shorten(60)
+    cancel.shorten(120)  # Only earlier deadlines are taken
+    assert 0 < cancel.remaining() <= 60
+    cancel.cancel('shutdown')
+    assert cancel.reason == 'shutdown'
+    with pytest.raises(RequestCancelled):
+        cancel.check()
+
+
+def test_cancel_token_deadline_and_disconnect():
+    cancel = CancelToken(0.01)
+    time.sleep(0.02)
+    assert cancel.reason == 'deadline'
+    assert cancel.remaining() == 0.0
+
+    disconnected = threading.Event()
+    cancel = CancelToken(60, disconnected)
+    assert cancel.reason is None
+    disconnected.set()
+    assert cancel.reason == 'disconnect'
+
+
+@pytest.mark.parametrize('kwargs', ({}, {'num_workers': 2}, {'pipelined': True, 'stage_workers': 'thread'}))
+def test_cancelled_pipeline_stops(tools, presets, raw_text, kwargs):
+    cancel = CancelToken()
+    output = build_pipeline(raw_text, ['tok', 'upper'], tools, presets, cancel=cancel, **kwargs)
+    assert next(output) == 'form\tupper\n'
+    cancel.cancel('test')
+    with pytest.raises(RequestCancelled) as e:
+        list(output)
+    assert e.value.reason == 'test'
+
+
+def test_admission_queue():
+    admission_queue = AdmissionQueue(1, max_queued=1, max_wait=5)
+    assert admission_queue.acquire()
+    results = []
+    waiting = threading.Thread(target=lambda: results.append(admission_queue.acquire()))
+    waiting.start()
+    while admission_queue.stats()['queued'] == 0:
+        time.sleep(0.01)
+    assert not admission_queue.acquire()  # The queue is full: rejected immediately
+    admission_queue.release()
+    waiting.join()
+    assert results == [True]
+    assert not admission_queue.acquire(timeout=0.01)  # Waited in vain
+    admission_queue.release()
+    assert admission_queue.stats() == {'active': 0, 'queued': 0, 'max_active': 1, 'max_queued': 1}
+
+    with pytest.raises(ValueError):
+        AdmissionQueue(0)
+
+
+def test_admission_queue_async():
+    admission_queue = AdmissionQueue(1, max_queued=3)
+
+    async def waiting():
+        assert await admission_queue.acquire_async()
+        waiters = [asyncio.ensure_future(admission_queue.acquire_async()) for _ in range(3)]
+        rejected = asyncio.ensure_future(admission_queue.acquire_async(timeout=0.05))
+        await asyncio.sleep(0.1)
+        assert not await rejected  # The queue is full
+        assert admission_queue.stats()['queued'] == 3
+        waiters[0].cancel()  # E.g. the client has gone away
+        await asyncio.sleep(0.01)
+        assert admission_queue.stats()['queued'] == 2
+        # Released from an other thread: the next waiter is woken without polling
+        threading.Thread(target=admission_queue.release).start()
+        assert await asyncio.wait_for(waiters[1], 1)
+        assert not waiters[2].done()
+        admission_queue.release()
+        assert await asyncio.wait_for(waiters[2], 1)
+        admission_queue.release()
+
+    asyncio.run(waiting())
+    assert admission_queue.stats() == {'active': 0, 'queued': 0, 'max_active': 1, 'max_queued': 3}
+
+
+def test_admission_queue_async_timeout():
+    admission_queue = AdmissionQueue(1, max_queued=1, max_wait=0.05)
+
+    async def waiting():
+        assert await admission_queue.acquire_async()
+        assert not await admission_queue.acquire_async()  # Waited in vain (max_wait)
+        admission_queue.release()
+        assert await admission_queue.acquire_async()
+        admission_queue.release()
+
+    asyncio.run(waiting())
+    assert admission_queue.stats()['active'] == 0
+
+
+def test_rest_api_overload_and_deadline(tools, presets):
+    metrics = PipelineMetrics()
+    admission_queue = AdmissionQueue(1)
+    client = pipeline_rest_api('test', tools, presets, False, metrics=metrics, admission_queue=admission_queue).\
+        test_client()
+
+    response = client.post('/tok/upper', data={'text': 'Ez egy mondat.'})
+    assert response.status_code == 200
+    assert response.get_data(as_text=True) == 'form\tupper\nEz\tEZ\negy\tEGY\nmondat.\tMONDAT.\n\n'
+
+    assert admission_queue.acquire()  # Every slot is busy
+    response = client.post('/tok/upper', data={'text': 'Ez egy mondat.'})
+    assert response.status_code == 503
+    assert 'Retry-After' in response.headers
+    admission_queue.release()
+
+    response = client.post('/tok/upper', data={'text': 'Ez egy mondat.', 'timeout': '1e-9'})
+    assert response.status_code == 503
+    response = client.post('/tok/upper', data={'text': 'Ez egy mondat.', 'timeout': '-1'})
+    assert response.status_code == 400
+
+    stats = metrics.stats()
+    assert stats['rejected'] == {'overload': 1}
+    assert stats['cancelled'] == {'deadline': 1}
+    assert admission_queue.stats()['active'] == 0
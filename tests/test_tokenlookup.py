@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8, vim: expandtab:ts=4 -*-
+
+import time
+import threading
+
+import pytest
+
+from xtsv import TokenLookup
+
+
+class SlowUpper:
+    """ process_token() and process_tokens() recording the calls and the number of the concurrent ones """
+    def __init__(self, batched=True):
+        self.calls = 0
+        self.max_concurrent = 0
+        self._concurrent = 0
+        self._lock = threading.Lock()
+        if not batched:
+            self.process_tokens = None
+
+    def process_token(self, token):
+        return self._call([token])[0]
+
+    def process_tokens(self, tokens):
+        return self._call(tokens)
+
+    def _call(self, tokens):
+        with self._lock:
+            self.calls += 1
+            self._concurrent += 1
+            self.max_concurrent = max(self.max_concurrent, self._concurrent)
+        time.sleep(0.01)
+        with self._lock:
+            self._concurrent -= 1
+        return [token.upper() for token in tokens]
+
+
+def run_threads(target, args_list):
+    threads = [threading.Thread(target=target, args=args) for args in args_list]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def test_batched_results_are_the_single_results():
+    tool = SlowUpper()
+    token_lookup = TokenLookup(max_entries=0, max_delay=0.01)
+    requests = [['alma', 'körte'], ['szilva'], ['alma'], ['barack', 'dió', 'alma']] * 10
+    results = [None] * len(requests)
+
+    def lookup(i, tool_name):
+        results[i] = token_lookup.lookup(tool_name, requests[i], lambda process: process(tool))
+
+    # Two names (e.g. aliases) of the same instance
+    run_threads(lookup, [(i, ('upper', 'nagybetű')[i % 2]) for i in range(len(requests))])
+    assert results == [{token: token.upper() for token in tokens} for tokens in requests]
+    assert tool.max_concurrent == 1  # The instance is not used concurrently
+    stats = token_lookup.stats()
+    assert stats['calls'] == tool.calls < len(requests)
+    assert stats['calls'] + stats['batched_requests'] == len(requests)
+
+
+def test_memo_and_unsupported_tools():
+    tool = SlowUpper(batched=False)
+    token_lookup = TokenLookup(max_entries=2)
+    assert token_lookup.lookup('upper', ['a', 'b', 'a'], lambda process: process(tool)) == {'a': 'A', 'b': 'B'}
+    assert token_lookup.memoised('upper', ['b', 'a']) == {'b': 'B', 'a': 'A'}
+    assert token_lookup.lookup('upper', ['c'], lambda process: process(tool)) == {'c': 'C'}
+    assert token_lookup.memoised('upper', ['b']) is None  # The least recently used one is evicted
+    assert token_lookup.stats()['entries'] == 2
+    assert token_lookup.lookup('none', ['a'], lambda process: process(None)) is None
+    assert token_lookup.lookup('object', ['a'], lambda process: process(object())) is None
+
+
+def test_error_is_raised_for_every_request_of_the_batch():
+    token_lookup = TokenLookup(max_delay=0.05)
+    errors = []
+
+    def failing(_):
+        raise ValueError('model not loaded')
+
+    def lookup(token):
+        try:
+            token_lookup.lookup('failing', [token], failing)
+        except ValueError as e:
+            errors.append(str(e))
+
+    run_threads(lookup, [(token,) for token in ('a', 'b', 'c')])
+    assert errors == ['model not loaded'] * 3
+    with pytest.raises(ValueError):
+        TokenLookup(max_batch=0)
@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8, vim: expandtab:ts=4 -*-
+
+import time
+import threading
+from itertools import count
+
+import pytest
+
+from xtsv import ToolPool, build_pipeline, toolpool
+
+# The second entry is an alias of the first one (same params)
+ALIASES = [(('dummy_modules', 'Upper', 'Upper', (), {}), ('upper',)),
+           (('dummy_modules', 'Upper', 'Upper', (), {}), ('upper_alias',))]
+
+
+def test_checkout_and_checkin(tools, presets):
+    pool = ToolPool()
+    checked_out = pool.checkout(['tok', 'upper'], tools, presets)
+    assert set(checked_out) == {'tok', 'tokenise', 'upper'}
+    assert checked_out['tok'] is checked_out['tokenise']
+    assert pool.stats()['tok,tokenise']['busy'] == 1
+    pool.checkin(checked_out)
+    assert pool.stats()['upper'] == {'instances': 1, 'idle': 1, 'busy': 0,
+                                     'estimated_memory': pool.stats()['upper']['estimated_memory']}
+
+    with pool.tools(['upper'], tools, presets) as checked_out_again:  # The idle instance is reused
+        assert checked_out_again['upper'] is checked_out['upper']
+    assert pool.stats()['upper']['idle'] == 1
+
+
+def test_max_instances_blocks(tools, presets):
+    pool = ToolPool({'upper': 2})
+    first = pool.checkout(['upper'], tools, presets)
+    second = pool.checkout(['upper'], tools, presets)  # All busy: a new instance
+    assert first['upper'] is not second['upper']
+    with pytest.raises(TimeoutError):
+        pool.checkout(['upper'], tools, presets, timeout=0.05)
+    assert pool.stats()['upper']['instances'] == 2
+
+    results = []
+    waiting = threading.Thread(target=lambda: results.append(pool.checkout(['upper'], tools, presets, timeout=5)))
+    waiting.start()
+    time.sleep(0.05)
+    assert results == []  # Waits for a checkin
+    pool.checkin(first)
+    waiting.join()
+    assert results[0]['upper'] is first['upper']
+    pool.checkin(second)
+    pool.checkin(results[0])
+    assert pool.stats()['upper'] == {'instances': 2, 'idle': 2, 'busy': 0,
+                                     'estimated_memory': pool.stats()['upper']['estimated_memory']}
+
+
+def test_concurrent_pipelines(tools, presets, raw_text):
+    expected = ''.join(build_pipeline(raw_text, ['tok', 'upper', 'length'], tools, presets))
+    pool = ToolPool(2)
+    outputs = []
+
+    def run():
+        outputs.append(''.join(build_pipeline(raw_text, ['tok', 'upper', 'length'], tools, presets,
+                                              singleton_store=pool)))
+
+    threads = [threading.Thread(target=run) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert outputs == [expected] * 8
+    stats = pool.stats()
+    assert all(1 <= tool_stats['instances'] <= 2 and tool_stats['busy'] == 0 for tool_stats in stats.values())
+
+
+def test_idle_eviction(tools, presets):
+    pool = ToolPool(3, idle_timeout=0.05, min_instances=1)
+    checked_out = [pool.checkout(['upper'], tools, presets) for _ in range(3)]
+    for curr_checked_out in checked_out:
+        pool.checkin(curr_checked_out)
+    assert pool.stats()['upper']['instances'] == 3
+    time.sleep(0.1)
+    assert pool.stats()['upper'] == {'instances': 1, 'idle': 1, 'busy': 0,
+                                     'estimated_memory': pool.stats()['upper']['estimated_memory']}
+    # The evicted instances can be created again
+    checked_out = [pool.checkout(['upper'], tools, presets) for _ in range(2)]
+    assert pool.stats()['upper']['busy'] == 2
+    for curr_checked_out in checked_out:
+        pool.checkin(curr_checked_out)
+
+
+def test_memory_estimate_limits_the_growth(tools, presets, monkeypatch):
+    rss = count(0, 100)  # Every instance grows the RSS by 100 bytes
+    monkeypatch.setattr(toolpool, 'current_rss', lambda: next(rss))
+    pool = ToolPool(4, max_memory=250)
+    checked_out = [pool.checkout(['upper'], tools, presets) for _ in range(2)]
+    assert pool.stats()['upper']['estimated_memory'] == 100
+    with pytest.raises(TimeoutError):  # The third instance would exceed max_memory
+        pool.checkout(['upper'], tools, presets, timeout=0.05)
+    pool.checkin(checked_out[0])
+    pool.checkin(pool.checkout(['upper'], tools, presets, timeout=0.05))  # The idle one
+    pool.checkin(checked_out[1])
+    assert pool.stats()['upper']['instances'] == 2
+
+    pool = ToolPool(4, max_memory=0)
+    checked_out = pool.checkout(['upper'], tools, presets)  # The first instance is always created
+    with pytest.raises(TimeoutError):
+        pool.checkout(['upper'], tools, presets, timeout=0.05)
+    pool.checkin(checked_out)
+
+
+def test_aliases_share_one_instance(presets):
+    pool = ToolPool(1)
+    checked_out = pool.checkout(['upper', 'upper_alias'], ALIASES, presets, timeout=1)  # No deadlock
+    assert checked_out['upper'] is checked_out['upper_alias']
+    assert pool.stats()['upper,upper_alias']['busy'] == 1
+    with pytest.raises(TimeoutError):
+        pool.checkout(['upper_alias'], ALIASES, presets, timeout=0.05)
+    pool.checkin(checked_out)
+    assert pool.stats()['upper,upper_alias'] == {'instances': 1, 'idle': 1, 'busy': 0,
+                                                 'estimated_memory': pool.stats()['upper,upper_alias']
+                                                 ['estimated_memory']}
+
+
+def test_failing_initialisation_frees_the_place(presets):
+    pool = ToolPool(1)
+    with pytest.raises(AttributeError):
+        pool.checkout(['missing'], [(('dummy_modules', 'Missing', 'Missing', (), {}), ('missing',))], presets,
+                      timeout=1)
+    assert pool.stats()['missing'] == {'instances': 0, 'idle': 0, 'busy': 0, 'estimated_memory': None}
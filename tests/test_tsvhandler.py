@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8, vim: expandtab:ts=4 -*-
+
+import io
+
+import pytest
+
+from xtsv import SentenceStream, process, process_chain
+
+from dummy_modules import Counter, Failing, Length, Upper
+
+# 10 sentences of 1, 2, ..., 10 tokens with a comment before the third one
+TSV = 'form\n' + ''.join('{0}{1}\n'.format('# sent_id = 3\n' if sen_len == 3 else '',
+                                              ''.join('w{0}\n'.format(i) for i in range(sen_len)))
+                           for sen_len in range(1, 11))
+
+
+class RecordingLength(Length):
+    """ Length recording the sizes of the batches """
+    def __init__(self, batch_size=None):
+        super().__init__()
+        if batch_size is not None:
+            self.batch_size = batch_size
+        self.batches = []
+
+    def process_sentences(self, batch, field_values):
+        self.batches.append([len(sen) for sen in batch])
+        return super().process_sentences(batch, field_values)
+
+
+class WrongBatchLength(Length):
+    def process_sentences(self, batch, field_values):
+        return super().process_sentences(batch, field_values)[:-1]
+
+
+class FailingBatch(Length):
+    def process_sentences(self, batch, field_values):
+        raise RuntimeError('batch failed')
+
+
+class UnbatchedLength(Length):
+    process_sentences = None
+
+
+def run(internal_app, conll_comments=True, **kwargs):
+    return ''.join(process(io.StringIO(TSV), internal_app, conll_comments, **kwargs))
+
+
+def test_batches_give_the_same_output():
+    expected = run(UnbatchedLength())
+    assert expected.startswith('form\tlength\nw0\t2\n\nw0\t2\nw1\t2\n\n# sent_id = 3\nw0\t2\n')
+    for kwargs in ({}, {'batch_size': 1}, {'batch_size': 3}, {'batch_tokens': 5}):
+        assert run(RecordingLength(), **kwargs) == expected
+
+
+def test_batch_size_and_tokens():
+    module = RecordingLength()
+    run(module)  # Default: 64 sentences
+    assert module.batches == [list(range(1, 11))]
+
+    module = RecordingLength(batch_size=4)  # The attribute of the module
+    run(module)
+    assert module.batches == [[1, 2, 3, 4], [5, 6, 7, 8], [9, 10]]
+
+    module = RecordingLength(batch_size=4)
+    run(module, batch_size=3)  # The parameter overrides the attribute
+    assert module.batches == [[1, 2, 3], [4, 5, 6], [7, 8, 9], [10]]
+
+    module = RecordingLength()
+    run(module, batch_tokens=6)  # A batch is closed when it reaches the limit
+    assert module.batches == [[1, 2, 3], [4, 5], [6], [7], [8], [9], [10]]
+
+
+def test_unbatched_modules_get_one_sentence_at_a_time():
+    output = run(Upper())
+    assert output.count('\n\n') == 10
+    assert 'w9\tW9\n' in output
+
+
+def test_batch_errors():
+    with pytest.raises(ValueError) as e:
+        run(WrongBatchLength())
+    assert 'returned 9 sentences instead of 10' in str(e.value)
+
+    with pytest.raises(RuntimeError) as e:
+        run(FailingBatch(), batch_size=4)
+    assert str(e.value).startswith('In "no filename for stream" at ')
+    assert str(e.value).endswith('batch failed')
+
+
+class Recording(Upper):
+    """ Upper recording the sentence objects it gets """
+    def __init__(self, source_fields=None, target_fields=None):
+        super().__init__(source_fields, target_fields)
+        self.sentences = []
+
+    def process_sentence(self, sen, field_values):
+        self.sentences.append(sen)
+        return super().process_sentence(sen, field_values)
+
+
+class LazyUpper(Upper):
+    """ Returns a generator instead of the list of the tokens """
+    def process_sentence(self, sen, field_values):
+        return (tok + [tok[field_values[0]].upper()] for tok in sen)
+
+
+def test_process_chain_passes_the_parsed_sentences():
+    expected = run_one_by_one([Upper(), Length({'upper'}, ['upper_length']), Counter()])
+    first, second = Recording(), Recording({'upper'}, ['upper_upper'])
+    output = ''.join(process_chain(io.StringIO(TSV), [first, second], True))
+    assert output == run_one_by_one([Recording(), Recording({'upper'}, ['upper_upper'])])
+    assert output.startswith('form\tupper\tupper_upper\nw0\tW0\tW0\n\n')
+    # The second module gets the sentences of the first without splitting the lines again
+    assert len(second.sentences) == 10 and all(sen1 is sen2 for sen1, sen2 in zip(first.sentences, second.sentences))
+
+    # Lazy outputs in the middle of the chain are materialised, the finalizer ends the chain
+    output = ''.join(process_chain(io.StringIO(TSV), [LazyUpper(), Length({'upper'}, ['upper_length']), Counter()],
+                                   True))
+    assert output == expected
+    assert output.endswith('w9\tW9\t2\n\n# tokens: 55\n')
+
+
+def test_parsed_output_hand_off():
+    expected = run_one_by_one([Upper(), Length({'upper'}, ['upper_length'])])
+    parsed = process_chain(io.StringIO(TSV), [Upper()], True, parsed_output=True)
+    assert isinstance(parsed, SentenceStream)
+    assert parsed.header == 'form\tupper\n'
+    # The next process() reads the parsed sentences (the header is skipped)
+    assert ''.join(process(parsed, Length({'upper'}, ['upper_length']), True)) == expected
+
+    parsed = process_chain(io.StringIO(TSV), [Upper()], True, parsed_output=True)
+    assert ''.join(parsed) == run_one_by_one([Upper()])  # Or the TSV lines
+
+
+def test_sentence_stream():
+    sentences = [([['a', 'A'], ['b', 'B']], '# sent_id = 1\n'), ([['c', 'C']], '')]
+    stream = SentenceStream('form\tupper\n', iter(sentences), 'test.tsv')
+    assert list(stream) == ['form\tupper\n', '# sent_id = 1\n', 'a\tA\n', 'b\tB\n', '\n', 'c\tC\n', '\n']
+
+    stream = SentenceStream('form\tupper\n', iter(sentences))
+    assert next(stream) == 'form\tupper\n'
+    track_stream = {'curr_line_number': 1}
+    assert list(stream.parsed_sentences(track_stream)) == sentences
+    assert track_stream['curr_line_number'] == 7  # The line number of the end of the last sentence as in TSV
+
+    stream = SentenceStream(None, iter(sentences), 'test.tsv')
+    assert next(stream) == '# sent_id = 1\n'
+    with pytest.raises(ValueError):  # A sentence can not be continued as parsed sentences
+        list(stream.parsed_sentences())
+
+
+def test_errors_in_the_chain_have_line_numbers():
+    with pytest.raises(ValueError) as e:
+        list(process_chain(io.StringIO(TSV), [Upper(), Failing({'upper'}, form='W2')], True))
+    # The end of the third sentence as with process()
+    assert str(e.value) == 'In "no filename for stream" at 11: failing on W2'
+    with pytest.raises(ValueError) as e:
+        run_one_by_one([Upper(), Failing({'upper'}, form='W2')])
+    assert str(e.value) == 'In "no filename for stream" at 11: failing on W2'
+
+
+def run_one_by_one(internal_apps):
+    """ Chain process() calls, each of them splits and joins the lines """
+    stream = io.StringIO(TSV)
+    for internal_app in internal_apps:
+        stream = process(stream, internal_app, True)
+    return ''.join(stream)
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8, vim: expandtab:ts=4 -*-
+
+import json
+
+from xtsv import ToolPool, build_pipeline, pipeline_rest_api, singleton_store_factory, warm_up
+
+import dummy_modules
+
+SLOW_TOOLS = [(('dummy_modules', 'Tokeniser', 'Tokeniser', (), {}), ('tok',)),
+              (('dummy_modules', 'SlowInit', 'Slow upper', (), {}), ('upper',))]
+
+FAILING_TOOLS = [(('dummy_modules', 'Tokeniser', 'Tokeniser', (), {}), ('tok',)),
+                 (('dummy_modules', 'Missing', 'Missing', (), {}), ('missing',))]
+
+
+def test_warm_up_fills_the_singleton_store(tools, presets, raw_text):
+    singleton_store = singleton_store_factory()
+    status = warm_up(['tok', 'upper'], tools, presets, singleton_store)
+    report = status.report()
+    assert status.done and status.ready and report['ready']
+    assert sorted(report['tools']) == ['tok,tokenise', 'upper']  # The aliases are initialised once
+    assert all(tool['status'] == 'ready' and tool['init_time'] >= 0 for tool in report['tools'].values())
+
+    initialised = dict(singleton_store[0])
+    assert sorted(initialised) == ['tok', 'tokenise', 'upper']
+    assert initialised['tok'] is initialised['tokenise']
+    expected = ''.join(build_pipeline(raw_text, ['tok', 'upper'], tools, presets))
+    assert ''.join(build_pipeline(raw_text, ['tokenise', 'upper'], tools, presets, singleton_store=singleton_store)) \
+        == expected
+    assert dict(singleton_store[0]) == initialised  # Nothing is initialised again
+
+
+def test_warm_up_fills_the_tool_pool(tools, presets):
+    pool = ToolPool(2)
+    assert warm_up(None, tools, presets, pool, max_workers=2).ready
+    stats = pool.stats()
+    assert len(stats) == len(tools)
+    assert all(tool_stats['instances'] == 1 and tool_stats['idle'] == 1 for tool_stats in stats.values())
+
+
+def test_failed_warm_up(presets, raw_text):
+    singleton_store = singleton_store_factory()
+    status = warm_up(None, FAILING_TOOLS, presets, singleton_store)
+    report = status.report()
+    assert report['done'] and not report['ready']
+    assert report['tools']['tok']['status'] == 'ready'
+    assert report['tools']['missing']['status'] == 'failed'
+    assert 'Missing' in report['tools']['missing']['error']
+    # The other tools can be used
+    assert ''.join(build_pipeline(raw_text, ['tok'], FAILING_TOOLS, presets, singleton_store=singleton_store)).\
+        startswith('form\nEz\n')
+
+    client = pipeline_rest_api('test', FAILING_TOOLS, presets, False, singleton_store, warm_up_status=status).\
+        test_client()
+    response = client.get('/readyz')
+    assert response.status_code == 503
+    assert json.loads(response.get_data(as_text=True))['tools']['missing']['status'] == 'failed'
+
+
+def test_readyz_during_background_warm_up(presets):
+    dummy_modules.SlowInit.started.clear()
+    dummy_modules.SlowInit.release.clear()
+    singleton_store = singleton_store_factory()
+    status = warm_up(None, SLOW_TOOLS, presets, singleton_store, background=True)
+    client = pipeline_rest_api('test', SLOW_TOOLS, presets, False, singleton_store, warm_up_status=status).\
+        test_client()
+    try:
+        assert dummy_modules.SlowInit.started.wait(5)
+        response = client.get('/readyz')
+        assert response.status_code == 503
+        report = json.loads(response.get_data(as_text=True))
+        assert not report['done']
+        assert report['tools']['upper']['status'] == 'initialising'
+        assert client.get('/healthz').status_code == 200  # The server is alive
+    finally:
+        dummy_modules.SlowInit.release.set()
+    assert status.wait(5)
+    response = client.get('/readyz')
+    assert response.status_code == 200
+    assert json.loads(response.get_data(as_text=True))['ready']
+
+    response = client.post('/tok/upper', data={'text': 'Ez egy mondat.'})
+    assert response.get_data(as_text=True) == 'form\tupper\nEz\tEZ\negy\tEGY\nmondat.\tMONDAT.\n\n'
+
+
+def test_readyz_without_warm_up(tools, presets):
+    client = pipeline_rest_api('test', tools, presets, False).test_client()
+    response = client.get('/readyz')
+    assert response.status_code == 200
+    assert json.loads(response.get_data(as_text=True)) == {'done': True, 'ready': True, 'tools': {}}
@@ -1,9 +1,27 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8, vim: expandtab:ts=4 -*-
 
-from .pipeline import ModuleError, build_pipeline, pipeline_rest_api, singleton_store_factory
-from .tsvhandler import HeaderError, process
-from .argparser import parser_skeleton, add_bool_arg
+from .pipeline import ModuleError, PipelinePlan, WarmUpStatus, build_pipeline, compile_pipeline, process_documents, \
+    singleton_store_factory, warm_up
+from .options import PipelineOptions
+from .toolpool import ToolPool
+from .restapi import pipeline_rest_api
+from .tsvhandler import HeaderError, InputLimitError, SentenceStream, process, process_chain
+from .parallel import StageMonitor
+from .fastio import BinaryLineReader, write_output
+from .limits import InputLimits, check_admission, limit_input
+from .slo import AdmissionQueue, CancelToken, RequestCancelled
+from .tokenlookup import TokenLookup
+from .corpus import MmapCorpus, sidecar_index_path
+from .binformat import encode_binary, read_binary, write_binary
+from .cache import ResultCache
+from .optimiser import ConcurrentBranches, analyse_pipeline, plan_reannotation
+from .batch import FileResult, expand_inputs, iter_process_files, process_files
+from .checkpoint import run_checkpointed
+from .profiling import PipelineMetrics, PipelineProfile, prometheus_metrics
+from .asgi import pipeline_asgi_api
+from .jvmhost import RemoteTool, ToolHost, start_tool_host
+from .argparser import parser_skeleton, add_batch_args, add_bool_arg, add_profiling_args
 from .version import __version__
 
 # The PyJNIus is not a dependency of xtsv, rather a dependency of the modules actualy use it!
@@ -40,3 +40,35 @@ def parser_skeleton(*args, **kwargs):
     parser.add_argument(dest='task', nargs='?', default=())
 
     return parser
+
+
+def add_batch_args(parser):
+    """
+    Add the options of the batch mode (see process_files()) to the parser as an argument group. The batch mode is
+     off by default (opts.input_files is None), so the other options of parser_skeleton() work as before
+    """
+    group = parser.add_argument_group('batch mode')
+    group.add_argument('--input-files', dest='input_files', nargs='+', default=None,
+                       help='Batch mode: process the files, directories (recursively) or glob patterns '
+                            'into --output-dir with the tools initialised only once', metavar='PATH')
+    group.add_argument('--output-dir', dest='output_dir', type=str, default=None,
+                       help='The output directory of the batch mode (the relative paths of the inputs are kept)',
+                       metavar='DIR')
+    group.add_argument('--output-suffix', dest='output_suffix', type=str, default='',
+                       help='Append this suffix to the names of the output files in batch mode', metavar='SUFFIX')
+    group.add_argument('--file-workers', dest='file_workers', type=int, default=1,
+                       help='Process N files concurrently in batch mode (default: 1)', metavar='N')
+    add_bool_arg(group, 'overwrite', 'Process the files in batch mode even if their output exist '
+                                     '(default: skip them to resume an interrupted run)', has_negative_variant=False)
+    return group
+
+
+def add_profiling_args(parser):
+    """
+    Add the --profile option (print the PipelineProfile of the run to STDERR) to the parser as an argument group.
+     Profiling is off by default
+    """
+    group = parser.add_argument_group('profiling')
+    add_bool_arg(group, 'profile', 'Print the time, throughput and memory usage of each module to STDERR at the end',
+                 has_negative_variant=False)
+    return group
@@ -0,0 +1,666 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8, vim: expandtab:ts=4 -*-
+
+"""
+Asynchronous (ASGI) alternative of the REST API for serving many concurrent requests in one process with one copy
+ of every model. Run with any ASGI server (e.g. uvicorn 'module:app'), which is not a dependency of xtsv.
+ The request body is streamed into the pipeline and the output is streamed back while the pipeline runs
+ in a managed thread pool. The access to the tools which are not thread-safe (most of them) is serialised.
+ The output which the client does not read fast enough is buffered, so the tools are not held by slow clients.
+"""
+
+import asyncio
+import logging
+import threading
+import concurrent.futures
+from itertools import chain
+from collections import deque
+from json import dumps as json_dumps, loads as json_loads
+from tempfile import SpooledTemporaryFile
+from urllib.parse import parse_qs
+
+from werkzeug.http import parse_options_header
+from werkzeug.sansio.multipart import MultipartDecoder, Field, File, Data, Epilogue, NeedData
+
+from .tsvhandler import HeaderError, InputLimitError
+from .fastio import BinaryLineReader, encode_lines
+from .limits import check_admission
+from .slo import RETRY_AFTER, CancelToken, RequestCancelled, reject_overload
+from .pipeline import ModuleError, build_pipeline, lazy_init_tools, resolve_presets, singleton_store_factory
+from .toolpool import ToolPool
+from .restapi import NDJSON_CONTENT_TYPES, PROMETHEUS_CONTENT_TYPE, RESTapp, batch_results, check_reserved_names, \
+    checked_bool, checked_timeout, health_check, iter_ndjson
+from .profiling import prometheus_metrics
+from .tokenlookup import TokenLookup, checked_tokens, token_json
+
+logger = logging.getLogger('xtsv')
+
+_STARTED = b''  # Put into the output queue when the pipeline has started (see _run_pipeline())
+_MAX_BUFFERED_OUTPUT = 1 << 20  # Bytes of the output buffered in the memory, the rest is spooled to the disk
+
+
+def pipeline_asgi_api(available_tools, presets, conll_comments, singleton_store=None, output_header=True,
+                      max_workers=None, queue_size=16, warm_up_status=None, result_cache=None, metrics=None,
+                      input_limits=None, request_timeout=None, admission_queue=None, token_lookup=None):
+    """
+    Create an ASGI application with the same REST API as pipeline_rest_api() (without the HTML form)
+    :param available_tools: the uninitialised tools
+    :param presets: pre-defined chains eg. from tokenisation to dependency parsing
+    :param conll_comments: CoNLL-U-style comments (lines beginning with '# ') before sentences (default per request)
+    :param singleton_store: preinitialised tool pool (a new one is created for the application if not given)
+     or ToolPool to run the pipelines concurrently on several instances of the same tools
+    :param output_header: Make header for output or not (default per request)
+    :param max_workers: the number of pipelines running at once (threads, default: see ThreadPoolExecutor)
+    :param queue_size: the maximal number of chunks buffered between the client and the pipeline in both directions
+    :param warm_up_status: WarmUpStatus of the background warm-up of singleton_store (see warm_up()),
+     readyz answers 503 and the requests wait until it is finished
+    :param result_cache: ResultCache shared by the requests to reuse the output for repeated sentences
+    :param metrics: PipelineMetrics to profile every request (exported at the metrics endpoint)
+    :param input_limits: InputLimits of the requests (the size, the sentences, the lines and the memory usage)
+    :param request_timeout: the time budget of the requests in seconds (the clients can set shorter ones with the
+     timeout parameter), the pipeline is stopped between two sentences when it is exceeded or the client has gone away
+    :param admission_queue: AdmissionQueue to bound the concurrent and the waiting requests (503 over it, the
+     waiting requests do not occupy the threads)
+    :param token_lookup: TokenLookup shared by the requests to memoise and batch the calls of process_token()
+     (the memoised tokens are answered without the thread pool)
+    :return: the ASGI application
+    """
+    if available_tools is None:
+        raise ValueError('No internal_app is given!')
+    check_reserved_names(available_tools, presets)
+    if singleton_store is None:
+        singleton_store = singleton_store_factory()  # Must be shared between the requests
+    if token_lookup is None:
+        token_lookup = TokenLookup()
+    return ASGIapp(available_tools, presets, conll_comments, singleton_store, output_header, max_workers, queue_size,
+                   warm_up_status, result_cache, metrics, input_limits, request_timeout, admission_queue, token_lookup)
+
+
+class ASGIapp:
+    def __init__(self, internal_apps, presets, conll_comments, singleton_store, output_header=True, max_workers=None,
+                 queue_size=16, warm_up_status=None, result_cache=None, metrics=None, input_limits=None,
+                 request_timeout=None, admission_queue=None, token_lookup=None):
+        self._internal_apps = internal_apps
+        self._input_limits = input_limits
+        self._request_timeout = request_timeout
+        self._admission_queue = admission_queue
+        self._token_lookup = token_lookup if token_lookup is not None else TokenLookup()
+        self._warm_up_status = warm_up_status
+        self._result_cache = result_cache
+        self._metrics = metrics
+        self._presets = presets
+        self._conll_comments = conll_comments
+        self._singleton_store = singleton_store
+        self._output_header = output_header
+        self._queue_size = queue_size
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers, thread_name_prefix='xtsv-pipeline')
+        self._init_lock = threading.Lock()  # Initialise every tool only once
+        self._tool_locks = {}  # Serialise the access to the tools which are not thread-safe (by instance)
+        self._tool_locks_lock = threading.Lock()
+        # Dict of default tool names -> friendly names
+        self._available_tools = {names[0]: tool_params[2] for tool_params, names in internal_apps}
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+        elif scope['type'] == 'http':
+            if scope['method'] == 'POST':
+                await self._post(scope, receive, send)
+            elif scope['method'] == 'GET':
+                await self._get(scope, send)
+            else:
+                await _send_text(send, 405, 'ERROR: Only GET and POST methods are allowed!')
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self._executor.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def _get(self, scope, send):
+        # fun/token
+        path = scope['path'].lstrip('/')
+        if path.rstrip('/') in {'healthz', 'readyz'}:  # Answered without waiting for the thread pool
+            http_status, json_text = health_check(path.rstrip('/'), self._warm_up_status)
+            await _send_response(send, http_status, json_text.encode('UTF-8'), b'application/json; charset=utf-8')
+            return
+        if path.rstrip('/') == 'metrics':
+            await _send_response(send, 200, prometheus_metrics(self._metrics, self._result_cache,
+                                                                self._admission_queue,
+                                                                self._token_lookup).encode('UTF-8'),
+                                 PROMETHEUS_CONTENT_TYPE.encode('UTF-8'))
+            return
+        req_data = parse_qs(scope['query_string'].decode('UTF-8'))
+        fun, token = None, ''
+        if '/' in path:
+            fun, token = path.split('/', maxsplit=1)
+        if fun == 'tokens':
+            await self._send_tokens(send, token, req_data.get('token', []), req_data)
+            return
+        json_text = None
+        if len(token) > 0:
+            try:
+                compact = checked_bool('compact', False, {k: v[-1] for k, v in req_data.items()})
+            except ValueError as e:
+                await _send_text(send, 400, str(e))
+                return
+            results = await self._lookup_tokens(fun, [token])
+            if results is not None:
+                json_text = token_json(results, compact)
+        if json_text is None:  # No HTML form here, list the available tools and presets instead
+            json_text = json_dumps({'available_tools': self._available_tools,
+                                    'presets': {name: friendly for name, (friendly, _) in dict(self._presets).items()}},
+                                   indent=2, sort_keys=True, ensure_ascii=False)
+        await _send_response(send, 200, json_text.encode('UTF-8'), b'application/json; charset=utf-8')
+
+    async def _post(self, scope, receive, send):
+        if not await self._admitted(scope, send):
+            return
+        path = scope['path'].strip('/')
+        if path.split('/', maxsplit=1)[0] == 'tokens':  # Short lookups without the admission queue
+            try:
+                tokens = json_loads(b''.join([chunk async for chunk in
+                                              _iter_body(receive, _max_request_bytes(self._input_limits))]))
+            except InputLimitError as e:
+                await _send_text(send, 413, 'ERROR: {0}'.format(e))
+                return
+            except ValueError:
+                tokens = None
+            await self._send_tokens(send, path[len('tokens/'):], tokens,
+                                    parse_qs(scope['query_string'].decode('UTF-8')))
+            return
+        cancel = threading.Event()  # Set when the client has gone away (or the response is finished)
+        # The waiting in the queue is also part of the time budget
+        token = CancelToken(self._request_timeout, cancel)
+        if self._admission_queue is not None and not await self._admission_queue.acquire_async(token.remaining()):
+            await _send_text(send, *reject_overload(self._metrics))
+            return
+        try:
+            required_tools = scope['path'].strip('/').split('/')
+            if required_tools[0] == 'batch':
+                await self._post_batch(scope, receive, send, required_tools[1:], cancel, token)
+            else:
+                await self._post_pipeline(scope, receive, send, required_tools, cancel, token)
+        finally:
+            if self._admission_queue is not None:
+                self._admission_queue.release()
+
+    async def _post_pipeline(self, scope, receive, send, required_tools, cancel, token):
+        loop = asyncio.get_running_loop()
+        req_data = {k: v[-1] for k, v in parse_qs(scope['query_string'].decode('UTF-8')).items()}
+        headers = dict(scope['headers'])
+        content_type, content_type_options = parse_options_header(headers.get(b'content-type', b'').decode('latin1'))
+
+        body_task = None
+        if content_type in {'multipart/form-data', 'application/x-www-form-urlencoded', 'application/json'}:
+            try:
+                form_data, inp_data = await _read_form(receive, content_type, content_type_options,
+                                                       self._input_limits)
+            except InputLimitError as e:
+                await _send_text(send, 413, 'ERROR: {0}'.format(e))
+                return
+            except ValueError as e:
+                await _send_text(send, 400, 'ERROR: {0}'.format(e))
+                return
+            req_data.update(form_data)
+            if inp_data is None:
+                await _send_text(send, 400, 'ERROR: input text or file (mutually exclusive) not found in request!')
+                return
+            body_task = loop.create_task(_watch_disconnect(receive, cancel))
+        else:  # Raw body (e.g. text/plain) is streamed into the pipeline while it is received
+            request_body = _RequestBody(loop, self._queue_size, cancel, _max_request_bytes(self._input_limits))
+            inp_data = BinaryLineReader(request_body, chunk_size=1 << 16,
+                                        max_line_length=getattr(self._input_limits, 'max_line_length', None))
+            body_task = loop.create_task(request_body.receive_all(receive))
+
+        try:
+            conll_comments = checked_bool('conll_comments', self._conll_comments, req_data)
+            output_header = checked_bool('output_header', self._output_header, req_data)
+            tohtml = checked_bool('toHTML', False, req_data)
+            token.shorten(checked_timeout(req_data))
+        except ValueError as e:
+            body_task.cancel()
+            await _send_text(send, 400, str(e))
+            return
+
+        output = _ResponseQueue(loop, self._queue_size, cancel)
+        pipeline_run = loop.run_in_executor(self._executor, self._run_pipeline, inp_data, required_tools,
+                                            conll_comments, output_header, tohtml, output, token)
+        response_headers = [(b'content-type', b'text/plain; charset=utf-8')]
+        if not tohtml:
+            response_headers.append((b'content-disposition', b'attachment; filename="output.txt"'))
+        try:
+            await _stream_response(send, output, cancel, response_headers)
+        finally:
+            cancel.set()
+            body_task.cancel()
+            await pipeline_run
+
+    async def _post_batch(self, scope, receive, send, required_tools, cancel, token):
+        """ Many documents in one request: JSON array or NDJSON (streamed) in, NDJSON out in order """
+        loop = asyncio.get_running_loop()
+        req_data = {k: v[-1] for k, v in parse_qs(scope['query_string'].decode('UTF-8')).items()}
+        headers = dict(scope['headers'])
+        content_type, _ = parse_options_header(headers.get(b'content-type', b'').decode('latin1'))
+
+        if content_type in NDJSON_CONTENT_TYPES:  # Parsed while the documents are processed
+            request_body = _RequestBody(loop, self._queue_size, cancel, _max_request_bytes(self._input_limits))
+            items = iter_ndjson(BinaryLineReader(request_body, chunk_size=1 << 16))
+            body_task = loop.create_task(request_body.receive_all(receive))
+        else:
+            try:
+                items = json_loads(b''.join([chunk async for chunk in
+                                             _iter_body(receive, _max_request_bytes(self._input_limits))]))
+            except InputLimitError as e:
+                await _send_text(send, 413, 'ERROR: {0}'.format(e))
+                return
+            except ValueError:
+                items = None
+            if not isinstance(items, list):
+                await _send_text(send, 400, 'ERROR: the body should be a JSON array of documents or NDJSON!')
+                return
+            body_task = loop.create_task(_watch_disconnect(receive, cancel))
+
+        try:
+            conll_comments = checked_bool('conll_comments', self._conll_comments, req_data)
+            output_header = checked_bool('output_header', self._output_header, req_data)
+            token.shorten(checked_timeout(req_data))
+        except ValueError as e:
+            body_task.cancel()
+            await _send_text(send, 400, str(e))
+            return
+
+        output = _ResponseQueue(loop, self._queue_size, cancel)
+        batch_run = loop.run_in_executor(self._executor, self._run_batch, items, required_tools, conll_comments,
+                                         output_header, output, token)
+        try:
+            await _stream_response(send, output, cancel, [(b'content-type', b'application/x-ndjson; charset=utf-8')])
+        finally:
+            cancel.set()
+            body_task.cancel()
+            await batch_run
+
+    async def _admitted(self, scope, send):
+        """ Check the request size (if it is known) and the memory usage before reading the request """
+        content_length = dict(scope['headers']).get(b'content-length')
+        try:
+            content_length = int(content_length) if content_length is not None else None
+        except ValueError:
+            content_length = None
+        rejection = check_admission(self._input_limits, content_length, self._metrics)
+        if rejection is not None:
+            await _send_text(send, *rejection)
+            return False
+        return True
+
+    async def _send_tokens(self, send, tool, tokens, req_data):
+        """ The tokens endpoint: many tokens processed by one tool (see TokenLookup) """
+        try:
+            compact = checked_bool('compact', False, {k: v[-1] for k, v in req_data.items()})
+            tokens = checked_tokens(tokens)
+        except ValueError as e:
+            await _send_text(send, 400, str(e))
+            return
+        results = await self._lookup_tokens(tool, tokens)
+        if results is None:
+            await _send_text(send, 404, 'ERROR: {0} is not available or does not support processing single tokens!'.
+                             format(tool))
+            return
+        await _send_response(send, 200, token_json(results, compact).encode('UTF-8'),
+                             b'application/json; charset=utf-8')
+
+    async def _lookup_tokens(self, fun, tokens):
+        """ The results of the tokens (None if the tool does not support it), only the tool calls use the threads """
+        results = self._token_lookup.memoised(fun, tokens)
+        if results is None:
+            results = await asyncio.get_running_loop().run_in_executor(
+                self._executor, self._token_lookup.lookup, fun, tokens,
+                lambda process: self._run_with_tool(fun, process))
+        return results
+
+    def _run_with_tool(self, fun, process):
+        """ Runs in the thread pool: call process() with the initialised tool (None if it is not available) """
+        if isinstance(self._singleton_store, ToolPool):  # The checked out instance is used exclusively
+            with self._singleton_store.tools([fun], self._internal_apps, self._presets) as curr_tools:
+                return process(curr_tools.get(fun))
+        tool = self._init_tools([fun]).get(fun)
+        return self._run_exclusively([fun], lambda: process(tool))
+
+    def _init_tools(self, required_tools):
+        if self._warm_up_status is not None:  # The tools are initialised only once
+            self._warm_up_status.wait()
+        with self._init_lock:
+            return lazy_init_tools(required_tools, self._internal_apps, self._presets, self._singleton_store)
+
+    def _locks_for(self, required_tools):
+        if isinstance(self._singleton_store, ToolPool):  # The pipeline checks out its own instances
+            return []
+        current_initialised_tools = self._init_tools(required_tools)
+        instances = {id(inst): inst for inst in (current_initialised_tools.get(name)
+                                                 for name in resolve_presets(self._presets, required_tools))
+                     if inst is not None and not getattr(inst, 'thread_safe', False)}
+        with self._tool_locks_lock:
+            # Always acquire the locks in the same order to avoid deadlocks
+            return [self._tool_locks.setdefault(inst_id, threading.Lock()) for inst_id in sorted(instances)]
+
+    def _run_exclusively(self, required_tools, fun):
+        locks = self._locks_for(required_tools)
+        for lock in locks:
+            lock.acquire()
+        try:
+            return fun()
+        finally:
+            for lock in reversed(locks):
+                lock.release()
+
+    def _run_pipeline(self, inp_data, required_tools, conll_comments, output_header, tohtml, output, token):
+        """ Runs in the thread pool: the first item put to the output is _STARTED or the exception """
+        buffered_output = _BufferedOutput(output)
+        self._run_cancellable(buffered_output, token, lambda: self._run_exclusively(
+            required_tools, lambda: self._stream_pipeline(inp_data, required_tools, conll_comments, output_header,
+                                                          tohtml, buffered_output, token)))
+        # The tools are released: the rest of the output is sent at the pace of the client
+        self._run_cancellable(output, token, buffered_output.flush)
+
+    def _run_batch(self, items, required_tools, conll_comments, output_header, output, token):
+        """ Runs in the thread pool: the tools are used exclusively for the whole batch """
+        buffered_output = _BufferedOutput(output)
+        self._run_cancellable(buffered_output, token, lambda: self._run_exclusively(
+            required_tools, lambda: self._stream_batch(items, required_tools, conll_comments, output_header,
+                                                       buffered_output, token)))
+        self._run_cancellable(output, token, buffered_output.flush)
+
+    def _run_cancellable(self, output, token, fun):
+        """ The exceptions are put to the output, the cancelled requests are counted """
+        try:
+            fun()
+        except _Cancelled:  # The client has gone away while the output was sent
+            self._count_cancelled('disconnect')
+        except RequestCancelled as e:
+            self._count_cancelled(e.reason)
+            if e.reason != 'disconnect':  # Else nobody reads the output
+                try:
+                    output.put(e)
+                except _Cancelled:
+                    pass
+        except Exception as e:
+            output.put(e)
+
+    def _count_cancelled(self, reason):
+        if self._metrics is not None:
+            self._metrics.cancel(reason)
+
+    def _stream_batch(self, items, required_tools, conll_comments, output_header, output, token):
+        lines = batch_results(items, required_tools, self._internal_apps, self._presets, conll_comments,
+                              self._singleton_store, output_header, self._result_cache, self._metrics,
+                              self._input_limits, token)
+        output.put(_STARTED)
+        for chunk in encode_lines(lines, buffer_size=1 << 12):
+            output.put(chunk)
+        output.put(None)
+
+    def _stream_pipeline(self, inp_data, required_tools, conll_comments, output_header, tohtml, output, token):
+        profile = self._metrics.new_profile() if self._metrics is not None else None
+        last_prog = build_pipeline(inp_data, required_tools, self._internal_apps, self._presets, conll_comments,
+                                   self._singleton_store, output_header, result_cache=self._result_cache,
+                                   profile=profile, input_limits=self._input_limits, cancel=token)
+        chunks = encode_lines(last_prog, buffer_size=1 << 14)
+        if tohtml:
+            chunks = RESTapp._to_html(chunks)
+        first_chunk = next(chunks, None)  # The input rejected at the beginning is reported with status code
+        output.put(_STARTED)
+        for chunk in chain([first_chunk] if first_chunk is not None else [], chunks):
+            output.put(chunk)
+        output.put(None)
+
+
+# From here, there are only private methods
+
+class _Cancelled(Exception):
+    pass
+
+
+class _RequestBody:
+    """ File-like view (read()) for the worker thread on the request body received by the event loop """
+    def __init__(self, loop, queue_size, cancel, max_bytes=None):
+        self.name = 'request body'
+        self._loop = loop
+        self._queue = asyncio.Queue(queue_size)
+        self._cancel = cancel
+        self._max_bytes = max_bytes
+        self._eof = False
+
+    async def receive_all(self, receive):
+        received = 0
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                self._cancel.set()
+                break
+            body = message.get('body', b'')
+            received += len(body)
+            if self._max_bytes is not None and received > self._max_bytes:  # The reader raises it
+                await self._queue.put(_request_too_large(self._max_bytes))
+                break
+            await self._queue.put(body)
+            if not message.get('more_body', False):
+                break
+        await self._queue.put(None)
+        await _watch_disconnect(receive, self._cancel)
+
+    def read(self, _=-1):
+        while not self._eof:
+            if self._cancel.is_set():
+                raise _Cancelled()
+            chunk = _wait_for(asyncio.run_coroutine_threadsafe(self._queue.get(), self._loop), self._cancel)
+            if chunk is None:
+                self._eof = True
+            elif isinstance(chunk, Exception):
+                self._eof = True
+                raise chunk
+            elif len(chunk) > 0:
+                return chunk
+        return b''
+
+
+class _ResponseQueue:
+    """ Put the output chunks from the worker thread to the event loop (blocks when the client is slow) """
+    def __init__(self, loop, queue_size, cancel):
+        self._loop = loop
+        self._queue = asyncio.Queue(queue_size)
+        self._cancel = cancel
+
+    def put(self, item):
+        _wait_for(asyncio.run_coroutine_threadsafe(self._queue.put(item), self._loop), self._cancel)
+
+    def try_put(self, item):
+        """ Put the item only if the queue is not full (does not wait for the client) """
+        return _wait_for(asyncio.run_coroutine_threadsafe(self._put_nowait(item), self._loop), self._cancel)
+
+    async def _put_nowait(self, item):
+        if self._queue.full():
+            return False
+        self._queue.put_nowait(item)
+        return True
+
+    async def get(self):
+        """ The next item or None when the client has gone away and the worker thread stopped putting items """
+        while True:
+            try:
+                return await asyncio.wait_for(self._queue.get(), 0.1)
+            except asyncio.TimeoutError:
+                if self._cancel.is_set():
+                    return None
+
+
+class _BufferedOutput:
+    """
+    The output of a pipeline holding the tools: the items are put to the response queue while the client keeps up,
+     after the queue is full, the rest is buffered (spooled to the disk when large) until flush() is called
+     when the tools are released
+    """
+    def __init__(self, output):
+        self._output = output
+        self._spool = None
+        self._items = deque()  # The length of the spooled chunks (bytes) or the other items (e.g. exceptions)
+
+    def put(self, item):
+        if self._spool is None:
+            if self._output.try_put(item):
+                return
+            self._spool = SpooledTemporaryFile(_MAX_BUFFERED_OUTPUT)
+        if isinstance(item, bytes):
+            self._spool.write(item)
+            self._items.append(len(item))
+        else:
+            self._items.append(item)
+
+    def flush(self):
+        if self._spool is None:
+            return
+        self._spool.seek(0)
+        try:
+            while len(self._items) > 0:
+                item = self._items.popleft()
+                self._output.put(self._spool.read(item) if isinstance(item, int) else item)
+        finally:
+            self._spool.close()
+
+
+def _wait_for(future, cancel):
+    while True:
+        try:
+            return future.result(timeout=0.1)
+        except concurrent.futures.TimeoutError:
+            if cancel.is_set():
+                future.cancel()
+                raise _Cancelled()
+
+
+async def _watch_disconnect(receive, cancel):
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            cancel.set()
+            return
+
+
+async def _read_form(receive, content_type, content_type_options, input_limits=None):
+    """ Read the whole form (spool the uploaded file to disk when it is large) and return the fields and the input """
+    max_bytes = _max_request_bytes(input_limits)
+    form_data = {}
+    text = None
+    upload = None
+    if content_type == 'multipart/form-data':
+        decoder = MultipartDecoder(content_type_options.get('boundary', '').encode('latin1'))
+        current_part, current_value = None, []
+        async for chunk in _iter_body(receive, max_bytes):
+            decoder.receive_data(chunk)
+            event = decoder.next_event()
+            while not isinstance(event, (NeedData, Epilogue)):
+                if isinstance(event, File) and event.name == 'file':
+                    current_part, upload = event, SpooledTemporaryFile(1 << 19)
+                elif isinstance(event, (Field, File)):
+                    current_part, current_value = event, []
+                elif isinstance(event, Data):
+                    if current_part.name == 'file' and isinstance(current_part, File):
+                        upload.write(event.data)
+                    else:
+                        current_value.append(event.data)
+                    if not event.more_data and not (current_part.name == 'file' and isinstance(current_part, File)):
+                        form_data[current_part.name] = b''.join(current_value).decode('UTF-8')
+                event = decoder.next_event()
+        decoder.receive_data(None)
+        text = form_data.pop('text', None)
+    else:
+        body = b''.join([chunk async for chunk in _iter_body(receive, max_bytes)]).decode('UTF-8')
+        if content_type == 'application/json':
+            form_data = json_loads(body) if len(body) > 0 else {}
+            if not isinstance(form_data, dict):
+                raise ValueError('JSON object is expected!')
+        else:
+            form_data = {k: v[-1] for k, v in parse_qs(body).items()}
+        text = form_data.pop('text', None)
+        if text is not None and not isinstance(text, str):
+            raise ValueError('the input text should be a string!')
+
+    if (text is None) == (upload is None):  # Both or none of them
+        return form_data, None
+    if upload is not None:
+        upload.seek(0)
+        return form_data, BinaryLineReader(upload, max_line_length=getattr(input_limits, 'max_line_length', None))
+    return form_data, text
+
+
+async def _stream_response(send, output, cancel, response_headers):
+    """
+    Send the chunks of the output: the status depends on the first item (_STARTED or the exception). The status is
+     already sent when the pipeline fails or it is cancelled while streaming, so the exception is raised to abort the
+     connection (the ASGI server does not terminate the chunked response, so the cut output can not look complete)
+    """
+    first_item = await output.get()
+    if first_item is None:  # The client has gone away before the response started
+        return
+    if isinstance(first_item, Exception):
+        if isinstance(first_item, (HeaderError, ModuleError, InputLimitError)):
+            await _send_text(send, 400, str(first_item))
+        elif isinstance(first_item, RequestCancelled):
+            logger.warning('Request cancelled: {0}'.format(first_item))
+            await _send_text(send, 503, str(first_item))
+        else:
+            logger.error('Pipeline failed: {0}'.format(first_item))
+            await _send_text(send, 500, 'ERROR: Internal server error!')
+        return
+
+    await send({'type': 'http.response.start', 'status': 200, 'headers': response_headers})
+    while not cancel.is_set():
+        item = await output.get()
+        if item is None:
+            break
+        if isinstance(item, RequestCancelled):
+            logger.warning('Request cancelled while streaming, the connection is aborted: {0}'.format(item))
+            raise item
+        if isinstance(item, Exception):
+            logger.error('Pipeline failed while streaming, the connection is aborted: {0}'.format(item))
+            raise item
+        await send({'type': 'http.response.body', 'body': item, 'more_body': True})
+    await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+
+
+async def _iter_body(receive, max_bytes=None):
+    received = 0
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            raise ValueError('Client disconnected!')
+        body = message.get('body', b'')
+        received += len(body)
+        if max_bytes is not None and received > max_bytes:
+            raise _request_too_large(max_bytes)
+        yield body
+        if not message.get('more_body', False):
+            return
+
+
+def _max_request_bytes(input_limits):
+    return getattr(input_limits, 'max_request_bytes', None)
+
+
+def _request_too_large(max_bytes):
+    return InputLimitError('the request is larger than {0} bytes!'.format(max_bytes))
+
+
+async def _send_text(send, status, text):
+    await _send_response(send, status, text.encode('UTF-8'), b'text/plain; charset=utf-8')
+
+
+async def _send_response(send, status, body, content_type):
+    headers = [(b'content-type', content_type)]
+    if status == 503:  # Temporary
+        headers.append((b'retry-after', str(RETRY_AFTER).encode('latin1')))
+    await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+    await send({'type': 'http.response.body', 'body': body, 'more_body': False})
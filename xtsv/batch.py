@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8, vim: expandtab:ts=4 -*-
+
+"""
+Batch processing of many files (directories or glob patterns) with one initialisation of the tools per worker:
+ the files are distributed among a pool of workers, the outputs are written atomically (to a temporary file renamed
+ at the end), so the existing outputs are always complete and can be skipped when an interrupted run is restarted
+"""
+
+import os
+import glob
+import logging
+import threading
+import multiprocessing
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from .fastio import write_output
+from .jnius_wrapper import jnius_config
+from .toolpool import ToolPool
+
+logger = logging.getLogger('xtsv')
+
+FileResult = namedtuple('FileResult', ['input_path', 'output_path', 'status', 'error'])
+FileResult.__doc__ = """ The outcome of a file: status is 'done', 'skipped' (the output existed) or 'failed' """
+
+# The state of the current worker process set by _init_file_worker() (the compiled plan, the tools and the options)
+_file_worker_state = None
+
+
+def expand_inputs(inputs):
+    """
+    Collect the input files from files, directories (recursively, hidden files excluded) and glob patterns
+    :param inputs: the list of paths and patterns
+    :return: the list of (input path, path relative to the directory or to the non-pattern part of the glob) pairs
+     in a deterministic order
+    """
+    files = []
+    for inp in inputs:
+        if os.path.isdir(inp):
+            dir_files = []
+            for dir_path, dir_names, file_names in os.walk(inp):
+                dir_names[:] = [name for name in dir_names if not name.startswith('.')]
+                dir_files.extend(os.path.join(dir_path, name) for name in file_names if not name.startswith('.'))
+            files.extend((path, os.path.relpath(path, inp)) for path in sorted(dir_files))
+        elif glob.has_magic(inp):
+            base_dir = _glob_base_dir(inp)
+            files.extend((path, os.path.relpath(path, base_dir))
+                         for path in sorted(glob.glob(inp, recursive=True)) if os.path.isfile(path))
+        elif os.path.isfile(inp):
+            files.append((inp, os.path.basename(inp)))
+        else:
+            raise ValueError('Input file, directory or pattern not found: {0}'.format(inp))
+    return files
+
+
+def process_files(inputs, output_dir, used_tools, available_tools, presets, conll_comments=False, output_header=True,
+                  num_workers=1, overwrite=False, output_suffix='', worker_type='auto', singleton_store=None):
+    """
+    Process many files into the output directory keeping their relative paths (see iter_process_files())
+    :return: the list of FileResult in the order of completion (after every file is processed)
+    """
+    return list(iter_process_files(inputs, output_dir, used_tools, available_tools, presets, conll_comments,
+                                   output_header, num_workers, overwrite, output_suffix, worker_type, singleton_store))
+
+
+def iter_process_files(inputs, output_dir, used_tools, available_tools, presets, conll_comments=False,
+                       output_header=True, num_workers=1, overwrite=False, output_suffix='', worker_type='auto',
+                       singleton_store=None):
+    """
+    Process many files into the output directory keeping their relative paths (see expand_inputs()) lazily:
+     the files are processed while the results are consumed
+    :param inputs: the list of files, directories and glob patterns
+    :param output_dir: the output directory (created if needed)
+    :param used_tools, available_tools, presets, conll_comments, output_header: like build_pipeline()
+    :param num_workers: the number of files processed concurrently (each worker initialises its tools once)
+    :param overwrite: process the files even if their output exists (default: skip them to resume a stopped run)
+    :param output_suffix: appended to the names of the output files (e.g. '.tsv')
+    :param worker_type: 'process', 'thread' (the workers check out the instances from the singleton_store which
+     should be a ToolPool) or 'auto' (threads if the JVM is running, processes otherwise)
+    :param singleton_store: the initialised tools used in the current process (one worker or thread workers)
+    :return: iterator of FileResult in the order of completion
+    """
+    from .pipeline import compile_pipeline  # Circular import...
+
+    tasks = []
+    output_paths = {}
+    for input_path, rel_path in expand_inputs(inputs):
+        output_path = os.path.join(output_dir, rel_path + output_suffix)
+        other_input = output_paths.setdefault(os.path.abspath(output_path), input_path)
+        if other_input != input_path:
+            raise ValueError('{0} and {1} would be written to the same output: {2}'.
+                             format(other_input, input_path, output_path))
+        tasks.append((input_path, output_path))
+
+    todo = []
+    for input_path, output_path in tasks:
+        if not overwrite and os.path.exists(output_path):  # Outputs are written atomically, so they are complete
+            yield FileResult(input_path, output_path, 'skipped', None)
+        else:
+            todo.append((input_path, output_path))
+    if len(todo) == 0:
+        return
+
+    plan = compile_pipeline(used_tools, available_tools, presets)  # Fail early if the tools are not found
+    options = (conll_comments, output_header)
+    if worker_type == 'auto':
+        worker_type = 'thread' if getattr(jnius_config, 'vm_running', False) else 'process'
+    num_workers = min(num_workers, len(todo))
+
+    if num_workers <= 1:
+        current_initialised_tools = plan.init_tools(singleton_store) \
+            if not isinstance(singleton_store, ToolPool) else None
+        for task in todo:
+            yield _process_file(task, plan, current_initialised_tools, options, singleton_store)
+    elif worker_type == 'thread':
+        if singleton_store is None:
+            singleton_store = ToolPool(max_instances=num_workers)
+        elif not isinstance(singleton_store, ToolPool):
+            raise ValueError('Thread workers need a ToolPool as singleton_store!')
+        with ThreadPoolExecutor(num_workers) as executor:
+            futures = [executor.submit(_process_file, task, plan, None, options, singleton_store) for task in todo]
+            for future in as_completed(futures):
+                yield future.result()
+    else:
+        init_args = (used_tools, available_tools, presets, options)
+        with multiprocessing.Pool(num_workers, initializer=_init_file_worker, initargs=init_args) as pool:
+            yield from pool.imap_unordered(_process_file_in_worker, todo)
+
+
+# From here, there are only private methods
+def _glob_base_dir(pattern):
+    """ The directory part of the pattern before the first component with wildcards """
+    base_parts = []
+    for part in pattern.split(os.sep):
+        if glob.has_magic(part):
+            break
+        base_parts.append(part)
+    return os.sep.join(base_parts) or os.curdir
+
+
+def _init_file_worker(used_tools, available_tools, presets, options):
+    from .pipeline import compile_pipeline  # Circular import...
+
+    global _file_worker_state
+    plan = compile_pipeline(used_tools, available_tools, presets)
+    _file_worker_state = (plan, plan.init_tools(), options)
+
+
+def _process_file_in_worker(task):
+    plan, current_initialised_tools, options = _file_worker_state
+    return _process_file(task, plan, current_initialised_tools, options)
+
+
+def _process_file(task, plan, current_initialised_tools, options, singleton_store=None):
+    input_path, output_path = task
+    conll_comments, output_header = options
+    output_dir = os.path.dirname(output_path) or os.curdir
+    tmp_path = None
+    try:
+        os.makedirs(output_dir, exist_ok=True)
+        # Hidden temporary file in the same directory (on the same filesystem) unique for the worker
+        tmp_path = os.path.join(output_dir, '.{0}.{1}.{2}.tmp'.format(os.path.basename(output_path), os.getpid(),
+                                                                     threading.get_ident()))
+        with open(input_path, 'rb') as inp_fh, open(tmp_path, 'w', encoding='UTF-8') as out_fh:
+            if len(inp_fh.peek(1)) > 0:  # Empty input, empty output
+                if current_initialised_tools is not None:
+                    output = plan.run_with_tools(inp_fh, current_initialised_tools, conll_comments, output_header)
+                else:
+                    output = plan.run(inp_fh, conll_comments, singleton_store, output_header)
+                write_output(output, out_fh)
+            out_fh.flush()  # The buffered text must reach the file before it is synced
+            os.fsync(out_fh.fileno())
+        os.replace(tmp_path, output_path)
+    except Exception as e:  # The error of a file does not stop the others
+        logger.error('{0}: {1}'.format(input_path, e))
+        if tmp_path is not None and os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return FileResult(input_path, output_path, 'failed', str(e) or type(e).__name__)
+    logger.info('{0} -> {1}'.format(input_path, output_path))
+    return FileResult(input_path, output_path, 'done', None)
@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8, vim: expandtab:ts=4 -*-
+
+"""
+Compact binary format of the TSV streams for handing over intermediate results between jobs without formatting and
+ parsing TSV again. The file starts with a magic, the flags and the header line (stored only once), followed by
+ length-prefixed blocks of sentences (optionally compressed with zlib). A block is column-oriented: the token counts
+ (and the comments) of the sentences are followed by the columns of all the tokens in the block (the values of
+ a column joined by newlines), so the (sentence, comment) pairs of sentence_iterator() round-trip losslessly
+ (CoNLL-U style comments included)
+"""
+
+import io
+import sys
+import zlib
+import struct
+from array import array
+from itertools import chain
+from argparse import ArgumentParser
+
+from .fastio import BinaryLineReader, write_output
+from .tsvhandler import SentenceStream, sentence_iterator
+
+MAGIC = b'XTSVBIN1'
+_FLAG_ZLIB = 1
+_FLAG_HEADER = 2
+_RAGGED = 0xFFFFFFFF  # The column count of the blocks with different number of fields per token
+_FILE_HEADER = struct.Struct('<8sBI')  # magic, flags, length of the header line
+_BLOCK_HEADER = struct.Struct('<II')  # length of the (compressed) block, number of sentences
+_COLUMNS_HEADER = struct.Struct('<I?')  # number of columns, has comments
+_LENGTH = struct.Struct('<I')
+_COUNTS_TYPE = 'I'  # Token counts and comment lengths (little-endian unsigned 32 bit)
+
+
+def encode_binary(stream, conll_comments=False, compress=False, has_header=True, block_size=256):
+    """
+    Encode a TSV stream to the binary format
+    :param stream: SentenceStream (e.g. the parsed output of build_pipeline()) or TSV lines (e.g. a file)
+    :param conll_comments: Allow conll style comments (lines starting with '# ') before sentences (TSV lines only)
+    :param compress: compress the blocks with zlib (True or the compression level)
+    :param has_header: the first line is the header (TSV lines only, False for fixed-order TSV)
+    :param block_size: the number of sentences in a block
+    :return: iterator over the bytes of the file
+    """
+    if getattr(stream, 'parsed_sentences', None) is not None:
+        header = stream.header
+        sentences = stream.parsed_sentences()
+    else:
+        track_stream = {'file_name': getattr(stream, 'name', 'no filename for stream'),
+                        'curr_line_number': int(has_header)}
+        stream = iter(stream)
+        header = next(stream, None) if has_header else None
+        sentences = sentence_iterator(stream, conll_comments, track_stream)
+
+    compress_level = None
+    if compress is not False and compress is not None:
+        compress_level = -1 if compress is True else compress
+    flags = (_FLAG_ZLIB if compress_level is not None else 0) | (_FLAG_HEADER if header is not None else 0)
+    header_bytes = header.rstrip('\n').encode('UTF-8') if header is not None else b''
+    yield _FILE_HEADER.pack(MAGIC, flags, len(header_bytes)) + header_bytes
+
+    block = []
+    for sen_and_comment in sentences:
+        block.append(sen_and_comment)
+        if len(block) == block_size:
+            yield _encode_block(block, compress_level)
+            block = []
+    if len(block) > 0:
+        yield _encode_block(block, compress_level)
+
+
+def write_binary(stream, output_stream, conll_comments=False, compress=False, has_header=True, block_size=256):
+    """ Write the TSV stream to the binary output stream (see encode_binary()) """
+    for chunk in encode_binary(stream, conll_comments, compress, has_header, block_size):
+        output_stream.write(chunk)
+    output_stream.flush()
+
+
+def read_binary(input_stream):
+    """
+    Read the binary format
+    :param input_stream: binary stream (e.g. file opened in 'rb' mode), text stream with buffer (e.g. STDIN) or bytes
+    :return: SentenceStream which can be passed to build_pipeline() directly or iterated as TSV lines
+    """
+    if isinstance(input_stream, (bytes, bytearray, memoryview)):
+        input_stream = io.BytesIO(input_stream)
+    elif isinstance(input_stream, io.TextIOBase):
+        input_stream = input_stream.buffer
+    name = getattr(input_stream, 'name', 'no filename for stream')
+    file_header = _read_exactly(input_stream, _FILE_HEADER.size, name)
+    magic, flags, header_len = _FILE_HEADER.unpack(file_header)
+    if magic != MAGIC:
+        raise ValueError('{0} is not in the binary format of xtsv!'.format(name))
+    header = None
+    header_bytes = _read_exactly(input_stream, header_len, name)
+    if flags & _FLAG_HEADER:
+        header = '{0}\n'.format(header_bytes.decode('UTF-8'))
+    return SentenceStream(header, _read_sentences(input_stream, flags & _FLAG_ZLIB, name), name)
+
+
+# From here, there are only private methods
+def _encode_block(block, compress_level):
+    tokens = list(chain.from_iterable(sen for sen, _ in block))
+    widths = set(map(len, tokens))
+    if len(widths) == 1:
+        num_columns = widths.pop()
+        columns = ['\n'.join(column) for column in zip(*tokens)]
+    else:
+        num_columns = _RAGGED
+        columns = ['\n'.join('\t'.join(tok) for tok in tokens)]
+    comments = [comment.encode('UTF-8') for _, comment in block]
+    has_comments = any(len(comment) > 0 for comment in comments)
+
+    parts = [_COLUMNS_HEADER.pack(num_columns, has_comments),
+             _to_little_endian(array(_COUNTS_TYPE, (len(sen) for sen, _ in block)))]
+    if has_comments:
+        parts.append(_to_little_endian(array(_COUNTS_TYPE, map(len, comments))))
+        parts.extend(comments)
+    for column in columns:
+        column_bytes = column.encode('UTF-8')
+        parts.append(_LENGTH.pack(len(column_bytes)))
+        parts.append(column_bytes)
+    data = b''.join(parts)
+    if compress_level is not None:
+        data = zlib.compress(data, compress_level)
+    return _BLOCK_HEADER.pack(len(data), len(block)) + data
+
+
+def _to_little_endian(counts):
+    if sys.byteorder != 'little':
+        counts.byteswap()
+    return counts.tobytes()
+
+
+def _from_little_endian(data):
+    counts = array(_COUNTS_TYPE)
+    counts.frombytes(data)
+    if sys.byteorder != 'little':
+        counts.byteswap()
+    return counts
+
+
+def _read_exactly(input_stream, size, name):
+    data = input_stream.read(size)
+    if len(data) != size:
+        raise ValueError('Unexpected end of the binary file {0}!'.format(name))
+    return data
+
+
+def _read_sentences(input_stream, compressed, name):
+    while True:
+        block_header = input_stream.read(_BLOCK_HEADER.size)
+        if len(block_header) == 0:  # End of file
+            return
+        if len(block_header) != _BLOCK_HEADER.size:
+            raise ValueError('Unexpected end of the binary file {0}!'.format(name))
+        block_len, sen_count = _BLOCK_HEADER.unpack(block_header)
+        block = _read_exactly(input_stream, block_len, name)
+        if compressed:
+            block = zlib.decompress(block)
+        yield from _decode_block(memoryview(block), sen_count, name)
+
+
+def _decode_block(block, sen_count, name):
+    num_columns, has_comments = _COLUMNS_HEADER.unpack_from(block, 0)
+    pos = _COLUMNS_HEADER.size
+    counts_size = sen_count * array(_COUNTS_TYPE).itemsize
+    token_counts = _from_little_endian(block[pos:pos + counts_size])
+    pos += counts_size
+    comments = [''] * sen_count
+    if has_comments:
+        comment_lengths = _from_little_endian(block[pos:pos + counts_size])
+        pos += counts_size
+        for i, comment_len in enumerate(comment_lengths):
+            comments[i] = str(block[pos:pos + comment_len], 'UTF-8')
+            pos += comment_len
+
+    num_tokens = sum(token_counts)
+    columns = []
+    for _ in range(1 if num_columns == _RAGGED else num_columns):
+        column_len, = _LENGTH.unpack_from(block, pos)
+        pos += _LENGTH.size
+        values = str(block[pos:pos + column_len], 'UTF-8').split('\n')
+        pos += column_len
+        if len(values) != num_tokens:
+            raise ValueError('Corrupt block in the binary file {0}!'.format(name))
+        columns.append(values)
+    if num_columns == _RAGGED:
+        tokens = [tok.split('\t') for tok in columns[0]]
+    else:
+        tokens = list(map(list, zip(*columns)))
+
+    start = 0
+    for token_count, comment in zip(token_counts, comments):
+        yield tokens[start:start + token_count], comment
+        start += token_count
+
+
+def main():
+    argparser = ArgumentParser(description='Convert between the TSV and the binary format of xtsv')
+    argparser.add_argument(dest='direction', choices=('encode', 'decode'),
+                           help='encode: TSV to binary, decode: binary to TSV')
+    argparser.add_argument('-i', '--input', dest='input_file', default=None, help='Input file (default: STDIN)')
+    argparser.add_argument('-o', '--output', dest='output_file', default=None, help='Output file (default: STDOUT)')
+    argparser.add_argument('--conllu-comments', dest='conllu_comments', action='store_true',
+                           help='Enable CoNLL-U style comments (lines starting with "# ") in the TSV input')
+    argparser.add_argument('--compress', action='store_true', help='Compress the binary output with zlib')
+    argparser.add_argument('--no-header', dest='has_header', action='store_false',
+                           help='The TSV input has no header (fixed-order TSV)')
+    opts = argparser.parse_args()
+
+    input_stream = open(opts.input_file, 'rb') if opts.input_file is not None else sys.stdin.buffer
+    output_stream = open(opts.output_file, 'wb') if opts.output_file is not None else sys.stdout.buffer
+    with input_stream, output_stream:
+        if opts.direction == 'encode':
+            write_binary(BinaryLineReader(input_stream), output_stream, opts.conllu_comments, opts.compress,
+                         opts.has_header)
+        else:
+            write_output(read_binary(input_stream), output_stream)
+
+
+if __name__ == '__main__':
+    main()
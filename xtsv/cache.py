@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8, vim: expandtab:ts=4 -*-
+
+"""
+Content-addressed cache of the processed sentences: the key is the hash of the tool (its parameters from
+ available_tools), the input header and the input sentence, the value is the output of process_sentence().
+ Repeated sentences (boilerplate, re-submitted documents) are processed only once.
+"""
+
+import pickle
+import sqlite3
+import hashlib
+import threading
+from weakref import WeakKeyDictionary
+from collections import OrderedDict
+
+from .moduletypes import is_sentence_module
+
+
+class ResultCache:
+    """ Thread-safe LRU cache of processed sentences in memory with an optional on-disk (SQLite) backend """
+    def __init__(self, max_entries=100000, max_bytes=None, disk_path=None):
+        """
+        :param max_entries: the maximal number of sentences kept in memory
+        :param max_bytes: the maximal (approximate) size of the sentences kept in memory (default: unlimited)
+        :param disk_path: the SQLite database file to store every sentence persistently (default: memory only)
+        """
+        self._max_entries = max_entries
+        self._max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._tool_keys = WeakKeyDictionary()
+        self._counters = {'hits': 0, 'disk_hits': 0, 'misses': 0, 'evictions': 0}
+        self._db = None
+        if disk_path is not None:
+            self._db = sqlite3.connect(disk_path, check_same_thread=False, isolation_level=None)
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute('PRAGMA synchronous=OFF')
+            self._db.execute('CREATE TABLE IF NOT EXISTS sentences (key BLOB PRIMARY KEY, value BLOB)')
+
+    def register_tool(self, internal_app, prog_params):
+        """ Identify the initialised tool by its parameters (module, class, friendly name, args, kwargs) """
+        try:
+            self._tool_keys[internal_app] = repr(prog_params)
+        except TypeError:  # Not weak referenceable: identified by its class
+            pass
+
+    def tool_key(self, internal_app):
+        tool_key = None
+        try:
+            tool_key = self._tool_keys.get(internal_app)
+        except TypeError:
+            pass
+        if tool_key is None:
+            tool_key = '{0}.{1}'.format(type(internal_app).__module__, type(internal_app).__qualname__)
+        return tool_key
+
+    @staticmethod
+    def make_key(prefix, sen):
+        """ The digest of the tool (and header) prefix and the columns of the input sentence """
+        key = hashlib.blake2b(prefix.encode('UTF-8'), digest_size=16)
+        key.update('\n'.join('\t'.join(tok) for tok in sen).encode('UTF-8'))
+        return key.digest()
+
+    def get(self, key):
+        """ The processed sentence (a new copy) or None """
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+                self._counters['hits'] += 1
+            elif self._db is not None:
+                row = self._db.execute('SELECT value FROM sentences WHERE key = ?', (key,)).fetchone()
+                if row is not None:
+                    value = row[0]
+                    self._store(key, value)
+                    self._counters['disk_hits'] += 1
+            if value is None:
+                self._counters['misses'] += 1
+                return None
+        return pickle.loads(value)
+
+    def put(self, key, sen):
+        value = pickle.dumps(sen, pickle.HIGHEST_PROTOCOL)
+        with self._lock:
+            self._store(key, value)
+            if self._db is not None:
+                self._db.execute('INSERT OR REPLACE INTO sentences VALUES (?, ?)', (key, value))
+
+    def stats(self):
+        """ The hit (from memory and disk) and miss counters and the size of the memory cache """
+        with self._lock:
+            stats = dict(self._counters)
+            stats['entries'] = len(self._entries)
+            stats['bytes'] = self._bytes
+        lookups = stats['hits'] + stats['disk_hits'] + stats['misses']
+        stats['hit_ratio'] = (stats['hits'] + stats['disk_hits']) / lookups if lookups > 0 else 0.0
+        return stats
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+            if self._db is not None:
+                self._db.execute('DELETE FROM sentences')
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+    def _store(self, key, value):
+        old_value = self._entries.pop(key, None)
+        if old_value is not None:
+            self._bytes -= len(old_value)
+        self._entries[key] = value
+        self._bytes += len(value)
+        while len(self._entries) > self._max_entries or \
+                (self._max_bytes is not None and self._bytes > self._max_bytes and len(self._entries) > 1):
+            _, old_value = self._entries.popitem(last=False)
+            self._bytes -= len(old_value)
+            self._counters['evictions'] += 1
+
+
+def is_cacheable(internal_app):
+    """
+    Only the stateless "Internal modules" can be cached: the output depends only on the input sentence.
+     Modules can opt out explicitly with cacheable = False (modules with sentence_parallel = False are not cached)
+    """
+    return is_sentence_module(internal_app) and getattr(internal_app, 'sentence_parallel', True) and \
+        getattr(internal_app, 'cacheable', True)
@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8, vim: expandtab:ts=4 -*-
+
+"""
+Resumable runs of long files: the input is processed in consecutive chunks of sentences (paragraphs for raw text)
+ and after each chunk the output is flushed to the disk and a checkpoint is saved with the number of the completed
+ input sentences and the size of the flushed output. On restart the output is truncated to the checkpoint and the
+ processing continues with the next chunk, so only the work since the last checkpoint is lost
+"""
+
+import os
+import json
+import logging
+from array import array
+
+from .corpus import MmapCorpus
+from .fastio import encode_lines
+from .toolpool import ToolPool
+
+logger = logging.getLogger('xtsv')
+
+_CHECKPOINT_VERSION = 3
+# The raw text is cut at line boundaries into units of at most this size when there are no blank lines to cut at
+_MAX_PARAGRAPH_BYTES = 1 << 20
+
+
+def run_checkpointed(input_path, output_path, used_tools, available_tools, presets, conll_comments=False,
+                     output_header=True, checkpoint_path=None, checkpoint_interval=10000, resume=True,
+                     singleton_store=None, index_path=None):
+    """
+    Process the input file into the output file with periodic checkpoints (like build_pipeline() and write_output())
+     The same tool instances process every chunk and the final_output() of the finalizers is written only after
+     the last chunk (after a restart it covers only the sentences processed since then)
+    :param input_path: the input file (TSV+header, fixed-order TSV or raw text depending on the first module)
+    :param output_path: the output file
+    :param used_tools, available_tools, presets, conll_comments, output_header, singleton_store: like build_pipeline()
+    :param checkpoint_path: the checkpoint file (default: the output file with .checkpoint suffix)
+    :param checkpoint_interval: the number of input sentences (paragraphs separated by blank lines for raw text,
+     the overlong paragraphs are cut at line boundaries) between the checkpoints
+    :param resume: continue from the checkpoint if there is a valid one (else start from the beginning)
+    :param index_path: the sidecar index of the input (optional, see MmapCorpus, not used for raw text)
+    :return: dict of the number of sentences (paragraphs for raw text) in the input, the completed ones when the run
+     started and the checkpoints
+    """
+    from .pipeline import compile_pipeline, singleton_store_factory  # Circular import...
+
+    if checkpoint_path is None:
+        checkpoint_path = '{0}.checkpoint'.format(output_path)
+    if checkpoint_interval < 1:
+        raise ValueError('checkpoint_interval must be positive!')
+
+    plan = compile_pipeline(used_tools, available_tools, presets)
+    if isinstance(singleton_store, ToolPool):  # The instances are used exclusively until the end of the run
+        tools = singleton_store.checkout_selected(plan.selected_tools)
+        try:
+            return _run_chunks(plan, tools, input_path, output_path, conll_comments, output_header, checkpoint_path,
+                               checkpoint_interval, resume, index_path, used_tools)
+        finally:
+            singleton_store.checkin(tools)
+
+    if singleton_store is None:  # The chunks share the tools
+        singleton_store = singleton_store_factory()
+    tools = plan.init_tools(singleton_store)
+    return _run_chunks(plan, tools, input_path, output_path, conll_comments, output_header, checkpoint_path,
+                       checkpoint_interval, resume, index_path, used_tools)
+
+
+# From here, there are only private methods
+def _run_chunks(plan, tools, input_path, output_path, conll_comments, output_header, checkpoint_path,
+                checkpoint_interval, resume, index_path, used_tools):
+    from .pipeline import output_has_header  # Circular import...
+
+    # The first and the last module determine the format of the input and the output
+    first_app, last_app = tools[plan.programs[0]], tools[plan.programs[-1]]
+    # Tokenisers read raw text, fixed-order TSV importers read input without header
+    raw_input = len(first_app.source_fields) == 0 and not getattr(first_app, 'fixed_order_tsv_input', False)
+    has_header = len(first_app.source_fields) > 0 and not getattr(first_app, 'fixed_order_tsv_input', False)
+    # The header of the output is written only before the first chunk
+    skip_header = output_has_header(last_app, output_header)
+    # The finalizers write their final_output() only after the last chunk
+    held_tools = {program: _HeldFinalOutput(pr) if getattr(pr, 'final_output', None) is not None else pr
+                  for program, pr in tools.items()}
+
+    if raw_input:
+        input_corpus = _RawParagraphs(input_path)
+    else:
+        input_corpus = MmapCorpus(input_path, index_path, conll_comments, has_header=has_header)
+    with input_corpus as corpus:
+        input_id = _input_id(input_path, used_tools, conll_comments, output_header)
+        start, output_offset = 0, 0
+        if resume:
+            start, output_offset = _load_checkpoint(checkpoint_path, input_id, output_path)
+        stats = {'sentences': len(corpus), 'resumed_from': start, 'checkpoints': 0}
+        if start > 0:
+            logger.info('Resuming {0} from sentence {1}'.format(input_path, start))
+
+        with open(output_path, 'r+b' if start > 0 else 'wb') as output_stream:
+            output_stream.truncate(output_offset)  # Drop the output written after the last checkpoint
+            output_stream.seek(output_offset)
+            for chunk_start in range(start, len(corpus), checkpoint_interval):
+                chunk_stop = min(chunk_start + checkpoint_interval, len(corpus))
+                chunk_lines = corpus.lines(chunk_start, chunk_stop)
+                chunk_tools = tools if chunk_stop == len(corpus) else held_tools
+                try:
+                    output = iter(plan.run_with_tools(chunk_lines, chunk_tools, conll_comments, output_header))
+                    if chunk_start > 0 and skip_header:
+                        next(output, None)
+                    for chunk in encode_lines(output):
+                        output_stream.write(chunk)
+                finally:  # Release the input even if the pipeline has failed (the corpus can be closed only then)
+                    chunk_lines.close()
+                output_stream.flush()
+                os.fsync(output_stream.fileno())
+                _save_checkpoint(checkpoint_path, input_id, chunk_stop, output_stream.tell(),
+                                 chunk_stop == len(corpus))
+                stats['checkpoints'] += 1
+                logger.info('Checkpoint: {0} of {1} sentences'.format(chunk_stop, len(corpus)))
+    return stats
+
+
+class _RawParagraphs:
+    """
+    The paragraphs (with the blank lines after them) of a raw text file as the units of the chunks, so the sentences
+     spanning more lines reach the tokeniser in one piece. The paragraphs larger than _MAX_PARAGRAPH_BYTES
+     (e.g. a text without blank lines) are cut at line boundaries to keep the chunks small
+    """
+    def __init__(self, path, encoding='UTF-8'):
+        self.name = path
+        self._encoding = encoding
+        self._file = open(path, 'rb')
+        self._starts = array('Q')
+        pos, unit_start = 0, None
+        has_content, after_blank = False, False
+        for line in self._file:
+            blank = len(line.strip()) == 0
+            if unit_start is None or (not blank and after_blank and has_content) or \
+                    pos - unit_start >= _MAX_PARAGRAPH_BYTES:
+                self._starts.append(pos)
+                unit_start = pos
+                has_content, after_blank = False, False
+            if blank:
+                after_blank = True
+            else:
+                has_content = True
+            pos += len(line)
+        self._size = pos
+
+    def __len__(self):
+        return len(self._starts)
+
+    def lines(self, start, stop):
+        pos = self._starts[start]
+        end = self._starts[stop] if stop < len(self._starts) else self._size
+        self._file.seek(pos)
+        while pos < end:
+            line = self._file.readline()
+            pos += len(line)
+            line = str(line, self._encoding)
+            yield line if line.endswith('\n') else line + '\n'  # No newline at EOF
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class _HeldFinalOutput:
+    """ Proxy of a finalizer for the chunks before the last one: the final_output() is not written yet """
+    final_output = None
+
+    def __init__(self, internal_app):
+        self.wrapped_app = internal_app  # Shares the field bindings of the tool (see bind_fields())
+
+    def __getattr__(self, name):
+        if name == 'wrapped_app':  # Not initialised yet (e.g. copying)
+            raise AttributeError(name)
+        return getattr(self.wrapped_app, name)
+
+
+def _input_id(input_path, used_tools, conll_comments, output_header):
+    """ The checkpoint is valid only for the same (unmodified) input and settings """
+    stat = os.stat(input_path)
+    return {'input': os.path.abspath(input_path), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns,
+            'used_tools': list(used_tools), 'conll_comments': conll_comments, 'output_header': output_header}
+
+
+def _load_checkpoint(checkpoint_path, input_id, output_path):
+    try:
+        with open(checkpoint_path, encoding='UTF-8') as fh:
+            checkpoint = json.load(fh)
+    except FileNotFoundError:
+        return 0, 0
+    except (OSError, ValueError) as e:
+        logger.warning('Invalid checkpoint {0} ({1}), starting from the beginning'.format(checkpoint_path, e))
+        return 0, 0
+    if checkpoint.get('version') != _CHECKPOINT_VERSION or checkpoint.get('input_id') != input_id:
+        logger.warning('The checkpoint {0} belongs to an other input or settings, starting from the beginning'.
+                       format(checkpoint_path))
+        return 0, 0
+    output_offset = checkpoint['output_offset']
+    if not os.path.exists(output_path) or os.path.getsize(output_path) < output_offset:
+        logger.warning('The output {0} is shorter than the checkpoint {1}, starting from the beginning'.
+                       format(output_path, checkpoint_path))
+        return 0, 0
+    return checkpoint['sentences'], output_offset
+
+
+def _save_checkpoint(checkpoint_path, input_id, sentences, output_offset, finished):
+    tmp_path = '{0}.tmp'.format(checkpoint_path)
+    with open(tmp_path, 'w', encoding='UTF-8') as fh:
+        json.dump({'version': _CHECKPOINT_VERSION, 'input_id': input_id, 'sentences': sentences,
+                   'output_offset': output_offset, 'finished': finished}, fh)
+        fh.flush()
+        os.fsync(fh.fileno())
+    os.replace(tmp_path, checkpoint_path)
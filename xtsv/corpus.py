@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8, vim: expandtab:ts=4 -*-
+
+"""
+Random access to large TSV corpora: the file is memory-mapped and the byte offsets of the sentences are indexed
+ (optionally persisted to a sidecar file), so any range of sentences can be fed to build_pipeline() without reading
+ the file sequentially (e.g. for sharding a file across workers or resuming a failed run)
+"""
+
+import os
+import re
+import sys
+import mmap
+import struct
+from array import array
+
+_INDEX_MAGIC = b'XTSVIDX2'
+_INDEX_HEADER = struct.Struct('<8sQQ?QQ')  # magic, file size, mtime (ns), conll_comments, header end, sentences
+_SENTENCE_SEPARATOR = re.compile(b'(?:\r?\n){2,}')  # LF or CRLF line endings
+_BLANK_LINES = re.compile(b'(?:\r?\n)*')
+
+
+class MmapCorpus:
+    """ Memory-mapped TSV file with the index of sentence offsets """
+    def __init__(self, path, index_path=None, conll_comments=False, encoding='UTF-8', has_header=True):
+        """
+        :param path: the TSV file (one token per line and emtpy lines as sentence separator)
+        :param index_path: the sidecar file of the index (loaded if it is up-to-date, built and saved otherwise)
+         e.g. sidecar_index_path(path) (default: the index is built in memory only)
+        :param conll_comments: Allow conll style comments (lines starting with '# ') before sentences
+        :param encoding: the encoding of the file
+        :param has_header: the first line of the file is the header (False for fixed-order TSV)
+        """
+        self.name = path
+        self._encoding = encoding
+        self._conll_comments = conll_comments
+        self._file = open(path, 'rb')
+        stat = os.fstat(self._file.fileno())
+        self._file_id = (stat.st_size, stat.st_mtime_ns)
+        if stat.st_size > 0:
+            self._data = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self._data = b''  # Empty files can not be mapped
+
+        if has_header:
+            header_end = self._data.find(b'\n') + 1
+            if header_end == 0:
+                header_end = len(self._data)
+        else:
+            header_end = 0
+        self.header = _lf_lines(str(self._data[:header_end], encoding))
+
+        if index_path is None or not self._load_index(index_path, header_end):
+            self._build_index(header_end)
+            if index_path is not None:
+                self._save_index(index_path, header_end)
+
+    def __len__(self):
+        """ The number of sentences """
+        return len(self._starts)
+
+    def __iter__(self):
+        return self.lines()
+
+    def sentence_bytes(self, sen_nr):
+        """ The sentence (including the preceding comments, without the separator) as a zero-copy memoryview """
+        return memoryview(self._data)[self._starts[sen_nr]:self._ends[sen_nr]]
+
+    def comment(self, sen_nr):
+        """ The comment lines before the sentence (empty string if there are none) """
+        return _lf_lines(str(self._data[self._starts[sen_nr]:self._token_starts[sen_nr]], self._encoding))
+
+    def lines(self, start=0, stop=None, header=True, chunk_size=1 << 20):
+        """
+        The lines of a range of sentences as input for build_pipeline() or process() (CRLF line endings are
+         converted to LF like in the text mode files)
+        :param start: the first sentence of the range
+        :param stop: the sentence after the last one of the range (default: the end of the corpus)
+        :param header: yield the header as the first line
+        :param chunk_size: the approximate number of bytes decoded at once
+        :return: iterator over the lines
+        """
+        if header and len(self.header) > 0:
+            yield self.header
+        start, stop, _ = slice(start, stop).indices(len(self))
+        data = memoryview(self._data) if len(self._data) > 0 else memoryview(b'')
+        chunk_begin = start
+        try:
+            while chunk_begin < stop:
+                # Decode whole sentences (and the blank lines between them) at once
+                chunk_end = chunk_begin + 1
+                while chunk_end < stop and self._ends[chunk_end - 1] - self._starts[chunk_begin] < chunk_size:
+                    chunk_end += 1
+                chunk_lines = _lf_lines(str(data[self._starts[chunk_begin]:self._ends[chunk_end - 1]],
+                                            self._encoding)).split('\n')
+                last_line = chunk_lines.pop()  # Empty string unless the last sentence is not closed by newline at EOF
+                yield from (line + '\n' for line in chunk_lines)
+                if len(last_line) > 0:
+                    yield last_line + '\n'
+                yield '\n'  # The separator after the last sentence of the chunk
+                chunk_begin = chunk_end
+        finally:  # The map can be closed only if the view is released (e.g. the pipeline stopped by an exception)
+            data.release()
+
+    def shards(self, num_shards):
+        """ Split the corpus into num_shards consecutive (start, stop) sentence ranges of nearly equal size """
+        size, rest = divmod(len(self), num_shards)
+        ranges = []
+        start = 0
+        for i in range(num_shards):
+            stop = start + size + (i < rest)
+            ranges.append((start, stop))
+            start = stop
+        return ranges
+
+    def close(self):
+        if isinstance(self._data, mmap.mmap):
+            self._data.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _build_index(self, header_end):
+        self._starts, self._token_starts, self._ends = array('Q'), array('Q'), array('Q')
+        data = self._data
+        pos = _BLANK_LINES.match(data, header_end).end()  # Blank lines after the header
+        block_start = pos  # A block of comments without sentence is merged with the next sentence
+        for separator in _SENTENCE_SEPARATOR.finditer(data, pos):
+            # The sentence ends with the line break of its last line
+            if self._add_sentence(block_start, pos, data.find(b'\n', separator.start()) + 1):
+                block_start = separator.end()
+            pos = separator.end()
+        if pos < len(data):  # No blank line before EOF
+            self._add_sentence(block_start, pos, len(data))
+
+    def _add_sentence(self, block_start, pos, end):
+        token_start = pos
+        if self._conll_comments:
+            while token_start < end and self._data[token_start:token_start + 2] == b'# ':
+                token_start = self._data.find(b'\n', token_start, end) + 1 or end
+        if token_start == end:
+            return False
+        self._starts.append(block_start)
+        self._token_starts.append(token_start)
+        self._ends.append(end)
+        return True
+
+    def _load_index(self, index_path, header_end):
+        try:
+            with open(index_path, 'rb') as fh:
+                magic, size, mtime, conll_comments, stored_header_end, count = \
+                    _INDEX_HEADER.unpack(fh.read(_INDEX_HEADER.size))
+                if magic != _INDEX_MAGIC or (size, mtime) != self._file_id or \
+                        conll_comments != self._conll_comments or stored_header_end != header_end:
+                    return False
+                arrays = []
+                for _ in range(3):
+                    arr = array('Q')
+                    arr.fromfile(fh, count)
+                    if sys.byteorder != 'little':  # The index is stored in little-endian byte order
+                        arr.byteswap()
+                    arrays.append(arr)
+        except (OSError, EOFError, struct.error):
+            return False
+        self._starts, self._token_starts, self._ends = arrays
+        return True
+
+    def _save_index(self, index_path, header_end):
+        tmp_path = '{0}.tmp'.format(index_path)
+        with open(tmp_path, 'wb') as fh:
+            fh.write(_INDEX_HEADER.pack(_INDEX_MAGIC, self._file_id[0], self._file_id[1], self._conll_comments,
+                                        header_end, len(self._starts)))
+            for arr in (self._starts, self._token_starts, self._ends):
+                if sys.byteorder != 'little':  # The index is stored in little-endian byte order
+                    arr = array('Q', arr)
+                    arr.byteswap()
+                arr.tofile(fh)
+        os.replace(tmp_path, index_path)
+
+
+def sidecar_index_path(path):
+    """ The default name of the index file next to the corpus """
+    return '{0}.xtsvidx'.format(path)
+
+
+# From here, there are only private methods
+def _lf_lines(text):
+    return text.replace('\r\n', '\n')
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8, vim: expandtab:ts=4 -*-
+
+"""
+Byte-level fast path for reading and writing the TSV streams: decode the input in large chunks and split it into lines
+ in bulk, and emit the output in coalesced buffers instead of one (encoded) string per token
+"""
+
+import io
+import codecs
+from itertools import chain
+
+
+class BinaryLineReader:
+    """ Iterate over the lines of a binary stream decoding it in large chunks (universal newlines like text mode) """
+    def __init__(self, binary_stream, encoding='UTF-8', chunk_size=1 << 20, max_line_length=None):
+        """
+        :param binary_stream: any object with read(size) method returning bytes (e.g. file opened in 'rb' mode)
+        :param encoding: the encoding of the stream
+        :param chunk_size: the number of bytes read and decoded at once
+        :param max_line_length: the lines longer than this are yielded in pieces (longer than max_line_length,
+         without newline except the last one) instead of collecting them in the memory (see limit_input())
+        """
+        self.name = getattr(binary_stream, 'name', 'no filename for stream')
+        self._lines = self._read_lines(binary_stream, encoding, chunk_size, max_line_length)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self._lines)
+
+    @staticmethod
+    def _read_lines(binary_stream, encoding, chunk_size, max_line_length):
+        decoder = io.IncrementalNewlineDecoder(codecs.getincrementaldecoder(encoding)(), translate=True)
+        rest = ''
+        while True:
+            chunk = binary_stream.read(chunk_size)
+            text = rest + decoder.decode(chunk, final=len(chunk) == 0)
+            lines = text.split('\n')
+            rest = lines.pop()  # Incomplete last line (or empty string)
+            if len(lines) > 0:
+                yield from (line + '\n' for line in lines)
+            if max_line_length is not None and len(rest) > max_line_length:  # Piece of an overlong line
+                yield rest
+                rest = ''
+            if len(chunk) == 0:
+                break
+        if len(rest) > 0:
+            yield rest
+
+
+def is_binary_stream(stream):
+    """ Binary files and the ones opened in 'rb' mode """
+    return isinstance(stream, (io.BufferedIOBase, io.RawIOBase)) or 'b' in getattr(stream, 'mode', '')
+
+
+def coalesce_lines(lines, buffer_size=1 << 16):
+    """
+    Join the small output strings (header, tokens, sentence separators) into larger chunks
+    :param lines: iterator over the output lines
+    :param buffer_size: the minimal number of characters in a chunk (except the last one)
+    :return: iterator over the chunks
+    """
+    buffer = []
+    buffer_len = 0
+    for line in lines:
+        buffer.append(line)
+        buffer_len += len(line)
+        if buffer_len >= buffer_size:
+            yield ''.join(buffer)
+            buffer = []
+            buffer_len = 0
+    if len(buffer) > 0:
+        yield ''.join(buffer)
+
+
+def encode_lines(lines, encoding='UTF-8', buffer_size=1 << 16):
+    """ Coalesce the output lines (see coalesce_lines()) and encode the chunks at once """
+    for chunk in coalesce_lines(lines, buffer_size):
+        yield chunk.encode(encoding)
+
+
+def write_output(lines, output_stream, encoding='UTF-8', buffer_size=1 << 16):
+    """
+    Write the output lines to a text or binary stream in coalesced chunks (e.g. for the CLI)
+    :param lines: iterator over the output lines (e.g. build_pipeline()) or bytes (e.g. the binary format)
+    :param output_stream: text or binary output stream
+    :param encoding: the encoding used for binary streams
+    :param buffer_size: the minimal number of characters written at once
+    """
+    lines = iter(lines)
+    first_line = next(lines, '')
+    lines = chain([first_line], lines)
+    if isinstance(first_line, bytes):  # Already encoded, written to the binary buffer of text streams (e.g. STDOUT)
+        if not is_binary_stream(output_stream):
+            output_stream.flush()
+            output_stream = output_stream.buffer
+        chunks = lines
+    elif is_binary_stream(output_stream):
+        chunks = encode_lines(lines, encoding, buffer_size)
+    else:
+        chunks = coalesce_lines(lines, buffer_size)
+    for chunk in chunks:
+        output_stream.write(chunk)
+    output_stream.flush()
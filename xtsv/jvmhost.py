@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8, vim: expandtab:ts=4 -*-
+
+"""
+Shared host process for the heavy (e.g. JNI-based) tools: the tools are initialised once in a long-lived server
+ process (one JVM with one copy of the models) listening on a local (Unix) socket, and the pipelines of any number of
+ worker processes use them through RemoteTool proxies sending batches of sentences.
+ RemoteTool can be used as an ordinary entry of available_tools:
+ (('xtsv.jvmhost', 'RemoteTool', 'emDep (shared)', ('/tmp/xtsv-host.sock', 'emdeppy', 'EmDepPy'),
+   {'kwargs': {'source_fields': {'form', 'lemma', 'upostag', 'feats'}, 'target_fields': ['id', 'deprel', 'head']}}),
+  ('dep',))
+ The host is started with start_tool_host() or from the command line: python3 -m xtsv.jvmhost /tmp/xtsv-host.sock
+"""
+
+import os
+import sys
+import logging
+import threading
+import multiprocessing
+from argparse import ArgumentParser
+from multiprocessing.connection import Client, Listener
+
+logger = logging.getLogger('xtsv')
+
+# The optional attributes of the hosted tools which are mirrored by RemoteTool (see process())
+_MIRRORED_ATTRIBUTES = ('pass_header', 'fixed_order_tsv_input', 'add_newline_after_sentence', 'sentence_parallel',
+                        'cacheable', 'batch_tokens')
+
+
+class RemoteTool:
+    """ Proxy of a tool initialised in the tool host with the module interface (for "Internal modules" and such) """
+    releases_gil = True  # Waiting for the host
+    thread_safe = True  # The requests of the threads are serialised on the connection
+
+    def __init__(self, address, module_name, class_name, args=(), kwargs=None, authkey=None, batch_size=64):
+        """
+        :param address: the address of the tool host (the path of the Unix socket)
+        :param module_name, class_name, args, kwargs: the tool initialised in the host (like in available_tools)
+        :param authkey: the authentication key of the host (bytes, optional)
+        :param batch_size: the maximal number of sentences sent to the host at once
+        """
+        self._lock = threading.Lock()
+        self._conn = Client(address, family=_address_family(address), authkey=authkey)
+        self._tool_key = (module_name, class_name, tuple(args), kwargs or {})
+        attributes = self._request('init', self._tool_key)
+        self.source_fields = set(attributes['source_fields'])
+        self.target_fields = list(attributes['target_fields'])
+        for name in _MIRRORED_ATTRIBUTES:
+            if name in attributes:
+                setattr(self, name, attributes[name])
+        if len(self.source_fields) == 0 and not getattr(self, 'fixed_order_tsv_input', False):
+            self.close()
+            raise ValueError('Tokenisers can not be hosted remotely: {0}.{1}'.format(module_name, class_name))
+        self.batch_size = batch_size
+        if attributes['final_output']:  # Only if the hosted tool has it
+            self.final_output = self._final_output
+
+    def prepare_fields(self, field_names):
+        return self._request('prepare_fields', self._tool_key, field_names)
+
+    def process_sentence(self, sen, field_values):
+        return self._request('process_sentences', self._tool_key, [sen], field_values)[0]
+
+    def process_sentences(self, batch, field_values):
+        return self._request('process_sentences', self._tool_key, list(batch), field_values)
+
+    def _final_output(self):
+        return iter(self._request('final_output', self._tool_key))
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def _request(self, *message):
+        with self._lock:
+            self._conn.send(message)
+            status, result = self._conn.recv()
+        if status == 'error':
+            raise result  # The exception of the hosted tool
+        return result
+
+
+class ToolHost:
+    """ The server hosting the tools: one thread per connection, the tools are initialised at their first use """
+    def __init__(self, address, authkey=None, preload=()):
+        """
+        :param address: the address to listen on (the path of the Unix socket, removed if it exists,
+         which is accessible only for the user of the host)
+        :param authkey: the authentication key required from the clients (bytes, optional for Unix sockets,
+         required for TCP addresses as the host unpickles the requests)
+        :param preload: (module_name, class_name, args, kwargs) tuples of the tools to initialise at startup
+        """
+        if _address_family(address) != 'AF_UNIX' and authkey is None:
+            raise ValueError('The tool host requires an authkey when listening on a TCP address: {0}'.format(address))
+        self.address = address
+        self._authkey = authkey
+        self._tools = {}  # repr of the tool key -> (initialised tool, lock)
+        self._init_locks = {}  # repr of the tool key -> the lock of its initialisation
+        self._tools_lock = threading.Lock()  # Guards the dicts above only (not held while a tool is initialised)
+        for tool_key in preload:
+            self._get_tool(tool_key)
+
+    def serve_forever(self, ready=None):
+        """ Accept connections until the process is stopped (ready is an Event set when the host is listening) """
+        family = _address_family(self.address)
+        if family == 'AF_UNIX':
+            if os.path.exists(self.address):
+                os.remove(self.address)  # Stale socket of a previous host
+        listener = Listener(self.address, family=family, authkey=self._authkey)
+        if family == 'AF_UNIX':
+            # Only the user of the host can connect (the umask is process-wide, so it is not changed for binding)
+            os.chmod(self.address, 0o600)
+        with listener:
+            logger.info('Tool host listening on {0}'.format(self.address))
+            if ready is not None:
+                ready.set()
+            while True:
+                try:
+                    conn = listener.accept()
+                except (OSError, EOFError) as e:  # E.g. authentication failed
+                    logger.warning('Tool host: connection refused: {0}'.format(e))
+                    continue
+                threading.Thread(target=self._serve_connection, args=(conn,), daemon=True).start()
+
+    def _serve_connection(self, conn):
+        with conn:
+            while True:
+                try:
+                    command, tool_key, *args = conn.recv()
+                except EOFError:  # The client has closed the connection
+                    return
+                try:
+                    response = ('ok', self._execute(command, tool_key, args))
+                except Exception as e:  # Forwarded to the client
+                    response = ('error', e)
+                try:
+                    conn.send(response)
+                except Exception as e:  # The exception or the result can not be pickled
+                    conn.send(('error', RuntimeError('{0}: {1}'.format(type(e).__name__, e))))
+
+    def _execute(self, command, tool_key, args):
+        internal_app, lock = self._get_tool(tool_key)
+        if command == 'init':
+            attributes = {name: getattr(internal_app, name) for name in _MIRRORED_ATTRIBUTES
+                          if hasattr(internal_app, name)}
+            attributes.update(source_fields=set(internal_app.source_fields),
+                              target_fields=list(internal_app.target_fields),
+                              final_output=getattr(internal_app, 'final_output', None) is not None)
+            return attributes
+        with lock:
+            if command == 'prepare_fields':
+                return internal_app.prepare_fields(*args)
+            if command == 'process_sentences':
+                return _process_batch(internal_app, *args)
+            if command == 'final_output':
+                return list(internal_app.final_output())
+        raise ValueError('Unknown command: {0}'.format(command))
+
+    def _get_tool(self, tool_key):
+        from .pipeline import init_tool  # Circular import...
+
+        module_name, class_name, args, kwargs = tool_key
+        key = repr((module_name, class_name, _canonical(args), _canonical(kwargs)))
+        with self._tools_lock:
+            tool = self._tools.get(key)
+            if tool is not None:
+                return tool
+            init_lock = self._init_locks.setdefault(key, threading.Lock())
+        # A tool is initialised only once, but the slow initialisation (e.g. loading a model into the JVM)
+        #  does not block the requests of the other tools
+        with init_lock:
+            with self._tools_lock:
+                tool = self._tools.get(key)
+            if tool is None:
+                internal_app = init_tool((module_name, class_name, class_name, args, kwargs), (class_name,))
+                # Tools which are not thread-safe are used by one connection at a time
+                lock = threading.Lock() if not getattr(internal_app, 'thread_safe', False) else _NoLock()
+                tool = (internal_app, lock)
+                with self._tools_lock:
+                    self._tools[key] = tool
+        return tool
+
+
+def start_tool_host(address, authkey=None, preload=()):
+    """
+    Start the tool host in a new process (before starting the JVM in the current process)
+    :return: the multiprocessing.Process of the host (terminate() it to stop the host)
+    """
+    ready = multiprocessing.Event()
+    process = multiprocessing.Process(target=_run_host, args=(address, authkey, preload, ready), daemon=True)
+    process.start()
+    while not ready.wait(0.1):
+        if not process.is_alive():
+            raise RuntimeError('The tool host could not be started on {0}!'.format(address))
+    return process
+
+
+# From here, there are only private methods
+class _NoLock:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        return False
+
+
+def _canonical(value):
+    """ The tool parameters independent of the iteration order of the sets and dicts (e.g. source_fields) """
+    if isinstance(value, dict):
+        return tuple(sorted(((key, _canonical(item)) for key, item in value.items()), key=repr))
+    if isinstance(value, (set, frozenset)):
+        return frozenset, tuple(sorted((_canonical(item) for item in value), key=repr))
+    if isinstance(value, (list, tuple)):
+        return tuple(_canonical(item) for item in value)
+    return value
+
+
+def _address_family(address):
+    return 'AF_UNIX' if isinstance(address, str) else 'AF_INET'
+
+
+def _process_batch(internal_app, batch, field_values):
+    process_sentences = getattr(internal_app, 'process_sentences', None)
+    if process_sentences is not None:
+        processed_batch = process_sentences(batch, field_values)
+    else:
+        processed_batch = (internal_app.process_sentence(sen, field_values) for sen in batch)
+    # Lazy outputs (e.g. generators) can not be sent
+    return [sen if isinstance(sen, list) else list(sen) for sen in processed_batch]
+
+
+def _run_host(address, authkey, preload, ready):
+    ToolHost(address, authkey, preload).serve_forever(ready)
+
+
+def main():
+    argparser = ArgumentParser(description='Host the tools of xtsv in one process for many pipelines')
+    argparser.add_argument(dest='address', help='The path of the Unix socket to listen on', metavar='SOCKET')
+    argparser.add_argument('--verbose', action='store_true', help='Log the connections')
+    opts = argparser.parse_args()
+    if opts.verbose:
+        logging.basicConfig(level=logging.INFO, stream=sys.stderr)
+    authkey = os.environ.get('XTSV_HOST_AUTHKEY')
+    ToolHost(opts.address, authkey.encode('UTF-8') if authkey is not None else None).serve_forever()
+
+
+if __name__ == '__main__':
+    main()
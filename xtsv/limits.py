@@ -0,0 +1,302 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8, vim: expandtab:ts=4 -*-
+
+"""
+Limits of the input for handling pathological inputs in bounded memory (e.g. a file without blank lines is one
+ sentence of millions of tokens for sentence_iterator() and one paragraph for the tokeniser). The input lines are
+ checked before they reach the first module: the overlong sentences (paragraphs of raw text) and lines are split,
+ rejected with InputLimitError or spilled to the disk (left out of the processing and saved into a spill file)
+"""
+
+import os
+import logging
+from tempfile import NamedTemporaryFile
+
+from .memusage import rss_below
+from .tsvhandler import InputLimitError
+
+logger = logging.getLogger('xtsv')
+
+LIMIT_STRATEGIES = ('split', 'reject', 'spill')
+
+
+class InputLimits:
+    """ The limits of the input of a pipeline run (None means unlimited) """
+    def __init__(self, max_sentence_tokens=None, max_line_length=None, max_request_bytes=None, strategy='reject',
+                 spill_dir=None, max_rss=None):
+        """
+        :param max_sentence_tokens: the maximal number of tokens in a sentence (words in a paragraph of raw text)
+        :param max_line_length: the maximal number of characters in a line
+        :param max_request_bytes: the maximal size of a REST request (413 is answered for the larger ones)
+        :param strategy: what to do with the sentences over the limits:
+         'split': the sentence is split into sentences of max_sentence_tokens tokens, the overlong lines of raw text
+          are wrapped at whitespace (the overlong TSV lines can not be split, they are rejected)
+         'reject': the input is rejected with InputLimitError
+         'spill': the sentence is left out of the processing and saved into a spill file in spill_dir
+        :param spill_dir: the directory of the spill files (default: the temporary directory of the system)
+        :param max_rss: the resident set size (bytes) over which the REST API rejects the new requests with 503
+        """
+        if strategy not in LIMIT_STRATEGIES:
+            raise ValueError('Unknown limit strategy: {0} (available: {1})'.
+                             format(strategy, ', '.join(LIMIT_STRATEGIES)))
+        for name, value in (('max_sentence_tokens', max_sentence_tokens), ('max_line_length', max_line_length),
+                            ('max_request_bytes', max_request_bytes), ('max_rss', max_rss)):
+            if value is not None and value < 1:
+                raise ValueError('{0} must be positive!'.format(name))
+        self.max_sentence_tokens = max_sentence_tokens
+        self.max_line_length = max_line_length
+        self.max_request_bytes = max_request_bytes
+        self.strategy = strategy
+        self.spill_dir = spill_dir
+        self.max_rss = max_rss
+
+    def __repr__(self):
+        return 'InputLimits(max_sentence_tokens={0}, max_line_length={1}, max_request_bytes={2}, strategy={3!r}, ' \
+               'spill_dir={4!r}, max_rss={5})'.format(self.max_sentence_tokens, self.max_line_length,
+                                                     self.max_request_bytes, self.strategy, self.spill_dir,
+                                                     self.max_rss)
+
+    @property
+    def checks_lines(self):
+        """ The lines must be checked (limit_input() is the identity otherwise) """
+        return self.max_sentence_tokens is not None or self.max_line_length is not None
+
+
+def limit_input(stream, limits, raw_text=False, has_header=True, conll_comments=False):
+    """
+    Enforce the limits on the input lines of a pipeline (the memory used is bounded by the limits, as the lines of
+     a sentence are buffered only with the spill strategy and only up to max_sentence_tokens)
+    :param stream: iterator over the input lines (BinaryLineReader with max_line_length yields the overlong lines
+     in pieces without newline)
+    :param limits: InputLimits (or None for no limits)
+    :param raw_text: the input is raw text for a tokeniser (paragraphs separated by blank lines), TSV otherwise
+    :param has_header: the first line is the header (TSV only)
+    :param conll_comments: Allow conll style comments (lines starting with '# ') before sentences (TSV only)
+    :return: iterator over the lines
+    """
+    if limits is None or not limits.checks_lines:
+        return stream
+    return _LimitedLines(stream, limits, raw_text, has_header, conll_comments)
+
+
+def check_admission(limits, content_length=None, metrics=None):
+    """
+    Check a REST request against the limits before processing it: the size of the request and the memory usage
+     of the service (the new requests are rejected instead of getting the service OOM-killed)
+    :param limits: InputLimits (or None for no limits)
+    :param content_length: the size of the request in bytes (None if unknown, e.g. chunked)
+    :param metrics: PipelineMetrics to count the rejected requests by reason
+    :return: None if the request is admitted, else the (HTTP status, error message) pair
+    """
+    if limits is None:
+        return None
+    if limits.max_request_bytes is not None and content_length is not None and \
+            content_length > limits.max_request_bytes:
+        reason, status, message = 'request_size', 413, 'ERROR: the request is larger than {0} bytes!'.\
+            format(limits.max_request_bytes)
+    elif limits.max_rss is not None and not rss_below(limits.max_rss):
+        reason, status, message = 'memory', 503, 'ERROR: the service is out of memory, try again later!'
+    else:
+        return None
+    logger.warning('Request rejected: {0}'.format(message))
+    if metrics is not None:
+        metrics.reject(reason)
+    return status, message
+
+
+# From here, there are only private methods
+class _LimitedLines:
+    def __init__(self, stream, limits, raw_text, has_header, conll_comments):
+        self.name = getattr(stream, 'name', 'no filename for stream')
+        self._limits = limits
+        self._spill_file = None
+        self._spill_header = None
+        self._line_number = 0  # The number of the current line (the pieces of an overlong line share it)
+        self._at_line_start = True
+        if raw_text:
+            lines = self._raw_text_lines(iter(stream))
+        else:
+            lines = self._tsv_lines(iter(stream), has_header, conll_comments)
+        self._lines = self._closing_spill_file(lines)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self._lines)
+
+    def _closing_spill_file(self, lines):
+        try:
+            yield from lines
+        finally:  # Also when the pipeline stops early
+            if self._spill_file is not None:
+                self._spill_file.close()
+                self._spill_file = None
+
+    def _tsv_lines(self, stream, has_header, conll_comments):
+        max_tokens = self._limits.max_sentence_tokens
+        max_line_length = self._limits.max_line_length
+        strategy = self._limits.strategy
+        if has_header:
+            header = next(stream, None)
+            if header is None:
+                return
+            self._count_line(header)
+            self._spill_header = header  # The spill file is TSV with the same header
+            yield header
+
+        sen_lines = []  # The buffered lines of the current sentence (spill strategy only)
+        token_count = 0
+        spilling = False  # The rest of the current sentence goes to the spill file
+        for line in stream:
+            self._count_line(line)
+            if len(line.rstrip('\n')) == 0:  # End of sentence
+                if spilling:
+                    self._spill([line])
+                else:
+                    yield from sen_lines
+                    yield line
+                sen_lines, token_count, spilling = [], 0, False
+                continue
+            if spilling:
+                self._spill([line])
+                continue
+            if token_count == 0 and conll_comments and line.startswith('# '):
+                if strategy == 'spill':
+                    sen_lines.append(line)
+                else:
+                    yield line
+                continue
+
+            token_count += 1
+            over_line_limit = max_line_length is not None and len(line.rstrip('\n')) > max_line_length
+            over_token_limit = max_tokens is not None and token_count > max_tokens
+            if over_line_limit or over_token_limit:
+                reason = self._reason(over_line_limit)
+                if strategy == 'split' and not over_line_limit:
+                    self._warn('split', reason)
+                    yield '\n'  # The rest of the tokens form a new sentence
+                    token_count = 1
+                elif strategy == 'spill':
+                    self._warn('spilled', reason)
+                    self._spill(sen_lines + [line])
+                    sen_lines, spilling = [], True
+                    continue
+                else:
+                    self._reject(reason)
+            if strategy == 'spill':
+                sen_lines.append(line)
+            else:
+                yield line
+        if spilling:
+            self._spill(['\n'])
+        else:
+            yield from sen_lines
+
+    def _raw_text_lines(self, stream):
+        max_words = self._limits.max_sentence_tokens
+        max_line_length = self._limits.max_line_length
+        strategy = self._limits.strategy
+
+        par_lines = []  # The buffered lines of the current paragraph (spill strategy only)
+        word_count = 0
+        spilling = False  # The rest of the current paragraph goes to the spill file
+        rest = ''  # The unfinished piece of an overlong line when it is wrapped
+        for line in stream:
+            self._count_line(line)
+            if len(line.strip()) == 0 and len(rest) == 0:  # End of paragraph
+                if spilling:
+                    self._spill([line])
+                else:
+                    yield from par_lines
+                    yield line
+                par_lines, word_count, spilling = [], 0, False
+                continue
+            if spilling:
+                self._spill([line])
+                continue
+
+            pieces = [line]
+            if max_line_length is not None and (len(line.rstrip('\n')) > max_line_length or len(rest) > 0):
+                if strategy == 'split':
+                    self._warn('wrapped', self._reason(True))
+                    pieces, rest = _wrap_line(rest + line, max_line_length)
+                elif strategy == 'spill':
+                    self._warn('spilled', self._reason(True))
+                    self._spill(par_lines + [line])
+                    par_lines, spilling = [], True
+                    continue
+                else:
+                    self._reject(self._reason(True))
+
+            for piece in pieces:
+                word_count += len(piece.split())
+                if max_words is not None and word_count > max_words:
+                    if strategy == 'split':
+                        self._warn('split', self._reason(False))
+                        yield '\n'  # The rest of the lines form a new paragraph
+                        word_count = len(piece.split())
+                    elif strategy == 'spill':
+                        self._warn('spilled', self._reason(False))
+                        self._spill(par_lines + [piece])
+                        par_lines, spilling = [], True
+                        break
+                    else:
+                        self._reject(self._reason(False))
+                if strategy == 'spill':
+                    par_lines.append(piece)
+                else:
+                    yield piece
+        if len(rest) > 0:
+            yield '{0}\n'.format(rest)
+        if spilling:
+            self._spill(['\n'])
+        else:
+            yield from par_lines
+
+    def _reason(self, over_line_limit):
+        if over_line_limit:
+            return 'the line is longer than {0} characters'.format(self._limits.max_line_length)
+        return 'the sentence has more than {0} tokens'.format(self._limits.max_sentence_tokens)
+
+    def _count_line(self, line):
+        if self._at_line_start:
+            self._line_number += 1
+        self._at_line_start = line.endswith('\n')
+
+    def _location(self):
+        return '"{0}" at {1}'.format(self.name, self._line_number)
+
+    def _warn(self, action, reason):
+        logger.warning('In {0}: {1}, {2}!'.format(self._location(), reason, action))
+
+    def _reject(self, reason):
+        raise InputLimitError('In {0}: {1}! (See InputLimits for the limits and the other strategies.)'.
+                              format(self._location(), reason))
+
+    def _spill(self, lines):
+        if self._spill_file is None:
+            spill_dir = self._limits.spill_dir
+            if spill_dir is not None:
+                os.makedirs(spill_dir, exist_ok=True)
+            self._spill_file = NamedTemporaryFile('w', encoding='UTF-8', dir=spill_dir, prefix='xtsv-spill-',
+                                                  suffix='.txt', delete=False)
+            logger.warning('The sentences over the limits are spilled to {0}'.format(self._spill_file.name))
+            if self._spill_header is not None:
+                self._spill_file.write(self._spill_header)
+        self._spill_file.writelines(lines)
+
+
+def _wrap_line(text, max_line_length):
+    """ Split the text at whitespace into lines of at most max_line_length characters (the unfinished rest too) """
+    pieces = []
+    while len(text.rstrip('\n')) > max_line_length:
+        cut = max(text.rfind(' ', 1, max_line_length + 1), text.rfind('\t', 1, max_line_length + 1))
+        if cut <= 0:  # No whitespace: hard wrap
+            cut = max_line_length
+        pieces.append('{0}\n'.format(text[:cut]))
+        text = text[cut:].lstrip(' \t')
+    if text.endswith('\n'):
+        pieces.append(text)
+        text = ''
+    return pieces, text
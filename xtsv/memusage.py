@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8, vim: expandtab:ts=4 -*-
+
+"""
+Memory usage of the current process (best effort without external dependencies)
+"""
+
+import gc
+import os
+import sys
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+def current_rss():
+    """ The resident set size of the current process in bytes (the peak RSS where the current is not available) """
+    rss = _statm_rss()
+    if rss is None:
+        return _max_rss()
+    return rss
+
+
+def rss_below(limit):
+    """
+    The resident set size of the current process is below the limit (in bytes). If it is not, the garbage is
+     collected and checked again. Where only the peak RSS is available, it never goes below the limit again!
+    """
+    if current_rss() < limit:
+        return True
+    gc.collect()
+    return current_rss() < limit
+
+
+def peak_rss():
+    """
+    The peak resident set size of the current process in bytes (0 if not available). It is never below the current
+     RSS: ru_maxrss comes from another counter of the kernel, which may lag behind the current RSS
+    """
+    return max(_max_rss(), _statm_rss() or 0)
+
+
+# From here, there are only private methods
+def _statm_rss():
+    """ The current RSS from /proc (None if not available) """
+    try:
+        with open('/proc/self/statm') as fh:
+            return int(fh.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError, AttributeError):
+        return None
+
+
+def _max_rss():
+    if resource is None:
+        return 0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform != 'darwin':  # Linux reports kilobytes, macOS bytes
+        peak *= 1024
+    return peak
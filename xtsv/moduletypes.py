@@ -0,0 +1,23 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8, vim: expandtab:ts=4 -*-
+
+"""
+The kinds of the modules by their declared attributes: the processing, the parallel modes, the result cache
+ and the optimiser decide by these predicates which modules they can handle
+"""
+
+
+def is_internal_module(internal_app):
+    """ "Internal modules" read TSV with header (not raw text like tokenisers or fixed-order TSV) """
+    return len(internal_app.source_fields) > 0 and not getattr(internal_app, 'fixed_order_tsv_input', False)
+
+
+def is_sentence_module(internal_app):
+    """ The output of the "Internal module" depends only on the sentences (no summary with final_output()) """
+    return is_internal_module(internal_app) and getattr(internal_app, 'final_output', None) is None
+
+
+def has_plain_output(internal_app):
+    """ The output of the "Internal module" is TSV+header without any additional free-format text """
+    return is_sentence_module(internal_app) and getattr(internal_app, 'pass_header', True) and \
+        getattr(internal_app, 'add_newline_after_sentence', True)
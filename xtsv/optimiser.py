@@ -0,0 +1,359 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8, vim: expandtab:ts=4 -*-
+
+"""
+Dependency-aware optimisation of the tool chain by the declared source_fields and target_fields of the modules:
+ the modules are ordered by their dependencies (keeping the requested order where it is feasible), the modules whose
+ target fields are not needed for the desired output fields are pruned, and the consecutive independent modules
+ (e.g. two taggers depending only on the tokens) form branches which process the same sentences concurrently
+ (see ConcurrentBranches). Only the "Internal modules" after the tokeniser (or the input) are optimised,
+ the finalizers and the modules with free-format output stay at the end of the chain.
+ Already annotated input can be re-annotated incrementally (see plan_reannotation()): only the modules whose columns
+ are missing or invalidated are run and only their columns are overwritten
+"""
+
+import os
+import atexit
+import logging
+import threading
+import concurrent.futures
+
+from .tsvhandler import SentenceStream, sentence_iterator
+from .moduletypes import has_plain_output
+
+logger = logging.getLogger('xtsv')
+
+_branch_executor = None  # The threads of the concurrent branches shared by the pipelines (see ConcurrentBranches)
+_branch_executor_lock = threading.Lock()
+
+
+def analyse_pipeline(pipeline, input_fields=(), output_fields=None):
+    """
+    Analyse the dependencies of the modules
+    :param pipeline: the list of (program name, initialised tool) pairs in the requested order
+    :param input_fields: the fields of the input header (not used if the first module reads raw text or
+     fixed-order TSV)
+    :param output_fields: the desired output fields (None: every field is needed, nothing is pruned)
+    :return: dict of 'order': the programs kept in the order of processing, 'pruned': the programs not needed for
+     the output fields, 'branches': the lists of consecutive programs (in 'order') independent of each other,
+     'modules': the 'consumers' (the later programs using its target fields) and the 'unconsumed_fields' (neither
+     used by the later programs nor desired) by program
+    """
+    head, body, tail = _split_pipeline(pipeline)
+    if len(head) > 0:
+        available_fields = set(head[0][1].target_fields)
+    else:
+        available_fields = set(input_fields)
+
+    if output_fields is not None:
+        producible = available_fields.union(*(pr.target_fields for _, pr in body + tail))
+        missing = [field for field in output_fields if field not in producible]
+        if len(missing) > 0:
+            from .pipeline import ModuleError  # Circular import...
+            raise ModuleError('ERROR: the desired output fields {0} are not produced by the pipeline ({1})!'.
+                              format(missing, ', '.join(program for program, _ in pipeline)))
+
+    order = _dependency_order(body)
+    kept = _needed_modules(body, order, tail, output_fields)
+    kept_body = [body[i] for i in order if i in kept]
+    pruned = [program for i, (program, _) in enumerate(body) if i not in kept]
+
+    modules = {}
+    kept_chain = head + kept_body + tail
+    for i, (program, pr) in enumerate(kept_chain):
+        consumers = [later_program for later_program, later_pr in kept_chain[i + 1:]
+                     if later_pr.source_fields & set(pr.target_fields)]
+        consumed = set().union(*(later_pr.source_fields for _, later_pr in kept_chain[i + 1:]))
+        unconsumed_fields = []
+        if output_fields is not None:
+            unconsumed_fields = [field for field in pr.target_fields
+                                 if field not in consumed and field not in output_fields]
+        modules[program] = {'consumers': consumers, 'unconsumed_fields': unconsumed_fields}
+    for program, pr in body:
+        if program in pruned:
+            modules[program] = {'consumers': [], 'unconsumed_fields': list(pr.target_fields)}
+
+    return {'order': [program for program, _ in kept_chain], 'pruned': pruned,
+            'branches': [[program for program, _ in branch] for branch in _independent_branches(kept_body)
+                         if len(branch) > 1],
+            'modules': modules}
+
+
+def optimise_pipeline(pipeline, input_fields=(), output_fields=None):
+    """
+    Reorder and prune the modules (see analyse_pipeline())
+    :return: the optimised list of (program name, initialised tool) pairs and the analysis
+    """
+    analysis = analyse_pipeline(pipeline, input_fields, output_fields)
+    tools = dict(pipeline)
+    if len(analysis['pruned']) > 0:
+        logger.info('Modules not needed for the output fields {0}: {1}'.
+                    format(output_fields, ', '.join(analysis['pruned'])))
+    return [(program, tools[program]) for program in analysis['order']], analysis
+
+
+def group_branches(pipeline, branches):
+    """
+    Replace the independent branches (see analyse_pipeline()) by ConcurrentBranches in the pipeline
+    :param pipeline: the list of (program name, tool) pairs in the order of the analysis
+    :param branches: the lists of consecutive programs to group
+    :return: the list of (program name, tool) pairs (the name of a group is the names of its programs joined by '+')
+    """
+    first_programs = {branch[0]: branch for branch in branches}
+    tools = dict(pipeline)
+    grouped = []
+    i = 0
+    while i < len(pipeline):
+        program, pr = pipeline[i]
+        branch = first_programs.get(program)
+        if branch is not None:
+            grouped.append(('+'.join(branch), ConcurrentBranches([tools[name] for name in branch])))
+            i += len(branch)
+        else:
+            grouped.append((program, pr))
+            i += 1
+    return grouped
+
+
+def plan_reannotation(pipeline, input_fields, recompute=()):
+    """
+    Select the modules to run on already annotated input (incremental re-annotation): the "Internal modules" whose
+     target fields are all in the input are skipped, unless they are invalidated explicitly (by program name or by
+     any of their target fields in recompute) or they use the fields recomputed by an earlier module (transitively)
+    :param pipeline: the list of (program name, initialised tool) pairs in the requested order
+    :param input_fields: the fields of the input header
+    :param recompute: the programs or fields to recompute even if their columns are in the input
+    :return: the list of (program name, tool) pairs to run, the skipped programs and the input fields to overwrite
+     (their columns are dropped from the input with drop_columns() and computed again)
+    """
+    known = {program for program, _ in pipeline}.union(*(pr.target_fields for _, pr in pipeline))
+    unknown = [name for name in recompute if name not in known]
+    if len(unknown) > 0:
+        raise ValueError('Neither programs nor target fields of the pipeline: {0}'.format(', '.join(unknown)))
+
+    head, body, tail = _split_pipeline(pipeline)
+    if len(head) > 0:  # Raw text or fixed-order TSV: nothing is annotated yet
+        return pipeline, [], []
+    available_fields = set(input_fields)
+    recompute = set(recompute)
+    recomputed_fields = set()
+    run, skipped = [], []
+    for program, pr in body:
+        target_fields = set(pr.target_fields)
+        if program in recompute or not target_fields.isdisjoint(recompute) or \
+                not target_fields.issubset(available_fields) or not pr.source_fields.isdisjoint(recomputed_fields):
+            run.append((program, pr))
+            recomputed_fields |= target_fields
+        else:
+            skipped.append(program)
+    if len(skipped) > 0:
+        logger.info('Modules with up-to-date columns in the input: {0}'.format(', '.join(skipped)))
+    # The finalizers (and such) read the fields by name, they are always run
+    return run + tail, skipped, [field for field in input_fields if field in recomputed_fields]
+
+
+def drop_columns(stream, dropped_fields, conll_comments=False, output_header=True):
+    """
+    Drop the columns of the given fields from the input (TSV+header)
+    :param stream: iterator over the lines or SentenceStream
+    :param output_header: keep the (reduced) header line
+    :return: SentenceStream of the rest of the columns
+    """
+    track_stream = {'file_name': getattr(stream, 'name', 'no filename for stream'), 'curr_line_number': 1}
+    fields = next(stream).rstrip('\n').split('\t')
+    kept = [i for i, field in enumerate(fields) if field not in dropped_fields]
+    header = '{0}\n'.format('\t'.join(fields[i] for i in kept)) if output_header else None
+    return SentenceStream(header, _projected_sentences(sentence_iterator(stream, conll_comments, track_stream), kept,
+                                                       track_stream), track_stream['file_name'])
+
+
+def restore_columns(stream, pipeline, input_fields, original_fields, has_header=True, conll_comments=False):
+    """
+    Restore the order of the columns in the output of the incremental re-annotation: the overwritten columns return
+     to their places in the original input and the new columns follow them in the order of the output (the output
+     is returned unchanged if it is not TSV+header)
+    :param stream: the output (iterator over the lines or SentenceStream)
+    :param pipeline: the list of (program name, tool) pairs run on the input
+    :param input_fields: the fields of the input of the pipeline (without the dropped columns)
+    :param original_fields: the fields of the original input
+    :param has_header: the output starts with the header line
+    :return: SentenceStream (or the unchanged output)
+    """
+    if len(pipeline) == 0 or not has_plain_output(pipeline[-1][1]):
+        return stream
+    output_fields = list(input_fields) + [field for _, pr in pipeline for field in pr.target_fields]
+    positions = {field: i for i, field in enumerate(output_fields)}  # The last one wins like in process_header()
+    order = [positions[field] for field in original_fields if field in positions]
+    order.extend(i for i in range(len(output_fields)) if i not in set(order))
+
+    track_stream = {'file_name': getattr(stream, 'name', 'no filename for stream'), 'curr_line_number': 0}
+    header = None
+    if has_header:
+        next(stream, None)
+        track_stream['curr_line_number'] += 1
+        header = '{0}\n'.format('\t'.join(output_fields[i] for i in order))
+    return SentenceStream(header, _projected_sentences(sentence_iterator(stream, conll_comments, track_stream), order,
+                                                       track_stream), track_stream['file_name'])
+
+
+class ConcurrentBranches:
+    """
+    Independent "Internal modules" (none of them uses the target fields of the others) as one module: every member
+     processes its own copy of the same batch of sentences in its own thread and the new columns are merged in the
+     order of the members, so the output is the same as processing the sentences by the members one after the other.
+     The members run in parallel only if they release the GIL (see releases_gil)
+    """
+    pass_header = True
+    cacheable = False  # The members are not cached one by one
+
+    def __init__(self, members):
+        self.members = list(members)
+        self.source_fields = set().union(*(member.source_fields for member in self.members))
+        self.target_fields = [field for member in self.members for field in member.target_fields]
+        self.batch_size = min(getattr(member, 'batch_size', 64) for member in self.members)
+        self.sentence_parallel = all(getattr(member, 'sentence_parallel', True) for member in self.members)
+
+    def prepare_fields(self, field_names):
+        # The fields of the input without the target fields of the members
+        input_width = sum(1 for key in field_names if isinstance(key, int)) - len(self.target_fields)
+        input_fields = [field_names[i] for i in range(input_width)]
+        # Every member is bound to the input fields with its own target fields (as if it was alone)
+        return input_width, [member.prepare_fields(_field_names(input_fields + list(member.target_fields)))
+                             for member in self.members]
+
+    def process_sentence(self, sen, field_values):
+        return self.process_sentences([sen], field_values)[0]
+
+    def process_sentences(self, batch, field_values):
+        input_width, field_values = field_values
+        batch = list(batch)
+        # The copies are made before any member modifies the tokens
+        member_batches = [batch] + [[[list(tok) for tok in sen] for sen in batch] for _ in self.members[1:]]
+        executor = _get_branch_executor()
+        futures = [executor.submit(_process_member_batch, member, member_batch, member_field_values)
+                   for member, member_batch, member_field_values in zip(self.members[1:], member_batches[1:],
+                                                                        field_values[1:])]
+        merged = _process_member_batch(self.members[0], member_batches[0], field_values[0])
+        for future in futures:
+            processed_batch = future.result()
+            if len(processed_batch) != len(merged):
+                raise ValueError('The members of the concurrent branches returned different number of sentences!')
+            for merged_sen, sen in zip(merged, processed_batch):
+                if len(merged_sen) != len(sen):
+                    raise ValueError('The members of the concurrent branches returned different number of tokens!')
+                for merged_tok, tok in zip(merged_sen, sen):
+                    merged_tok.extend(tok[input_width:])
+        return merged
+
+
+# From here, there are only private methods
+def _split_pipeline(pipeline):
+    """ The first module reading raw text or fixed-order TSV, the optimised body and the rest of the chain """
+    head = []
+    if len(pipeline) > 0 and (len(pipeline[0][1].source_fields) == 0 or
+                              getattr(pipeline[0][1], 'fixed_order_tsv_input', False)):
+        head = pipeline[:1]
+    end = len(head)
+    while end < len(pipeline) and has_plain_output(pipeline[end][1]):
+        end += 1
+    return head, pipeline[len(head):end], pipeline[end:]
+
+
+def _dependency_order(body):
+    """ Topological order of the indices of the modules (the requested order is kept where it is feasible) """
+    dependencies = [set() for _ in body]
+    for i, (_, pr) in enumerate(body):
+        for field in pr.source_fields:
+            producers = [j for j, (_, other) in enumerate(body) if j != i and field in other.target_fields]
+            earlier_producers = [j for j in producers if j < i]
+            if len(earlier_producers) > 0:  # The last one before the module as in the requested order
+                dependencies[i].add(earlier_producers[-1])
+            elif len(producers) > 0:
+                dependencies[i].add(producers[0])
+        # The modules producing the same fields keep their order (the last one overrides the others)
+        dependencies[i].update(j for j, (_, other) in enumerate(body[:i])
+                               if set(other.target_fields) & set(pr.target_fields))
+
+    order = []
+    remaining = set(range(len(body)))
+    while len(remaining) > 0:
+        ready = [i for i in remaining if dependencies[i].isdisjoint(remaining)]
+        if len(ready) == 0:  # Circular dependency: the feasibility check reports it
+            return list(range(len(body)))
+        order.append(min(ready))
+        remaining.remove(order[-1])
+    return order
+
+
+def _needed_modules(body, order, tail, output_fields):
+    """ The indices of the modules needed for the output fields and the rest of the chain (backwards) """
+    if output_fields is None:
+        return set(order)
+    needed_fields = set(output_fields).union(*(pr.source_fields for _, pr in tail))
+    needed = set()
+    for i in reversed(order):
+        _, pr = body[i]
+        if not needed_fields.isdisjoint(pr.target_fields):
+            needed.add(i)
+            # The fields of the module are not needed from the earlier ones (they would be overridden)
+            needed_fields = (needed_fields - set(pr.target_fields)) | pr.source_fields
+    return needed
+
+
+def _independent_branches(body):
+    """ Split the modules into runs of consecutive modules which do not depend on each other """
+    branches = []
+    for program, pr in body:
+        if len(branches) > 0 and all(pr.source_fields.isdisjoint(other.target_fields) and
+                                     other.source_fields.isdisjoint(pr.target_fields) and
+                                     set(pr.target_fields).isdisjoint(other.target_fields)
+                                     for _, other in branches[-1]):
+            branches[-1].append((program, pr))
+        else:
+            branches.append([(program, pr)])
+    return branches
+
+
+def _field_names(fields):
+    """ Both ways like process_header() """
+    field_names = {name: i for i, name in enumerate(fields)}
+    field_names.update({i: name for i, name in enumerate(fields)})
+    return field_names
+
+
+def _projected_sentences(sentences, indices, track_stream):
+    """ The sentences with the columns of the given indices """
+    for sen, comment in sentences:
+        try:
+            yield [[tok[i] for i in indices] for tok in sen], comment
+        except IndexError:
+            raise ValueError('In "{0}" at {1}: the sentence has fewer columns than the header!'.
+                             format(track_stream['file_name'], track_stream['curr_line_number']))
+
+
+def _process_member_batch(member, batch, field_values):
+    process_sentences = getattr(member, 'process_sentences', None)
+    if process_sentences is not None:
+        processed_batch = process_sentences(batch, field_values)
+    else:
+        processed_batch = (member.process_sentence(sen, field_values) for sen in batch)
+    # Lazy outputs (e.g. generators) are materialised for merging
+    return [[tok if isinstance(tok, list) else list(tok) for tok in sen] for sen in processed_batch]
+
+
+def _get_branch_executor():
+    global _branch_executor
+    with _branch_executor_lock:
+        if _branch_executor is None:
+            _branch_executor = concurrent.futures.ThreadPoolExecutor(os.cpu_count() or 1,
+                                                                     thread_name_prefix='xtsv-branch')
+            atexit.register(_shutdown_branch_executor)
+        return _branch_executor
+
+
+def _shutdown_branch_executor():
+    global _branch_executor
+    with _branch_executor_lock:
+        if _branch_executor is not None:
+            _branch_executor.shutdown(wait=False)
+            _branch_executor = None
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8, vim: expandtab:ts=4 -*-
+
+"""
+The options of a pipeline run (the execution mode, the formats, the limits, the reordering of the modules, etc.)
+ grouped into one object, which can be passed to build_pipeline() or PipelinePlan.run() as options
+ or given as keyword arguments
+"""
+
+INPUT_FORMATS = ('tsv', 'binary')
+OUTPUT_FORMATS = ('tsv', 'binary', 'binary-zlib')
+
+
+class PipelineOptions:
+    """ The options of a pipeline run (the default options run the modules sequentially in the current process) """
+    def __init__(self, num_workers=1, parallel_batch_size=1000, pipelined=False, stage_workers='auto', queue_size=8,
+                 stage_monitor=None, result_cache=None, profile=None, input_format='tsv', output_format='tsv',
+                 input_limits=None, output_fields=None, concurrent_branches=False, incremental=False, recompute=(),
+                 cancel=None):
+        """
+        :param num_workers: Process the sentences in parallel with this many worker processes when greater than one
+         (each worker initialises its own copy of the tools, see parallel.py)
+        :param parallel_batch_size: The number of sentences sent to a worker at once in parallel mode
+         (the number of lines in a batch between the stages in pipelined mode)
+        :param pipelined: Run each module in its own worker connected by bounded queues (see parallel.py)
+        :param stage_workers: The type of the workers in pipelined mode: 'thread', 'process' or 'auto'
+        :param queue_size: The maximal number of batches waiting between two stages in pipelined mode
+        :param stage_monitor: StageMonitor instance to observe the queue depths between the stages in pipelined mode
+        :param result_cache: ResultCache to reuse the output of the modules for the already processed sentences
+         (used in the sequential mode only, see cache.py)
+        :param profile: PipelineProfile to record the time, throughput and memory usage of the modules
+         running in the current process (see profiling.py)
+        :param input_format: 'tsv' or 'binary' (binary stream or bytes in the binary format, see binformat.py)
+        :param output_format: 'tsv', 'binary' or 'binary-zlib' (the binary format with compressed blocks)
+        :param input_limits: InputLimits to split, reject (InputLimitError) or spill the overlong sentences and lines
+         of the input before they reach the first module (see limits.py, the binary input is not checked)
+        :param output_fields: The desired output fields: the modules are ordered by their dependencies and the ones
+         not needed for these fields are left out (see optimiser.py)
+        :param concurrent_branches: The consecutive independent modules process the same sentences concurrently
+         and their columns are merged (in the sequential mode only, see ConcurrentBranches)
+        :param incremental: Re-annotate already annotated TSV input: the modules whose target fields are all in the
+         input header are skipped, the columns of the rerun modules are overwritten in place (see plan_reannotation())
+        :param recompute: The programs or fields to recompute in the incremental mode even if their columns exist
+         (the modules using their fields are recomputed too, a non-empty list implies incremental)
+        :param cancel: CancelToken to stop the processing between two sentences with RequestCancelled when it is
+         cancelled or its deadline has passed (see slo.py, in the other modes the output lines are checked)
+        """
+        if num_workers > 1 and pipelined:
+            raise ValueError('Sentence-parallel (num_workers > 1) and pipelined modes are mutually exclusive!')
+        if input_format not in INPUT_FORMATS or output_format not in OUTPUT_FORMATS:
+            raise ValueError('Unknown input or output format: {0}, {1}'.format(input_format, output_format))
+        self.num_workers = num_workers
+        self.parallel_batch_size = parallel_batch_size
+        self.pipelined = pipelined
+        self.stage_workers = stage_workers
+        self.queue_size = queue_size
+        self.stage_monitor = stage_monitor
+        self.result_cache = result_cache
+        self.profile = profile
+        self.input_format = input_format
+        self.output_format = output_format
+        self.input_limits = input_limits
+        self.output_fields = output_fields
+        self.concurrent_branches = concurrent_branches
+        self.incremental = incremental
+        self.recompute = recompute
+        self.cancel = cancel
+
+    def __repr__(self):
+        return 'PipelineOptions({0})'.format(', '.join('{0}={1!r}'.format(name, value)
+                                                       for name, value in vars(self).items()))
+
+    def replace(self, **kwargs):
+        """ A copy of the options with the given ones changed (e.g. a new profile or cancel for every request) """
+        options = dict(vars(self))
+        options.update(kwargs)
+        return PipelineOptions(**options)
+
+    @classmethod
+    def of(cls, options=None, **kwargs):
+        """ The options of a run given as PipelineOptions (or None) and as keyword arguments overriding them """
+        if options is None:
+            return cls(**kwargs)
+        if len(kwargs) > 0:
+            return options.replace(**kwargs)
+        return options
@@ -0,0 +1,312 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8, vim: expandtab:ts=4 -*-
+
+"""
+Parallel execution engines for the pipeline:
+ 1) Sentence-parallel: the sentence stream is split into batches which are processed by a pool of worker processes
+  (each holding its own initialised tools) and merged back in the original order
+ 2) Pipelined: each module runs in its own worker (thread or process) connected by bounded queues of sentence batches,
+  so the modules work concurrently on consecutive parts of the stream
+"""
+
+import queue
+import logging
+import threading
+import multiprocessing
+from itertools import chain
+from collections import deque, OrderedDict
+
+from .tsvhandler import process, process_chain, process_header, sentence_batch_iterator
+from .moduletypes import is_sentence_module
+from .jnius_wrapper import jnius_config
+
+logger = logging.getLogger('xtsv')
+
+# The state of the current worker process set by _init_worker() (the initialised tools and the options)
+_worker_state = None
+
+# The process stages inherit the tools initialised in the main process, which needs the fork start method
+_fork_context = multiprocessing.get_context('fork') if 'fork' in multiprocessing.get_all_start_methods() else None
+
+
+def is_sentence_parallel(internal_app):
+    """
+    Only "Internal modules" (have source fields and header, no summary) can process the sentences independently.
+     Modules can opt out explicitly (e.g. if they keep state between sentences) with sentence_parallel = False
+    """
+    return is_sentence_module(internal_app) and getattr(internal_app, 'sentence_parallel', True)
+
+
+def longest_parallel_segment(pipeline):
+    """ Return the (begin, end) indices of the longest run of sentence-parallel modules in the pipeline """
+    best_begin, best_end = 0, 0
+    begin = 0
+    for i, (_, pr) in enumerate(pipeline):
+        if not is_sentence_parallel(pr):
+            begin = i + 1
+        elif i + 1 - begin > best_end - best_begin:
+            best_begin, best_end = begin, i + 1
+    return best_begin, best_end
+
+
+def parallel_pipeline(inp_stream, pipeline, available_tools, conll_comments=False, output_header=True, num_workers=2,
+                      batch_size=1000):
+    """
+    Run the pipeline with the longest sentence-parallel segment fanned out to a process pool.
+     The modules before and after the segment (e.g. tokenisers and finalizers) are run in the current process.
+    :param inp_stream: Line chunked input stream (with header if the first module requires it)
+    :param pipeline: the list of (program name, initialised tool) pairs in order
+    :param available_tools: the uninitialised tools (the workers initialise their own copies from these)
+    :param conll_comments: Allow conll style comments (lines starting with '# ') before sentences
+    :param output_header: Make header for output or not
+    :param num_workers: the number of worker processes
+    :param batch_size: the number of sentences sent to a worker at once
+    :return: Iterator over the output lines
+    """
+    begin, end = longest_parallel_segment(pipeline)
+    internal_apps = [pr for _, pr in pipeline]
+
+    pipeline_end = inp_stream
+    if begin > 0:
+        pipeline_end = process_chain(pipeline_end, internal_apps[:begin], conll_comments,
+                                     begin != len(internal_apps) or output_header)
+
+    if begin < end:
+        pipeline_end = _process_segment_in_pool(pipeline_end, pipeline[begin:end], available_tools, conll_comments,
+                                                end != len(internal_apps) or output_header, num_workers, batch_size)
+
+    if end < len(internal_apps):
+        pipeline_end = process_chain(pipeline_end, internal_apps[end:], conll_comments, output_header)
+
+    return pipeline_end
+
+
+class StageMonitor:
+    """
+    Observe the queues between the stages of a pipelined run (see pipelined_pipeline()). The queue before a stage
+     filling up means that the stage is the bottleneck, the queue after it being (nearly) empty means it is starving
+    """
+    def __init__(self, interval=None):
+        """
+        :param interval: Log the queue depths with this period (in seconds) while the pipeline is running
+        """
+        self._interval = interval
+        self._stages = []
+        self._stop = threading.Event()
+        self._thread = None
+
+    def register(self, name, worker_type, input_queue):
+        self._stages.append((name, worker_type, input_queue))
+
+    def queue_depths(self):
+        """ The number of batches waiting in the input queue of each stage (by stage name) """
+        depths = OrderedDict()
+        for name, _, input_queue in self._stages:
+            try:
+                depths[name] = input_queue.qsize()
+            except NotImplementedError:  # multiprocessing.Queue.qsize() is not implemented on macOS
+                depths[name] = None
+        return depths
+
+    def worker_types(self):
+        return OrderedDict((name, worker_type) for name, worker_type, _ in self._stages)
+
+    def start(self):
+        if self._interval is not None and self._thread is None:
+            self._thread = threading.Thread(target=self._log_periodically, daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _log_periodically(self):
+        while not self._stop.wait(self._interval):
+            logger.info('queue depths: {0}'.format(', '.join('{0}={1}'.format(name, depth)
+                                                             for name, depth in self.queue_depths().items())))
+
+
+def pipelined_pipeline(inp_stream, pipeline, conll_comments=False, output_header=True, stage_workers='auto',
+                       queue_size=8, batch_size=1000, stage_monitor=None):
+    """
+    Run every module of the pipeline in its own worker connected by bounded queues of sentence batches
+     (the full queue blocks the previous stage: backpressure). Threads are suitable for modules which release the GIL
+     (e.g. JVM-based tools, which must not be forked anyway), processes for the pure Python ones.
+     The process workers are forked and inherit the tools initialised in this process (the models are not loaded again)
+    :param inp_stream: Line chunked input stream (with header if the first module requires it)
+    :param pipeline: the list of (program name, initialised tool) pairs in order
+    :param conll_comments: Allow conll style comments (lines starting with '# ') before sentences
+    :param output_header: Make header for output or not
+    :param stage_workers: 'thread', 'process' or 'auto' (threads for modules declaring releases_gil = True,
+     when the JVM is running or when processes can not be forked, processes otherwise)
+    :param queue_size: the maximal number of batches waiting between two stages
+    :param batch_size: the (approximate) number of lines in a batch (batches are cut at sentence boundaries)
+    :param stage_monitor: StageMonitor instance to observe the queue depths
+    :return: Iterator over the output lines
+    """
+    if stage_workers not in {'auto', 'thread', 'process'}:
+        raise ValueError('stage_workers should be \'auto\', \'thread\' or \'process\' instead of {0}'.
+                         format(stage_workers))
+    if stage_workers == 'process' and _fork_context is None:
+        raise ValueError('stage_workers=\'process\' requires the fork start method, which is not available!')
+    if stage_monitor is None:
+        stage_monitor = StageMonitor()
+    return _run_stages(inp_stream, pipeline, conll_comments, output_header, stage_workers, queue_size, batch_size,
+                       stage_monitor)
+
+
+# From here, there are only private methods
+class _StageError:
+    """ Forwarded through the queues to the consumer to reraise the exception of a stage """
+    def __init__(self, exception):
+        self.exception = exception
+
+
+def _stage_worker_type(pr, stage_workers):
+    if stage_workers != 'auto':
+        return stage_workers
+    if getattr(pr, 'releases_gil', False) or getattr(jnius_config, 'vm_running', False) or _fork_context is None:
+        return 'thread'
+    return 'process'
+
+
+def _run_stages(inp_stream, pipeline, conll_comments, output_header, stage_workers, queue_size, batch_size,
+                stage_monitor):
+    worker_types = [_stage_worker_type(pr, stage_workers) for _, pr in pipeline]
+    if 'process' in worker_types:
+        mp_stop = _fork_context.Event()
+    else:
+        mp_stop = threading.Event()
+    # The queue before the first stage is filled by a thread of this process, the queue after the last is read here
+    queues = []
+    for i in range(len(pipeline) + 1):
+        neighbours = worker_types[max(i - 1, 0):i + 1]
+        if 'process' in neighbours:
+            queues.append(_fork_context.Queue(queue_size))
+        else:
+            queues.append(queue.Queue(queue_size))
+
+    threads = [threading.Thread(target=_feed_stage, args=(inp_stream, queues[0], batch_size, mp_stop), daemon=True)]
+    processes = []
+    last_used_tool_nr = len(pipeline) - 1
+    for i, ((program, pr), worker_type) in enumerate(zip(pipeline, worker_types)):
+        stage_monitor.register(program, worker_type, queues[i])
+        pass_header = i != last_used_tool_nr or output_header
+        # The forked processes get the initialised tool without pickling it (copy-on-write)
+        args = (pr, conll_comments, pass_header, queues[i], queues[i + 1], batch_size, mp_stop)
+        if worker_type == 'thread':
+            threads.append(threading.Thread(target=_stage_worker, args=args, daemon=True))
+        else:
+            processes.append(_fork_context.Process(target=_stage_worker, args=args, daemon=True))
+
+    workers = processes + threads  # Fork before starting the threads of this run
+    for worker in workers:
+        worker.start()
+    stage_monitor.start()
+    try:
+        for batch in _iter_queue(queues[-1], mp_stop):
+            yield from batch
+    finally:
+        stage_monitor.stop()
+        mp_stop.set()
+        for worker in workers:
+            worker.join(1)
+            if worker in processes and worker.is_alive():
+                worker.terminate()
+
+
+def _line_batches(lines, batch_size):
+    """ Cut the stream of lines into batches at sentence boundaries """
+    batch = []
+    for line in lines:
+        batch.append(line)
+        if len(batch) >= batch_size and line == '\n':
+            yield batch
+            batch = []
+    if len(batch) > 0:
+        yield batch
+
+
+def _put(out_queue, item, stop):
+    while not stop.is_set():
+        try:
+            out_queue.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+def _iter_queue(in_queue, stop):
+    while not stop.is_set():
+        try:
+            item = in_queue.get(timeout=0.1)
+        except queue.Empty:
+            continue
+        if item is None:  # End of stream
+            return
+        if isinstance(item, _StageError):
+            raise item.exception
+        yield item
+
+
+def _feed_stage(inp_stream, out_queue, batch_size, stop):
+    try:
+        for batch in _line_batches(inp_stream, batch_size):
+            if not _put(out_queue, batch, stop):
+                return
+        _put(out_queue, None, stop)
+    except Exception as e:
+        _put(out_queue, _StageError(e), stop)
+
+
+def _stage_worker(pr, conll_comments, pass_header, in_queue, out_queue, batch_size, stop):
+    try:
+        stream = chain.from_iterable(_iter_queue(in_queue, stop))
+        for batch in _line_batches(process(stream, pr, conll_comments, pass_header), batch_size):
+            if not _put(out_queue, batch, stop):
+                return
+        _put(out_queue, None, stop)
+    except Exception as e:  # Forward the exception downstream (upstream exceptions are forwarded as well)
+        _put(out_queue, _StageError(e), stop)
+
+
+def _process_segment_in_pool(stream, segment, available_tools, conll_comments, default_pass_header, num_workers,
+                             batch_size):
+    # Read header and check it for the whole segment in the main process to fail early (like process() does)
+    header_line = next(stream)
+    fields = header_line.strip().split('\t')
+    track_stream = {'file_name': getattr(stream, 'name', 'no filename for stream'), 'curr_line_number': 1}
+    header = header_line
+    for _, pr in segment:
+        header, _ = process_header(fields, pr.source_fields, pr.target_fields, track_stream)
+
+    last_pr = segment[-1][1]
+    if getattr(last_pr, 'pass_header', default_pass_header) and default_pass_header:
+        yield header
+
+    # Keep only a bounded number of batches in flight to preserve memory (and order)
+    max_pending = 2 * num_workers
+    init_args = ([program for program, _ in segment], available_tools, conll_comments, header_line)
+    with multiprocessing.Pool(num_workers, initializer=_init_worker, initargs=init_args) as pool:
+        pending = deque()
+        for batch in sentence_batch_iterator(stream, batch_size, conll_comments):
+            pending.append(pool.apply_async(_process_batch, (batch,)))
+            if len(pending) >= max_pending:
+                yield from pending.popleft().get()
+        while len(pending) > 0:
+            yield from pending.popleft().get()
+
+
+def _init_worker(programs, available_tools, conll_comments, header_line):
+    from .pipeline import lazy_init_tools  # Circular import...
+
+    global _worker_state
+    current_initialised_tools = lazy_init_tools(programs, available_tools, {})
+    _worker_state = ([current_initialised_tools[program] for program in programs], conll_comments, header_line)
+
+
+def _process_batch(batch):
+    tools, conll_comments, header_line = _worker_state
+    # The header is yielded by the main process. The lines are returned as they are: splitting the joined output
+    #  again (e.g. by str.splitlines()) would also split the tokens containing other line boundary characters
+    return list(process_chain(chain([header_line], batch), tools, conll_comments, False))
@@ -1,23 +1,35 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8, vim: expandtab:ts=4 -*-
 
+import io
+import time
 import importlib
-import codecs
+import logging
+import threading
+import concurrent.futures
 from itertools import chain
+from weakref import ref as weak_ref, WeakKeyDictionary
 from collections import defaultdict, OrderedDict, abc
-from os.path import abspath as os_path_abspath, dirname as os_path_dirname, join as os_path_join
 
-# import atexit
-
-from json import dumps as json_dumps
+from .tsvhandler import process_chain, SentenceStream
+from .binformat import encode_binary, read_binary
+from .parallel import parallel_pipeline, pipelined_pipeline
+from .fastio import BinaryLineReader, is_binary_stream
+from .limits import limit_input
+from .slo import RequestCancelled, cancellable
+from .optimiser import analyse_pipeline, drop_columns, group_branches, optimise_pipeline, plan_reannotation, \
+    restore_columns
+from .options import PipelineOptions
+from .toolpool import ToolPool
+from .profiling import record_init_time
+from .jnius_wrapper import jnius_config, import_pyjnius
 
-from flask import Flask, request, Response, stream_with_context, make_response, render_template
-from flask_restful import Api, Resource
-from flask_restful.inputs import boolean
-from werkzeug.exceptions import abort
+logger = logging.getLogger('xtsv')
 
-from .tsvhandler import process, HeaderError
-from .jnius_wrapper import jnius_config, import_pyjnius
+_MAX_COMPILED_PLANS = 128
+_compiled_plans = OrderedDict()  # (used tools, id of available tools, id of presets) -> PipelinePlan
+_compiled_plans_lock = threading.Lock()
+_warm_up_lock = threading.Lock()  # Serialises the registration of the warmed up tools into the singleton stores
 
 
 class ModuleError(ValueError):
@@ -25,67 +37,243 @@ class ModuleError(ValueError):
 
 
 def build_pipeline(input_data, used_tools, available_tools, presets, conll_comments=False, singleton_store=None,
-                   output_header=True):
-    friendly_name_for_modules = {name: tool_params[1] for tool_params, names in available_tools for name in names}
-    current_initialised_tools = lazy_init_tools(used_tools, available_tools, presets, singleton_store)
-
-    used_tools = resolve_presets(presets, used_tools)
-
-    if isinstance(input_data, str):
-        inp_stream = iter(input_data.splitlines(keepends=True))
-    elif isinstance(input_data, abc.Iterable):
-        inp_stream = input_data
-    else:
-        raise ValueError('The input should be string or iterable!')
-
-    # Peek header...
-    header = next(inp_stream)
-    # ...and restore iterator...
-    inp_stream = chain([header], inp_stream)
-
-    pipeline_begin = inp_stream
-    pipeline_begin_friendly = 'Input Text'
-    pipeline_begin_prod = set(header.strip().split('\t'))
-
-    pipeline_end = pipeline_begin
-    pipeline_end_friendly = pipeline_begin_friendly
-    pipeline_prod = pipeline_begin_prod
-
-    last_used_tool_nr = len(used_tools) - 1
-    for i, program in enumerate(used_tools):
-        program_friendly = friendly_name_for_modules[program]
-        pr = current_initialised_tools.get(program)
-        if pr is not None:
+                   output_header=True, options=None, **kwargs):
+    """
+    Build the pipeline from the input data and the list of used tools
+    :param options: PipelineOptions of the run: the execution mode, the formats, the limits, etc. (see options.py)
+    :param kwargs: the options as keyword arguments (e.g. num_workers=4), they override the ones of options
+    :return: Iterator over the output lines (over the bytes of the output in binary formats)
+    """
+    # The plan of the same tool chain is compiled only once (see compile_pipeline())
+    return compile_pipeline(used_tools, available_tools, presets).run(input_data, conll_comments, singleton_store,
+                                                                      output_header, options, **kwargs)
+
+
+def compile_pipeline(used_tools, available_tools, presets):
+    """
+    Compile the tool chain to a PipelinePlan or return the memoised plan of the same chain
+     (available_tools and presets must not be modified after their first use)
+    :return: PipelinePlan
+    """
+    key = (tuple(used_tools), id(available_tools), id(presets))
+    with _compiled_plans_lock:
+        plan = _compiled_plans.get(key)
+        # The plan keeps the tools and presets alive, so their ids can not be reused while it is stored
+        if plan is not None and plan.available_tools is available_tools and plan.presets is presets:
+            _compiled_plans.move_to_end(key)
+            return plan
+    plan = PipelinePlan(used_tools, available_tools, presets)
+    with _compiled_plans_lock:
+        _compiled_plans[key] = plan
+        while len(_compiled_plans) > _MAX_COMPILED_PLANS:
+            _compiled_plans.popitem(last=False)
+    return plan
+
+
+class PipelinePlan:
+    """
+    The compiled tool chain: the presets are resolved, the modules are imported and the tools are selected once.
+     The feasibility of the chain and the field bindings of the modules (process_header() and prepare_fields())
+     are memoised by the input header, so the plan can be run many times cheaply (e.g. for short REST requests)
+    """
+    def __init__(self, used_tools, available_tools, presets):
+        self.available_tools = available_tools
+        self.presets = presets
+        self.programs = list(resolve_presets(presets, used_tools))
+        friendly_name_for_modules = {name: tool_params[1] for tool_params, names in available_tools for name in names}
+        params_for_modules = {name: tool_params for tool_params, names in available_tools for name in names}
+        for program in self.programs:
+            if program not in params_for_modules:
+                raise ModuleError('ERROR: \'{0}\' module not found. Available modules: {1}'.
+                                  format(program, ','.join(m for _, names in available_tools for m in names)))
+        self.friendly_names = [friendly_name_for_modules[program] for program in self.programs]
+        self.tool_params = [params_for_modules[program] for program in self.programs]
+        self._friendly_name_of = dict(zip(self.programs, self.friendly_names))  # Also for the reordered chains
+        self._tool_params_of = dict(zip(self.programs, self.tool_params))
+        self.selected_tools = select_tools(self.programs, available_tools, presets)
+        self._feasible_chains = OrderedDict()  # (header, ids of the instances) -> weak references to the instances
+        self._field_cache = WeakKeyDictionary()  # The last field bindings of the instances (see bind_fields())
+
+    def init_tools(self, singleton_store=None):
+        """ Initialise the tools of the plan (if they were not initialised before) like lazy_init_tools() """
+        return _init_selected_tools(self.selected_tools, _checked_singleton_store(singleton_store))
+
+    def run(self, input_data, conll_comments=False, singleton_store=None, output_header=True, options=None,
+            **kwargs):
+        """ Run the plan on the input data (the parameters are the same as of build_pipeline()) """
+        options = PipelineOptions.of(options, **kwargs)
+        if not isinstance(singleton_store, ToolPool):
+            return self.run_with_tools(input_data, self.init_tools(singleton_store), conll_comments, output_header,
+                                       options)
+
+        # The instances are used exclusively by this pipeline until its output is exhausted or closed
+        checked_out_tools = singleton_store.checkout_selected(self.selected_tools)
+        try:
+            pipeline_end = self.run_with_tools(input_data, checked_out_tools, conll_comments, output_header, options)
+        except BaseException:
+            singleton_store.checkin(checked_out_tools)
+            raise
+        return _CheckinIterator(pipeline_end, singleton_store, checked_out_tools)
+
+    def run_with_tools(self, input_data, current_initialised_tools, conll_comments=False, output_header=True,
+                       options=None, **kwargs):
+        """ Run the plan with already initialised (or checked out) tools """
+        options = PipelineOptions.of(options, **kwargs)
+        if options.input_format == 'binary' and not isinstance(input_data, SentenceStream):
+            input_data = read_binary(input_data)
+
+        if isinstance(input_data, SentenceStream):  # Already parsed, the header is known
+            inp_stream = input_data
+        elif isinstance(input_data, str):
+            # Split only at '\n' like the files (str.splitlines() would split the tokens containing e.g. '\x0c')
+            inp_stream = iter(io.StringIO(input_data, newline='\n'))
+        elif is_binary_stream(input_data):
+            # The overlong lines are not collected in the memory when they are limited
+            max_line_length = getattr(options.input_limits, 'max_line_length', None)
+            inp_stream = BinaryLineReader(input_data, max_line_length=max_line_length)
+        elif isinstance(input_data, abc.Iterable):
+            inp_stream = iter(input_data)  # Files are their own iterators, lists and corpora (MmapCorpus) are not
+        else:
+            raise ValueError('The input should be string or iterable!')
+
+        if isinstance(inp_stream, SentenceStream):
+            header = inp_stream.header or ''
+        else:
+            # Peek header...
+            header = next(inp_stream)
+            # ...and restore iterator...
+            inp_stream = chain([header], inp_stream)
+
+        pipeline = [(program, current_initialised_tools[program]) for program in self.programs]
+        original_fields = header.strip().split('\t')
+        overwritten_fields = []
+        if options.incremental or len(options.recompute) > 0:
+            pipeline, _, overwritten_fields = plan_reannotation(pipeline, original_fields, options.recompute)
+            if len(pipeline) == 0:  # Every column is up to date: the input is the output
+                pipeline_end = drop_columns(inp_stream, (), conll_comments, output_header)
+                if options.output_format != 'tsv':
+                    pipeline_end = encode_binary(pipeline_end, conll_comments,
+                                                 options.output_format == 'binary-zlib', output_header)
+                return pipeline_end
+            header = '{0}\n'.format('\t'.join(field for field in original_fields if field not in overwritten_fields))
+        analysis = None
+        if options.output_fields is not None or options.concurrent_branches:
+            pipeline, analysis = optimise_pipeline(pipeline, header.strip().split('\t'), options.output_fields)
+        self._check_feasibility(header, pipeline)
+        if options.input_limits is not None and not isinstance(inp_stream, SentenceStream):
+            first_app = pipeline[0][1]
+            fixed_order_tsv_input = getattr(first_app, 'fixed_order_tsv_input', False)
+            raw_text = len(first_app.source_fields) == 0 and not fixed_order_tsv_input
+            inp_stream = limit_input(inp_stream, options.input_limits, raw_text,
+                                     not raw_text and not fixed_order_tsv_input, conll_comments)
+        if len(overwritten_fields) > 0:
+            inp_stream = drop_columns(inp_stream, overwritten_fields, conll_comments)
+        if options.output_format != 'tsv':
+            output_has_header = _check_binary_output(pipeline, output_header)
+
+        if options.profile is not None:
+            pipeline = [(program, options.profile.wrap(program, pr, self._friendly_name_of[program]))
+                        for program, pr in pipeline]
+
+        if options.num_workers > 1:
+            pipeline_end = parallel_pipeline(inp_stream, pipeline, self.available_tools, conll_comments,
+                                             output_header, options.num_workers, options.parallel_batch_size)
+            pipeline_end = cancellable(pipeline_end, options.cancel)  # The workers can not be interrupted
+        elif options.pipelined:
+            pipeline_end = pipelined_pipeline(inp_stream, pipeline, conll_comments, output_header,
+                                              options.stage_workers, options.queue_size, options.parallel_batch_size,
+                                              options.stage_monitor)
+            pipeline_end = cancellable(pipeline_end, options.cancel)
+        else:
+            if options.result_cache is not None:
+                for program, pr in pipeline:
+                    options.result_cache.register_tool(pr, self._tool_params_of[program])
+            if options.concurrent_branches and len(analysis['branches']) > 0:
+                # The workers of the other modes initialise the tools by program name, they can not be grouped
+                pipeline = group_branches(pipeline, analysis['branches'])
+
+            # The consecutive internal modules pass the parsed sentences to each other without serialisation
+            # The columns are reordered (see below) without formatting and parsing the output again
+            pipeline_end = process_chain(inp_stream, [pr for _, pr in pipeline], conll_comments, output_header,
+                                         options.result_cache, self._field_cache,
+                                         parsed_output=options.output_format != 'tsv' or len(overwritten_fields) > 0,
+                                         cancel=options.cancel)
+
+        if len(overwritten_fields) > 0:  # The overwritten columns are moved back to their original places
+            # Only the output of modules passing the header is restored, it has header if output_header is set
+            pipeline_end = restore_columns(pipeline_end, pipeline, header.strip().split('\t'), original_fields,
+                                           output_header, conll_comments)
+
+        if options.output_format != 'tsv':
+            pipeline_end = encode_binary(pipeline_end, conll_comments, options.output_format == 'binary-zlib',
+                                         output_has_header)
+
+        if options.profile is not None:
+            pipeline_end = options.profile.track(pipeline_end)
+        return pipeline_end
+
+    def analyse(self, header='', output_fields=None, singleton_store=None):
+        """
+        The dependencies of the modules (see analyse_pipeline()): the order of processing, the modules not needed for
+         the output fields, the unconsumed outputs and the independent branches
+        :param header: the header line of the input (not used if the first module reads raw text)
+        """
+        if isinstance(singleton_store, ToolPool):  # Only the fields of the instances are read
+            tools = singleton_store.checkout_selected(self.selected_tools)
+            singleton_store.checkin(tools)
+        else:
+            tools = self.init_tools(singleton_store)
+        pipeline = [(program, tools[program]) for program in self.programs]
+        return analyse_pipeline(pipeline, header.strip().split('\t'), output_fields)
+
+    def _check_feasibility(self, header, pipeline):
+        """ Check the feasibility of the whole pipeline before processing anything (memoised by the header) """
+        key = (header, tuple(id(pr) for _, pr in pipeline))
+        instances = self._feasible_chains.get(key)
+        if instances is not None and all(instance_ref() is pr for instance_ref, (_, pr) in zip(instances, pipeline)):
+            return
+        pipeline_end_friendly = 'Input Text'
+        pipeline_prod = set(header.strip().split('\t'))
+        for i, (program, pr) in enumerate(pipeline):
+            program_friendly = self._friendly_name_of[program]
             if i == 0 and len(pr.source_fields) == 0:  # If first module expects raw text, there are no fields!
                 pipeline_prod = set()
             if not pr.source_fields.issubset(pipeline_prod):
                 raise ModuleError('ERROR: \'{0}\' module requires {1} fields but the previous module \'{2}\''
                                   ' has only {3} fields!'.format(program_friendly, pr.source_fields,
                                                                  pipeline_end_friendly, pipeline_prod))
-            pipeline_end = process(pipeline_end, pr, conll_comments, i != last_used_tool_nr or output_header)
             pipeline_end_friendly = program_friendly
             pipeline_prod |= set(pr.target_fields)
-        else:
-            raise ModuleError('ERROR: \'{0}\' module not found. Available modules: {1}'.
-                              format(program, ','.join(m for _, names in available_tools for m in names)))
-
-    return pipeline_end
-
-
-def pipeline_rest_api(name, available_tools, presets, conll_comments, singleton_store=None, form_title='xtsv pipeline',
-                      form_type='checkbox', doc_link='', output_header=True):
-    if available_tools is None:
-        raise ValueError('No internal_app is given!')
+        try:
+            # Weak references: the evicted instances of a ToolPool must not be kept alive by the plan
+            self._feasible_chains[key] = tuple(weak_ref(pr) for _, pr in pipeline)
+        except TypeError:  # Not weak referenceable: checked every time
+            return
+        while len(self._feasible_chains) > _MAX_COMPILED_PLANS:
+            self._feasible_chains.popitem(last=False)
 
-    kwargs = {'internal_apps': available_tools, 'presets': presets, 'conll_comments': conll_comments,
-              'singleton_store': singleton_store, 'form_title': form_title, 'form_type': form_type,
-              'doc_link': doc_link, 'output_header': output_header}
 
-    app = Flask(name,  template_folder=os_path_join(os_path_dirname(os_path_abspath(__file__)), 'templates'))
-    api = Api(app)
-    api.add_resource(RESTapp, '/', '/<path:path>', resource_class_kwargs=kwargs)  # Catch-all with self
+def process_documents(documents, used_tools, available_tools, presets, conll_comments=False, singleton_store=None,
+                      output_header=True, result_cache=None, metrics=None, input_limits=None, cancel=None):
+    """
+    Run many (small) documents one after the other through the same initialised tools (the tools are initialised
+     or checked out from the ToolPool only once). The error of a document does not stop the others
+    :param documents: iterable of the documents (strings or iterables of lines like the input of build_pipeline(),
+     exceptions are reported in place of the invalid documents)
+    :param metrics: PipelineMetrics to profile the documents
+    :param input_limits: InputLimits of the documents (see build_pipeline())
+    :param cancel: CancelToken of all the documents: RequestCancelled stops the whole run (see build_pipeline())
+    :return: Iterator over the (output text, None) or (None, error message) pairs in the order of the documents
+    """
+    plan = compile_pipeline(used_tools, available_tools, presets)
+    if not isinstance(singleton_store, ToolPool):
+        return _process_documents(documents, plan, plan.init_tools(singleton_store), conll_comments, output_header,
+                                  result_cache, metrics, input_limits, cancel)
 
-    return app
+    checked_out_tools = singleton_store.checkout_selected(plan.selected_tools)
+    return _CheckinIterator(_process_documents(documents, plan, checked_out_tools, conll_comments, output_header,
+                                               result_cache, metrics, input_limits, cancel),
+                            singleton_store, checked_out_tools)
 
 
 def singleton_store_factory():
@@ -95,7 +283,91 @@ def singleton_store_factory():
     return {}, defaultdict(list)
 
 
-# From here, there are only private methods
+class WarmUpStatus:
+    """ The progress of warm_up(): the status and the initialisation time of every tool """
+    def __init__(self, tool_names=()):
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+        self._start = time.monotonic()
+        self._total_time = None
+        self._tools = OrderedDict((name, {'status': 'pending', 'init_time': None, 'error': None})
+                                  for name in tool_names)
+
+    @property
+    def done(self):
+        return self._done.is_set()
+
+    @property
+    def ready(self):
+        """ All tools are initialised successfully """
+        with self._lock:
+            return self._done.is_set() and all(tool['status'] == 'ready' for tool in self._tools.values())
+
+    def wait(self, timeout=None):
+        """ Wait for the end of the warm-up, return True if it has ended """
+        return self._done.wait(timeout)
+
+    def report(self):
+        with self._lock:
+            return {'done': self._done.is_set(),
+                    'ready': self._done.is_set() and all(tool['status'] == 'ready' for tool in self._tools.values()),
+                    'total_time': self._total_time if self._total_time is not None else time.monotonic() - self._start,
+                    'tools': {name: dict(tool) for name, tool in self._tools.items()}}
+
+    def _update(self, name, **kwargs):
+        with self._lock:
+            self._tools[name].update(kwargs)
+
+    def _finish(self):
+        with self._lock:
+            self._total_time = time.monotonic() - self._start
+        self._done.set()
+
+
+def warm_up(used_tools, available_tools, presets, singleton_store, max_workers=None, background=False):
+    """
+    Initialise the tools concurrently (in threads) into the singleton store or ToolPool before the first request.
+     The wall time is bounded by the slowest tool when the tools load their models without holding the GIL
+     (e.g. JVM-based tools or native libraries)
+    :param used_tools: the list of tools (or a preset) to initialise, None for all available tools
+    :param available_tools: the uninitialised tools
+    :param presets: pre-defined chains
+    :param singleton_store: the store (singleton_store_factory()) or ToolPool to fill
+    :param max_workers: the number of tools initialised at once (default: all of them)
+    :param background: return immediately and initialise the tools in a background thread
+    :return: WarmUpStatus
+    """
+    if used_tools is None:
+        used_tools = [prog_name for _, prog_names in available_tools for prog_name in prog_names]
+    if not isinstance(singleton_store, ToolPool):
+        lazy_init_tools([], available_tools, presets, singleton_store)  # Check the type of the store
+
+    # Aliases (same params) are initialised only once
+    unique_tools = []
+    for prog_params, prog_names in select_tools(used_tools, available_tools, presets):
+        for curr_prog_params, curr_prog_names in unique_tools:
+            if curr_prog_params == prog_params:
+                curr_prog_names.extend(prog_names)
+                break
+        else:
+            unique_tools.append((prog_params, list(prog_names)))
+
+    status = WarmUpStatus(','.join(prog_names) for _, prog_names in unique_tools)
+    thread = threading.Thread(target=_warm_up, args=(unique_tools, used_tools, available_tools, presets,
+                                                     singleton_store, max_workers, status), daemon=True)
+    thread.start()
+    if not background:
+        thread.join()
+    return status
+
+
+def output_has_header(last_app, output_header=True):
+    """ The output of the pipeline starts with a header line (see process()) """
+    if len(last_app.source_fields) == 0 and not getattr(last_app, 'fixed_order_tsv_input', False):
+        return True  # Tokenisers always output the header
+    return bool(getattr(last_app, 'pass_header', output_header) and output_header)
+
+
 def resolve_presets(presets, used_tools):  # Resolve presets to module names to enable shorter URLs/task definitions...
     if len(used_tools) == 1 and used_tools[0] in presets:
         used_tools = presets[used_tools[0]][1]
@@ -104,6 +376,12 @@ def resolve_presets(presets, used_tools):  # Resolve presets to module names to
 
 def lazy_init_tools(used_tools, available_tools, presets, singleton_store=None):
     """ Resolve presets and initialise what is needed if it were not initialised before or not available """
+    singleton_store = _checked_singleton_store(singleton_store)
+    return _init_selected_tools(select_tools(used_tools, available_tools, presets), singleton_store)
+
+
+def select_tools(used_tools, available_tools, presets):
+    """ Import the modules of the available tools, resolve presets and select the (prog_params, prog_names) needed """
     # Sanity check params!
     for app, _ in available_tools:
         if not isinstance(app, tuple):
@@ -118,6 +396,133 @@ def lazy_init_tools(used_tools, available_tools, presets, singleton_store=None):
     # Resolve presets to module names to init only the needed modules...
     used_tools = set(resolve_presets(presets, used_tools))
 
+    selected_tools = [(k, v) for k, v in available_tools if len(used_tools.intersection(set(v)))]
+    # Init everything properly
+    # Here we must challenge if any classpath or JAVA VM options are set to be able to throw the exception if needed
+    if jnius_config.classpath is not None or len(jnius_config.options) > 0:
+        import_pyjnius()
+    return selected_tools
+
+
+def init_tool(prog_params, prog_names):
+    """ Initialise one tool from its parameters (module, class, friendly name, args, kwargs) """
+    module, prog, friendly_name, prog_args, prog_kwargs = prog_params
+    prog_imp = getattr(importlib.import_module(module), prog)
+    start = time.perf_counter()
+    inited_prog = prog_imp(*prog_args, **prog_kwargs)  # Inint programs...
+    record_init_time(inited_prog, time.perf_counter() - start)
+    if (not hasattr(inited_prog, 'source_fields') or not isinstance(inited_prog.source_fields, set)) and \
+       (not hasattr(inited_prog, 'target_fields') or not isinstance(inited_prog.target_fields, list)):
+        raise ModuleError('Module named {0} has no source_fields or target_fields attributes'
+                          ' or some of them has wrong type !'.format(','.join(prog_names)))
+    return inited_prog
+
+
+# From here, there are only private methods
+def _warm_up(unique_tools, used_tools, available_tools, presets, singleton_store, max_workers, status):
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers or max(len(unique_tools), 1)) as executor:
+            futures = [executor.submit(_warm_up_tool, prog_params, prog_names, singleton_store, status)
+                       for prog_params, prog_names in unique_tools]
+            concurrent.futures.wait(futures)
+        if not isinstance(singleton_store, ToolPool):
+            failed_names = set()  # Every alias of the failed tools (they are not initialised again here)
+            with _warm_up_lock:
+                for future, (prog_params, prog_names) in zip(futures, unique_tools):
+                    inited_prog, failed = future.result()
+                    if failed:
+                        failed_names.update(prog_names)
+                    elif inited_prog is not None and not _is_initialised(singleton_store, prog_params):
+                        _register_tool(singleton_store, prog_params, prog_names, inited_prog)
+                # Register the aliases which were initialised before
+                lazy_init_tools([name for name in resolve_presets(presets, used_tools) if name not in failed_names],
+                                available_tools, presets, singleton_store)
+    finally:
+        status._finish()
+
+
+def _warm_up_tool(prog_params, prog_names, singleton_store, status):
+    """ Initialise one tool, return the new instance (None if it is stored elsewhere) and whether it has failed """
+    name = ','.join(prog_names)
+    status._update(name, status='initialising')
+    start = time.monotonic()
+    inited_prog = None
+    try:
+        if isinstance(singleton_store, ToolPool):
+            singleton_store.preload(prog_params, prog_names)
+        elif not _is_initialised(singleton_store, prog_params):
+            inited_prog = init_tool(prog_params, prog_names)
+    except Exception as e:
+        logger.error('Initialising {0} failed: {1}'.format(name, e))
+        status._update(name, status='failed', init_time=time.monotonic() - start, error=str(e))
+        return None, True
+    status._update(name, status='ready', init_time=time.monotonic() - start)
+    return inited_prog, False
+
+
+class _CheckinIterator:
+    """ Check in the tools of the pipeline to the ToolPool when its output is exhausted, closed or discarded """
+    def __init__(self, iterator, pool, checked_out):
+        self._iterator = iterator
+        self._pool = pool
+        self._checked_out = checked_out
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        try:
+            return next(self._iterator)
+        except BaseException:  # StopIteration as well
+            self.close()
+            raise
+
+    def close(self):
+        if self._checked_out is not None:
+            close = getattr(self._iterator, 'close', None)
+            if close is not None:
+                close()
+            self._pool.checkin(self._checked_out)
+            self._checked_out = None
+
+    def __del__(self):
+        self.close()
+
+
+def _check_binary_output(pipeline, output_header):
+    """ The output of the last module must be TSV (with or without header) to be written in binary format """
+    _, last_app = pipeline[-1]
+    if getattr(last_app, 'final_output', None) is not None or \
+            not getattr(last_app, 'add_newline_after_sentence', True) or \
+            (len(last_app.source_fields) > 0 and not getattr(last_app, 'pass_header', True)):
+        raise ModuleError('ERROR: the output of the last module is not TSV, it can not be written in binary format!')
+    return output_has_header(last_app, output_header)
+
+
+def _process_documents(documents, plan, current_initialised_tools, conll_comments, output_header, result_cache,
+                       metrics, input_limits=None, cancel=None):
+    for document in documents:
+        if cancel is not None:  # Also between the documents
+            cancel.check()
+        if isinstance(document, Exception):
+            yield None, str(document)
+            continue
+        profile = metrics.new_profile() if metrics is not None else None
+        try:
+            output = ''.join(plan.run_with_tools(document, current_initialised_tools, conll_comments, output_header,
+                                                 result_cache=result_cache, profile=profile,
+                                                 input_limits=input_limits, cancel=cancel))
+        except StopIteration:
+            yield None, 'ERROR: empty document!'
+        except RequestCancelled:  # Not the error of the document
+            raise
+        except Exception as e:  # Every error is reported for the document only
+            yield None, str(e) or type(e).__name__
+        else:
+            yield output, None
+
+
+def _checked_singleton_store(singleton_store):
     # If there is preinitialised tool pool check the type, else create a new!
     if singleton_store is None:
         singleton_store = singleton_store_factory()
@@ -126,13 +531,10 @@ def lazy_init_tools(used_tools, available_tools, presets, singleton_store=None):
             not issubclass(singleton_store[1].default_factory, list):
         raise ValueError('singleton_store  is expected to be the type of tuple(dict(), defaultdict(list))'
                          ' instead of {0} !'.format(type(singleton_store)))
+    return singleton_store
 
-    selected_tools = [(k, v) for k, v in available_tools if len(used_tools.intersection(set(v)))]
-    # Init everything properly
-    # Here we must challenge if any classpath or JAVA VM options are set to be able to throw the exception if needed
-    if jnius_config.classpath is not None or len(jnius_config.options) > 0:
-        import_pyjnius()
 
+def _init_selected_tools(selected_tools, singleton_store):
     current_initialised_tools = singleton_store[0]
     currrent_alias_store = singleton_store[1]
     for prog_params, prog_names in selected_tools:  # prog_names are individual, prog_params can be the same!
@@ -144,133 +546,16 @@ def lazy_init_tools(used_tools, available_tools, presets, singleton_store=None):
                     current_initialised_tools[prog_name] = current_initialised_tools[inited_prog_names[0]]
                 break
         else:  # No initialised alias found... Initialize and store as initialised alias!
-            prog_imp = getattr(importlib.import_module(module), prog)
-            inited_prog = prog_imp(*prog_args, **prog_kwargs)  # Inint programs...
-            if (not hasattr(inited_prog, 'source_fields') or not isinstance(inited_prog.source_fields, set)) and \
-               (not hasattr(inited_prog, 'target_fields') or not isinstance(inited_prog.target_fields, list)):
-                raise ModuleError('Module named {0} has no source_fields or target_fields attributes'
-                                  ' or some of them has wrong type !'.format(','.join(prog_names)))
-            for prog_name in prog_names:
-                current_initialised_tools[prog_name] = inited_prog
-            currrent_alias_store[prog].append((prog_names, prog_params))  # For lookup we need prog_names as well!
+            _register_tool(singleton_store, prog_params, prog_names, init_tool(prog_params, prog_names))
     return current_initialised_tools
 
 
-class RESTapp(Resource):
-    def __init__(self, internal_apps=None, presets=(), conll_comments=False, singleton_store=None,
-                 form_title='xtsv pipeline', form_type='checkbox', doc_link='', output_header=True):
-        """
-        Init REST API class
-        :param internal_apps: pre-inicialised applications
-        :param presets: pre-defined chains eg. from tokenisation to dependency parsing'
-        :param conll_comments: CoNLL-U-style comments (lines beginning with '# ') before sentences
-        :param singleton_store: preinitialised tool pool, which mustbe defined externally,
-                or new is created on every call!
-        :param form_title: the title of the HTML form shown when URL opened in a browser
-        :param form_type: Some tools can be used as alternatives (e.g. different modes of emMorph),
-                some allow sequences to be defined
-        :param doc_link: A link to documentation on usage for helping newbies
-        :param output_header: Make header for output or not
-        """
-        self._internal_apps = internal_apps
-        self._presets = presets
-        self._conll_comments = conll_comments
-        self._output_header = output_header
-
-        self._singleton_store = singleton_store
-        self._title = form_title
-        if form_type not in {'checkbox', 'radio'}:
-            raise ValueError('form_type should be either \'checkbox\' or \'radio\' instead of {0}'.format(form_type))
-        if form_type == 'radio' and len(presets) != 0:
-            raise ValueError('Presets and radio buttons are mutually exclusive options!')
-        self._tools_type = form_type
-
-        self._doc_link = doc_link
-
-        # Dict of default tool names -> friendly names
-        self._available_tools = {names[0]: tool_params[2] for tool_params, names in internal_apps}
-        # atexit.register(self._internal_apps.__del__)  # For clean exit...
-
-    def get(self, path=''):
-        # fun/token
-        fun, token = None, ''
-        if '/' in path:
-            fun, token = path.split('/', maxsplit=1)
-        curr_tools = lazy_init_tools([fun], self._internal_apps, self._presets, self._singleton_store)
-        prog = getattr(curr_tools.get(fun), 'process_token', None)
-
-        if len(path) == 0 or len(token) == 0 or prog is None:
-            base_url = request.url_root.rstrip('/')  # FORM URL
-
-            out_html = render_template('layout.html', title=self._title, base_url=base_url, doc_link=self._doc_link,
-                                       presets=self._presets, available_tools=self._available_tools,
-                                       tools_type=self._tools_type)
-            return Response(out_html)
-
-        json_text = json_dumps({token: prog(token)}, indent=2, sort_keys=True, ensure_ascii=False)
-
-        return self._make_json_response(json_text)
-
-    def post(self, path):
-        # Handle both json and form data transparently
-        req_data = request.get_json() if request.is_json else request.form
-        tohtml = req_data.get('toHTML', False)
-        if tohtml:
-            final_convert = self._to_html
-        else:
-            final_convert = self._identity
-
-        conll_comments = self._get_checked_bool('conll_comments', self._conll_comments, req_data)
-        output_header = self._get_checked_bool('output_header', self._output_header, req_data)
-        input_text = req_data.get('text')
-        if 'file' in request.files and input_text is None:
-            inp_data = codecs.getreader('UTF-8')(request.files['file'])
-        elif 'file' not in request.files and input_text is not None:
-            inp_data = input_text
-        else:
-            abort(400, 'ERROR: input text or file (mutually exclusive) not found in request!')
-            inp_data = None  # Silence dummy IDE
-
-        required_tools = path.split('/')
+def _register_tool(singleton_store, prog_params, prog_names, inited_prog):
+    current_initialised_tools, currrent_alias_store = singleton_store
+    for prog_name in prog_names:
+        current_initialised_tools[prog_name] = inited_prog
+    currrent_alias_store[prog_params[1]].append((prog_names, prog_params))  # For lookup we need prog_names as well!
 
-        try:
-            last_prog = build_pipeline(inp_data, required_tools, self._internal_apps, self._presets, conll_comments,
-                                       self._singleton_store, output_header)
-        except (HeaderError, ModuleError) as e:
-            abort(400, e)
-            last_prog = ()  # Silence, dummy IDE
-
-        response = Response(stream_with_context(final_convert((line.encode('UTF-8') for line in last_prog))),
-                            direct_passthrough=True, content_type='text/plain; charset=utf-8')
-        if not tohtml:
-            response.headers.set('Content-Disposition', 'attachment', filename='output.txt')
-        return response
-
-    @staticmethod
-    def _get_checked_bool(input_param_name, default, req_data):
-        try:
-            return boolean(req_data.get(input_param_name, default))
-        except ValueError:
-            abort(400, 'ERROR: argument {0} should be True/False!'.format(input_param_name))
 
-    @staticmethod
-    def _make_json_response(json_text, status=200):
-        """
-         https://stackoverflow.com/questions/16908943/display-json-returned-from-flask-in-a-neat-way/23320628#23320628
-        """
-        response = make_response(json_text)
-        response.headers['Content-Type'] = 'application/json; charset=utf-8'
-        response.headers['mimetype'] = 'application/json'
-        response.status_code = status
-        return response
-
-    @staticmethod
-    def _identity(x):
-        return x
-
-    @staticmethod
-    def _to_html(input_iterator):
-        for line in input_iterator:
-            yield line.rstrip(b'\n').replace(b'&', b'&amp;').replace(b'<', b'&lt;').replace(b'>', b'&gt;').\
-                replace(b'"', b'&quot;').replace(b'\'', b'&#x27;')
-            yield b'<br/>\n'
+def _is_initialised(singleton_store, prog_params):
+    return any(curr_prog_params == prog_params for _, curr_prog_params in singleton_store[1][prog_params[1]])
@@ -0,0 +1,290 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8, vim: expandtab:ts=4 -*-
+
+"""
+Per-module instrumentation of the pipeline: wall and CPU time, the number of sentences and tokens, throughput,
+ initialisation time and memory usage. PipelineProfile records one run (see build_pipeline()),
+ PipelineMetrics accumulates many runs (e.g. the requests of the REST API) and exports them in Prometheus format.
+"""
+
+import threading
+from time import perf_counter, thread_time
+from weakref import WeakKeyDictionary
+from collections import OrderedDict
+
+from .memusage import current_rss, peak_rss
+
+# The initialisation time of the tools (by instance) recorded by init_tool()
+_init_times = WeakKeyDictionary()
+
+
+def record_init_time(internal_app, seconds):
+    try:
+        _init_times[internal_app] = seconds
+    except TypeError:  # Not weak referenceable
+        pass
+
+
+def init_time_of(internal_app):
+    """ The initialisation time of the tool in seconds (None if it was not initialised by xtsv) """
+    try:
+        return _init_times.get(internal_app)
+    except TypeError:
+        return None
+
+
+class PipelineProfile:
+    """ The profile of one pipeline run: pass it as profile to build_pipeline() and read report() at the end """
+    def __init__(self, rss_sample_interval=100):
+        """
+        :param rss_sample_interval: sample the memory usage after every Nth call of a module
+        """
+        self._rss_sample_interval = rss_sample_interval
+        self._stages = []
+        self._start = None
+        self._wall_time = None
+        self._peak_rss = None
+        self._listeners = []
+
+    def wrap(self, name, internal_app, friendly_name=None):
+        """ Return the instrumented proxy of the initialised tool recording its stats under the given name """
+        stats = OrderedDict([('name', name), ('friendly_name', friendly_name or name), ('wall_time', 0.0),
+                             ('cpu_time', 0.0), ('sentences', 0), ('tokens', 0), ('calls', 0),
+                             ('init_time', init_time_of(internal_app)), ('peak_rss', 0)])
+        self._stages.append(stats)
+        return _ProfiledApp(internal_app, stats, self._rss_sample_interval)
+
+    def track(self, output_lines):
+        """ Measure the whole run from the first line to the exhaustion (or closing) of the output """
+        self._start = perf_counter()
+        try:
+            yield from output_lines
+        finally:
+            self._wall_time = perf_counter() - self._start
+            self._peak_rss = peak_rss()
+            for listener in self._listeners:
+                listener(self)
+
+    @property
+    def finished(self):
+        return self._wall_time is not None
+
+    def report(self):
+        """ The structured report of the run (can be read while the pipeline is running) """
+        stages = []
+        for stats in self._stages:
+            stage = OrderedDict(stats)
+            stage['tokens_per_sec'] = stats['tokens'] / stats['wall_time'] if stats['wall_time'] > 0 else None
+            stages.append(stage)
+        wall_time = self._wall_time
+        if wall_time is None and self._start is not None:
+            wall_time = perf_counter() - self._start
+        return OrderedDict([('wall_time', wall_time), ('peak_rss', self._peak_rss if self.finished else peak_rss()),
+                            ('stages', stages)])
+
+    def format_report(self):
+        """ The report as a human readable table """
+        report = self.report()
+        lines = ['{0:<20} {1:>10} {2:>10} {3:>10} {4:>10} {5:>12} {6:>10} {7:>10}'.
+                 format('module', 'wall (s)', 'cpu (s)', 'sentences', 'tokens', 'tokens/s', 'init (s)', 'RSS (MB)')]
+        for stage in report['stages']:
+            lines.append('{0:<20} {1:>10.3f} {2:>10.3f} {3:>10} {4:>10} {5:>12} {6:>10} {7:>10.1f}'.
+                         format(stage['name'], stage['wall_time'], stage['cpu_time'], stage['sentences'],
+                                stage['tokens'], _format_optional(stage['tokens_per_sec'], '{0:.1f}'),
+                                _format_optional(stage['init_time'], '{0:.3f}'), stage['peak_rss'] / (1 << 20)))
+        lines.append('total wall time: {0} s, peak RSS: {1:.1f} MB'.
+                     format(_format_optional(report['wall_time'], '{0:.3f}'), report['peak_rss'] / (1 << 20)))
+        return '\n'.join(lines) + '\n'
+
+
+class PipelineMetrics:
+    """ The cumulative stats of many pipeline runs by module (e.g. the requests of the REST API) """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._modules = OrderedDict()
+        self._runs = 0
+        self._wall_time = 0.0
+        self._rejected = OrderedDict()  # reason -> the number of the rejected requests
+        self._cancelled = OrderedDict()  # reason -> the number of the cancelled requests
+
+    def new_profile(self):
+        """ A PipelineProfile which is added to these metrics when its run is finished """
+        profile = PipelineProfile()
+        profile._listeners.append(self.add)
+        return profile
+
+    def add(self, profile):
+        report = profile.report()
+        with self._lock:
+            self._runs += 1
+            self._wall_time += report['wall_time'] or 0.0
+            for stage in report['stages']:
+                module = self._modules.setdefault(stage['name'], {'wall_time': 0.0, 'cpu_time': 0.0, 'sentences': 0,
+                                                                  'tokens': 0, 'init_time': None})
+                for key in ('wall_time', 'cpu_time', 'sentences', 'tokens'):
+                    module[key] += stage[key]
+                if stage['init_time'] is not None:
+                    module['init_time'] = stage['init_time']
+
+    def reject(self, reason):
+        """ Count a request rejected before processing (e.g. 'memory' or 'request_size', see check_admission()) """
+        with self._lock:
+            self._rejected[reason] = self._rejected.get(reason, 0) + 1
+
+    def cancel(self, reason):
+        """ Count a request stopped while processing (e.g. 'deadline' or 'disconnect', see CancelToken) """
+        with self._lock:
+            self._cancelled[reason] = self._cancelled.get(reason, 0) + 1
+
+    def stats(self):
+        with self._lock:
+            return {'runs': self._runs, 'wall_time': self._wall_time, 'rejected': dict(self._rejected),
+                    'cancelled': dict(self._cancelled),
+                    'modules': OrderedDict((name, dict(module)) for name, module in self._modules.items())}
+
+
+def prometheus_metrics(metrics=None, result_cache=None, admission_queue=None, token_lookup=None):
+    """
+    Export the metrics in the Prometheus text format
+    :param metrics: PipelineMetrics (the module level stats are omitted if None)
+    :param result_cache: ResultCache to export its counters (optional)
+    :param admission_queue: AdmissionQueue to export the number of the active and the waiting requests (optional)
+    :param token_lookup: TokenLookup to export the counters of the token endpoints (optional)
+    :return: the text of the metrics
+    """
+    lines = []
+    rss = current_rss()
+    _add_metric(lines, 'xtsv_process_resident_memory_bytes', 'gauge', 'Resident set size of the process',
+                [('', rss)])
+    _add_metric(lines, 'xtsv_process_peak_resident_memory_bytes', 'gauge', 'Peak resident set size of the process',
+                [('', max(peak_rss(), rss))])  # The memory may be freed between the two readings
+    if metrics is not None:
+        stats = metrics.stats()
+        _add_metric(lines, 'xtsv_pipeline_runs_total', 'counter', 'Finished pipeline runs', [('', stats['runs'])])
+        _add_metric(lines, 'xtsv_pipeline_wall_seconds_total', 'counter', 'Wall time of the finished pipeline runs',
+                    [('', stats['wall_time'])])
+        _add_metric(lines, 'xtsv_requests_rejected_total', 'counter', 'Requests rejected before processing',
+                    [('{{reason="{0}"}}'.format(_escape_label(reason)), count)
+                     for reason, count in stats['rejected'].items()])
+        _add_metric(lines, 'xtsv_requests_cancelled_total', 'counter', 'Requests stopped while processing',
+                    [('{{reason="{0}"}}'.format(_escape_label(reason)), count)
+                     for reason, count in stats['cancelled'].items()])
+        modules = stats['modules'].items()
+        for key, metric_name, metric_type, help_text in (
+                ('wall_time', 'xtsv_module_wall_seconds_total', 'counter', 'Wall time spent in the module'),
+                ('cpu_time', 'xtsv_module_cpu_seconds_total', 'counter', 'CPU time spent in the module'),
+                ('sentences', 'xtsv_module_sentences_total', 'counter', 'Sentences processed by the module'),
+                ('tokens', 'xtsv_module_tokens_total', 'counter', 'Tokens processed by the module'),
+                ('init_time', 'xtsv_module_init_seconds', 'gauge', 'Initialisation time of the module')):
+            _add_metric(lines, metric_name, metric_type, help_text,
+                        [('{{module="{0}"}}'.format(_escape_label(name)), module[key]) for name, module in modules
+                         if module[key] is not None])
+    if admission_queue is not None:
+        queue_stats = admission_queue.stats()
+        _add_metric(lines, 'xtsv_requests_active', 'gauge', 'Requests being processed',
+                    [('', queue_stats['active'])])
+        _add_metric(lines, 'xtsv_requests_queued', 'gauge', 'Requests waiting in the admission queue',
+                    [('', queue_stats['queued'])])
+    if result_cache is not None:
+        cache_stats = result_cache.stats()
+        for key in ('hits', 'disk_hits', 'misses', 'evictions'):
+            _add_metric(lines, 'xtsv_cache_{0}_total'.format(key), 'counter', 'Result cache {0}'.
+                        format(key.replace('_', ' ')), [('', cache_stats[key])])
+        _add_metric(lines, 'xtsv_cache_entries', 'gauge', 'Sentences in the memory cache',
+                    [('', cache_stats['entries'])])
+        _add_metric(lines, 'xtsv_cache_bytes', 'gauge', 'Size of the memory cache', [('', cache_stats['bytes'])])
+    if token_lookup is not None:
+        lookup_stats = token_lookup.stats()
+        for key, help_text in (('hits', 'Tokens answered from the memo'), ('misses', 'Tokens processed by the tools'),
+                               ('calls', 'Calls of the tools by the token endpoints'),
+                               ('batched_requests', 'Token requests served by the call of an other request')):
+            _add_metric(lines, 'xtsv_token_{0}_total'.format(key), 'counter', help_text, [('', lookup_stats[key])])
+        _add_metric(lines, 'xtsv_token_memo_entries', 'gauge', 'Memoised tokens', [('', lookup_stats['entries'])])
+    return '\n'.join(lines) + '\n'
+
+
+# From here, there are only private methods
+class _ProfiledApp:
+    """ Proxy of the initialised tool measuring the calls of process_sentence(s) and final_output """
+    def __init__(self, internal_app, stats, rss_sample_interval):
+        self._internal_app = internal_app
+        self._stats = stats
+        self._rss_sample_interval = rss_sample_interval
+        # Only the optional methods the tool has are exposed
+        if getattr(internal_app, 'process_sentences', None) is not None:
+            self.process_sentences = self._process_sentences
+        if getattr(internal_app, 'final_output', None) is not None:
+            self.final_output = self._final_output
+
+    def __getattr__(self, name):
+        if name == '_internal_app':  # Not initialised yet (e.g. copying)
+            raise AttributeError(name)
+        return getattr(self._internal_app, name)
+
+    @property
+    def wrapped_app(self):
+        """ The proxies of the runs share the field bindings of the tool (see bind_fields()) """
+        return self._internal_app
+
+    def process_sentence(self, sen, *args):
+        if len(args) == 0:  # Tokeniser: the input is the stream, the output is the lines
+            return self._timed_lines(self._internal_app.process_sentence(sen))
+        start, cpu_start = perf_counter(), thread_time()
+        tokens = len(sen)  # The module may change the input sentence in place
+        processed_sen = self._internal_app.process_sentence(sen, *args)
+        if not isinstance(processed_sen, list):  # Lazy outputs are measured here
+            processed_sen = list(processed_sen)
+        self._record(1, tokens, start, cpu_start)
+        return processed_sen
+
+    def _process_sentences(self, batch, *args):
+        start, cpu_start = perf_counter(), thread_time()
+        tokens = sum(len(sen) for sen in batch)
+        processed_batch = [sen if isinstance(sen, list) else list(sen)
+                           for sen in self._internal_app.process_sentences(batch, *args)]
+        self._record(len(batch), tokens, start, cpu_start)
+        return processed_batch
+
+    def _final_output(self):
+        return self._timed_lines(self._internal_app.final_output(), count=False)
+
+    def _timed_lines(self, lines, count=True):
+        lines = iter(lines)
+        while True:
+            start, cpu_start = perf_counter(), thread_time()
+            try:
+                line = next(lines)
+            except StopIteration:
+                self._record(0, 0, start, cpu_start)
+                return
+            if not count:
+                self._record(0, 0, start, cpu_start)
+            elif line == '\n':  # End of sentence
+                self._record(1, 0, start, cpu_start)
+            else:
+                self._record(0, int(not line.startswith('# ')), start, cpu_start)
+            yield line
+
+    def _record(self, sentences, tokens, start, cpu_start):
+        stats = self._stats
+        stats['wall_time'] += perf_counter() - start
+        stats['cpu_time'] += thread_time() - cpu_start
+        stats['sentences'] += sentences
+        stats['tokens'] += tokens
+        stats['calls'] += 1
+        if (stats['calls'] - 1) % self._rss_sample_interval == 0:
+            stats['peak_rss'] = max(stats['peak_rss'], current_rss())
+
+
+def _format_optional(value, fmt):
+    return '-' if value is None else fmt.format(value)
+
+
+def _escape_label(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _add_metric(lines, name, metric_type, help_text, samples):
+    lines.append('# HELP {0} {1}'.format(name, help_text))
+    lines.append('# TYPE {0} {1}'.format(name, metric_type))
+    lines.extend('{0}{1} {2}'.format(name, labels, value) for labels, value in samples)
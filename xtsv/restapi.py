@@ -0,0 +1,512 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8, vim: expandtab:ts=4 -*-
+
+"""
+The REST API of the pipelines (Flask): the HTML form and the pipelines of a request (RESTapp), many documents
+ in one request (BatchApp), the fast path of the tokens (TokensApp), the health and the metrics endpoints.
+ The helpers shared with the ASGI API (asgi.py) are here as well
+"""
+
+import io
+import logging
+from itertools import chain
+from collections import deque
+from os.path import abspath as os_path_abspath, dirname as os_path_dirname, join as os_path_join
+
+# import atexit
+
+from json import dumps as json_dumps, loads as json_loads
+
+from flask import Flask, request, Response, stream_with_context, make_response, render_template
+from flask_restful import Api, Resource
+from flask_restful.inputs import boolean
+from werkzeug.exceptions import abort
+
+from .tsvhandler import HeaderError, InputLimitError
+from .pipeline import ModuleError, build_pipeline, lazy_init_tools, process_documents
+from .toolpool import ToolPool
+from .fastio import BinaryLineReader, encode_lines
+from .limits import check_admission
+from .slo import RETRY_AFTER, CancelToken, RequestCancelled, reject_overload
+from .tokenlookup import TokenLookup, checked_tokens, token_json
+from .profiling import prometheus_metrics
+
+logger = logging.getLogger('xtsv')
+
+_HEALTH_ENDPOINTS = {'healthz', 'readyz'}
+RESERVED_ENDPOINTS = frozenset(_HEALTH_ENDPOINTS | {'metrics', 'batch', 'tokens'})
+PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+NDJSON_CONTENT_TYPES = {'application/x-ndjson', 'application/ndjson', 'application/jsonl'}
+
+
+def pipeline_rest_api(name, available_tools, presets, conll_comments, singleton_store=None, form_title='xtsv pipeline',
+                      form_type='checkbox', doc_link='', output_header=True, warm_up_status=None, result_cache=None,
+                      metrics=None, input_limits=None, request_timeout=None, admission_queue=None, token_lookup=None):
+    if available_tools is None:
+        raise ValueError('No internal_app is given!')
+    check_reserved_names(available_tools, presets)
+    if token_lookup is None:
+        token_lookup = TokenLookup()  # Must be shared between the requests
+
+    kwargs = {'internal_apps': available_tools, 'presets': presets, 'conll_comments': conll_comments,
+              'singleton_store': singleton_store, 'form_title': form_title, 'form_type': form_type,
+              'doc_link': doc_link, 'output_header': output_header, 'warm_up_status': warm_up_status,
+              'result_cache': result_cache, 'metrics': metrics, 'input_limits': input_limits,
+              'request_timeout': request_timeout, 'admission_queue': admission_queue, 'token_lookup': token_lookup}
+
+    app = Flask(name,  template_folder=os_path_join(os_path_dirname(os_path_abspath(__file__)), 'templates'))
+    if input_limits is not None and input_limits.max_request_bytes is not None:
+        app.config['MAX_CONTENT_LENGTH'] = input_limits.max_request_bytes  # Also for the chunked requests
+    api = Api(app)
+    api.add_resource(HealthApp, '/<any({0}):check>'.format(','.join(sorted(_HEALTH_ENDPOINTS))),
+                     resource_class_kwargs={'warm_up_status': warm_up_status})
+    api.add_resource(MetricsApp, '/metrics', resource_class_kwargs={'metrics': metrics, 'result_cache': result_cache,
+                                                                   'admission_queue': admission_queue,
+                                                                   'token_lookup': token_lookup})
+    api.add_resource(BatchApp, '/batch/<path:path>', resource_class_kwargs=kwargs)
+    api.add_resource(TokensApp, '/tokens/<tool>', resource_class_kwargs=kwargs)
+    api.add_resource(RESTapp, '/', '/<path:path>', resource_class_kwargs=kwargs)  # Catch-all with self
+
+    return app
+
+
+def check_reserved_names(available_tools, presets):
+    """ The tools and presets can not be named as the endpoints of the REST API (e.g. healthz) """
+    names = {prog_name for _, prog_names in available_tools for prog_name in prog_names} | set(dict(presets).keys())
+    collisions = names & RESERVED_ENDPOINTS
+    if len(collisions) > 0:
+        raise ValueError('The following tool or preset names are reserved for the REST API: {0}'.
+                         format(', '.join(sorted(collisions))))
+
+
+def health_check(check, warm_up_status=None):
+    """
+    The answer of the health endpoints: healthz is always OK while the server runs,
+     readyz is OK only when the warm-up (if any) is finished successfully
+    :return: (HTTP status, JSON text)
+    """
+    if check == 'healthz':
+        report, http_status = {'status': 'ok'}, 200
+    elif warm_up_status is None:
+        report, http_status = {'done': True, 'ready': True, 'tools': {}}, 200
+    else:
+        report = warm_up_status.report()
+        http_status = 200 if report['ready'] else 503
+    return http_status, json_dumps(report, indent=2, sort_keys=True, ensure_ascii=False)
+
+
+class HealthApp(Resource):
+    def __init__(self, warm_up_status=None):
+        self._warm_up_status = warm_up_status
+
+    def get(self, check):
+        http_status, json_text = health_check(check, self._warm_up_status)
+        return RESTapp._make_json_response(json_text, http_status)
+
+
+class MetricsApp(Resource):
+    def __init__(self, metrics=None, result_cache=None, admission_queue=None, token_lookup=None):
+        self._metrics = metrics
+        self._result_cache = result_cache
+        self._admission_queue = admission_queue
+        self._token_lookup = token_lookup
+
+    def get(self):
+        response = make_response(prometheus_metrics(self._metrics, self._result_cache, self._admission_queue,
+                                                    self._token_lookup))
+        response.headers['Content-Type'] = PROMETHEUS_CONTENT_TYPE
+        return response
+
+
+def batch_results(items, used_tools, available_tools, presets, conll_comments=False, singleton_store=None,
+                  output_header=True, result_cache=None, metrics=None, input_limits=None, cancel=None):
+    """
+    Process the documents of a batch request (see process_documents())
+    :param items: iterable of the documents (strings or objects with text and optional id fields)
+    :return: Iterator over the NDJSON lines of the results in order: {"index": i, "id": id, "output": text}
+     or {"index": i, "id": id, "error": message}
+    """
+    seen_items = deque()  # The items are needed for the ids as well
+
+    def documents():
+        for item in items:
+            seen_items.append(item)
+            yield item if isinstance(item, Exception) else _batch_document(item)
+
+    results = process_documents(documents(), used_tools, available_tools, presets, conll_comments, singleton_store,
+                                output_header, result_cache, metrics, input_limits, cancel)
+    return (_batch_result_line(i, seen_items.popleft(), output, error) for i, (output, error) in enumerate(results))
+
+
+def iter_ndjson(lines):
+    """ Parse the JSON values of the non-empty lines (ValueError in place of the invalid ones) """
+    for line in lines:
+        if len(line.strip()) > 0:
+            try:
+                yield json_loads(line)
+            except ValueError as e:
+                yield ValueError('ERROR: invalid JSON: {0}'.format(e))
+
+
+def checked_bool(input_param_name, default, req_data):
+    """ The boolean parameter of a request (True/False, 1/0) or raise ValueError with the error message """
+    value = req_data.get(input_param_name, default)
+    try:
+        return boolean(value if isinstance(value, bool) else str(value))  # E.g. numbers in JSON
+    except ValueError:
+        raise ValueError('ERROR: argument {0} should be True/False!'.format(input_param_name))
+
+
+def checked_timeout(req_data):
+    """ The time budget requested by the client in seconds (None if it is not given) or raise ValueError """
+    timeout = req_data.get('timeout')
+    if timeout is None:
+        return None
+    try:
+        timeout = float(timeout)
+    except (TypeError, ValueError):
+        timeout = 0
+    if not timeout > 0:
+        raise ValueError('ERROR: argument timeout should be a positive number of seconds!')
+    return timeout
+
+
+class RESTapp(Resource):
+    def __init__(self, internal_apps=None, presets=(), conll_comments=False, singleton_store=None,
+                 form_title='xtsv pipeline', form_type='checkbox', doc_link='', output_header=True,
+                 warm_up_status=None, result_cache=None, metrics=None, input_limits=None, request_timeout=None,
+                 admission_queue=None, token_lookup=None):
+        """
+        Init REST API class
+        :param internal_apps: pre-inicialised applications
+        :param presets: pre-defined chains eg. from tokenisation to dependency parsing'
+        :param conll_comments: CoNLL-U-style comments (lines beginning with '# ') before sentences
+        :param singleton_store: preinitialised tool pool, which mustbe defined externally,
+                or new is created on every call!
+        :param form_title: the title of the HTML form shown when URL opened in a browser
+        :param form_type: Some tools can be used as alternatives (e.g. different modes of emMorph),
+                some allow sequences to be defined
+        :param doc_link: A link to documentation on usage for helping newbies
+        :param output_header: Make header for output or not
+        :param warm_up_status: WarmUpStatus of the background warm-up (the requests wait until it is finished)
+        :param result_cache: ResultCache shared by the requests to reuse the output for repeated sentences
+        :param metrics: PipelineMetrics to profile every request (exported at the metrics endpoint)
+        :param input_limits: InputLimits of the requests (the size, the sentences, the lines and the memory usage)
+        :param request_timeout: the time budget of the requests in seconds (the clients can set shorter ones with
+         the timeout parameter), the pipeline is stopped between two sentences when it is exceeded (see slo.py)
+        :param admission_queue: AdmissionQueue to bound the concurrent and the waiting requests (503 over it)
+        :param token_lookup: TokenLookup shared by the requests to memoise and batch the calls of process_token()
+        """
+        self._internal_apps = internal_apps
+        self._input_limits = input_limits
+        self._request_timeout = request_timeout
+        self._admission_queue = admission_queue
+        self._token_lookup = token_lookup if token_lookup is not None else TokenLookup()
+        self._warm_up_status = warm_up_status
+        self._result_cache = result_cache
+        self._metrics = metrics
+        self._presets = presets
+        self._conll_comments = conll_comments
+        self._output_header = output_header
+
+        self._singleton_store = singleton_store
+        self._title = form_title
+        if form_type not in {'checkbox', 'radio'}:
+            raise ValueError('form_type should be either \'checkbox\' or \'radio\' instead of {0}'.format(form_type))
+        if form_type == 'radio' and len(presets) != 0:
+            raise ValueError('Presets and radio buttons are mutually exclusive options!')
+        self._tools_type = form_type
+
+        self._doc_link = doc_link
+
+        # Dict of default tool names -> friendly names
+        self._available_tools = {names[0]: tool_params[2] for tool_params, names in internal_apps}
+        # atexit.register(self._internal_apps.__del__)  # For clean exit...
+
+    def get(self, path=''):
+        # fun/token
+        fun, token = None, ''
+        if '/' in path:
+            fun, token = path.split('/', maxsplit=1)
+        self._wait_for_warm_up()
+        results = None
+        if len(token) > 0:  # The memoised tokens do not need the tool (see TokenLookup)
+            results = self._token_lookup.lookup(fun, [token], lambda process: self._run_with_tool(fun, process))
+
+        if results is None:  # No token or the tool does not support process_token()
+            base_url = request.url_root.rstrip('/')  # FORM URL
+
+            out_html = render_template('layout.html', title=self._title, base_url=base_url, doc_link=self._doc_link,
+                                       presets=self._presets, available_tools=self._available_tools,
+                                       tools_type=self._tools_type)
+            return Response(out_html)
+
+        return self._make_json_response(token_json(results, self._get_checked_bool('compact', False, request.args)))
+
+    def _run_with_tool(self, fun, process):
+        """ Call process() with the initialised tool (None if it is not available) """
+        if isinstance(self._singleton_store, ToolPool):  # Use an instance exclusively
+            with self._singleton_store.tools([fun], self._internal_apps, self._presets) as curr_tools:
+                return process(curr_tools.get(fun))
+        curr_tools = lazy_init_tools([fun], self._internal_apps, self._presets, self._singleton_store)
+        return process(curr_tools.get(fun))
+
+    def post(self, path):
+        rejection = self._check_admission()
+        if rejection is not None:
+            return rejection
+        cancel = CancelToken(self._request_timeout)  # The waiting in the queue is also part of the time budget
+        if self._admission_queue is not None and not self._admission_queue.acquire(cancel.remaining()):
+            return self._error_response(*reject_overload(self._metrics))
+        try:
+            response = self._post(path, cancel)
+        except BaseException:
+            self._release_slot()
+            raise
+        if not response.is_streamed:  # Else the end of the stream frees the slot (see _RequestStream)
+            self._release_slot()
+        return response
+
+    def _post(self, path, cancel):
+        # Handle both json and form data transparently
+        req_data = request.get_json() if request.is_json else request.form
+        tohtml = req_data.get('toHTML', False)
+        if tohtml:
+            final_convert = self._to_html
+        else:
+            final_convert = self._identity
+
+        conll_comments = self._get_checked_bool('conll_comments', self._conll_comments, req_data)
+        output_header = self._get_checked_bool('output_header', self._output_header, req_data)
+        cancel.shorten(self._get_checked_timeout(req_data))
+        input_text = req_data.get('text')
+        if input_text is not None and not isinstance(input_text, str):
+            abort(400, 'ERROR: the input text should be a string!')
+        if 'file' in request.files and input_text is None:
+            # Detach the uploaded stream as the request closes its files before streaming the response (Flask >= 3.1)
+            upload = request.files['file']
+            max_line_length = getattr(self._input_limits, 'max_line_length', None)
+            inp_data, upload.stream = BinaryLineReader(upload.stream, max_line_length=max_line_length), io.BytesIO()
+        elif 'file' not in request.files and input_text is not None:
+            inp_data = input_text
+        else:
+            abort(400, 'ERROR: input text or file (mutually exclusive) not found in request!')
+            inp_data = None  # Silence dummy IDE
+
+        required_tools = path.split('/')
+
+        self._wait_for_warm_up()
+        try:
+            profile = self._metrics.new_profile() if self._metrics is not None else None
+            last_prog = build_pipeline(inp_data, required_tools, self._internal_apps, self._presets, conll_comments,
+                                       self._singleton_store, output_header, result_cache=self._result_cache,
+                                       profile=profile, input_limits=self._input_limits, cancel=cancel)
+            # The input rejected at the beginning (e.g. a huge first sentence) is reported with status code
+            chunks = encode_lines(last_prog)
+            first_chunk = next(chunks, b'')
+        except (HeaderError, ModuleError, InputLimitError) as e:
+            abort(400, e)
+            first_chunk, chunks = b'', ()  # Silence, dummy IDE
+        except RequestCancelled as e:
+            return self._cancelled_response(e)
+
+        response = Response(stream_with_context(_RequestStream(final_convert(chain([first_chunk], chunks)), cancel,
+                                                               self._metrics, self._admission_queue)),
+                            direct_passthrough=True, content_type='text/plain; charset=utf-8')
+        if not tohtml:
+            response.headers.set('Content-Disposition', 'attachment', filename='output.txt')
+        return response
+
+    def _check_admission(self):
+        """ The error response if the request is rejected because of its size or the memory usage, else None """
+        rejection = check_admission(self._input_limits, request.content_length, self._metrics)
+        if rejection is None:
+            return None
+        return self._error_response(*rejection)
+
+    def _release_slot(self):
+        if self._admission_queue is not None:
+            self._admission_queue.release()
+
+    def _cancelled_response(self, e):
+        """ The request is cancelled before its output is started (e.g. its deadline has passed) """
+        logger.warning('Request cancelled: {0}'.format(e))
+        if self._metrics is not None:
+            self._metrics.cancel(e.reason)
+        return self._error_response(503, str(e))
+
+    @classmethod
+    def _error_response(cls, status, message):
+        response = cls._make_json_response(json_dumps({'message': message}), status)
+        if status == 503:  # Temporary
+            response.headers['Retry-After'] = str(RETRY_AFTER)
+        return response
+
+    def _wait_for_warm_up(self):
+        # The tools are initialised only once: the requests arriving during the warm-up wait for it
+        if self._warm_up_status is not None:
+            self._warm_up_status.wait()
+
+    @staticmethod
+    def _get_checked_bool(input_param_name, default, req_data):
+        try:
+            return checked_bool(input_param_name, default, req_data)
+        except ValueError as e:
+            abort(400, str(e))
+
+    @staticmethod
+    def _get_checked_timeout(req_data):
+        try:
+            return checked_timeout(req_data)
+        except ValueError as e:
+            abort(400, str(e))
+
+    @staticmethod
+    def _make_json_response(json_text, status=200):
+        """
+         https://stackoverflow.com/questions/16908943/display-json-returned-from-flask-in-a-neat-way/23320628#23320628
+        """
+        response = make_response(json_text)
+        response.headers['Content-Type'] = 'application/json; charset=utf-8'
+        response.headers['mimetype'] = 'application/json'
+        response.status_code = status
+        return response
+
+    @staticmethod
+    def _identity(x):
+        return x
+
+    @staticmethod
+    def _to_html(input_iterator):
+        for chunk in input_iterator:  # Chunks of whole lines
+            if len(chunk) == 0:
+                continue
+            if not chunk.endswith(b'\n'):  # The last line without newline is closed like the others
+                chunk += b'\n'
+            yield chunk.replace(b'&', b'&amp;').replace(b'<', b'&lt;').replace(b'>', b'&gt;').\
+                replace(b'"', b'&quot;').replace(b'\'', b'&#x27;').replace(b'\n', b'<br/>\n')
+
+
+class BatchApp(RESTapp):
+    """ Many documents in one request: JSON array or NDJSON (one document per line) in, NDJSON out in order """
+    def get(self, path=''):
+        abort(405, 'ERROR: Only POST method is allowed for batches!')
+
+    def _post(self, path, cancel):
+        conll_comments = self._get_checked_bool('conll_comments', self._conll_comments, request.args)
+        output_header = self._get_checked_bool('output_header', self._output_header, request.args)
+        cancel.shorten(self._get_checked_timeout(request.args))
+        if request.mimetype in NDJSON_CONTENT_TYPES:  # Streamed: parsed while the documents are processed
+            items = iter_ndjson(BinaryLineReader(request.stream))
+        else:
+            items = request.get_json(force=True, silent=True)
+            if not isinstance(items, list):
+                abort(400, 'ERROR: the body should be a JSON array of documents or NDJSON!')
+
+        required_tools = path.split('/')
+        self._wait_for_warm_up()
+        try:
+            lines = batch_results(items, required_tools, self._internal_apps, self._presets, conll_comments,
+                                  self._singleton_store, output_header, self._result_cache, self._metrics,
+                                  self._input_limits, cancel)
+        except (HeaderError, ModuleError) as e:
+            abort(400, e)
+            lines = ()  # Silence, dummy IDE
+
+        return Response(stream_with_context(_RequestStream(encode_lines(lines, buffer_size=1 << 12), cancel,
+                                                           self._metrics, self._admission_queue)),
+                        direct_passthrough=True, content_type='application/x-ndjson; charset=utf-8')
+
+
+class TokensApp(RESTapp):
+    """ Many tokens processed by one tool: GET with token parameters or POST with a JSON array of the tokens """
+    def get(self, tool):
+        return self._lookup(tool, request.args.getlist('token'))
+
+    def post(self, tool):
+        return self._lookup(tool, request.get_json(force=True, silent=True))
+
+    def _lookup(self, tool, tokens):
+        compact = self._get_checked_bool('compact', False, request.args)
+        try:
+            tokens = checked_tokens(tokens)
+        except ValueError as e:
+            abort(400, str(e))
+        self._wait_for_warm_up()
+        results = self._token_lookup.lookup(tool, tokens, lambda process: self._run_with_tool(tool, process))
+        if results is None:
+            abort(404, 'ERROR: {0} is not available or does not support processing single tokens!'.format(tool))
+        return self._make_json_response(token_json(results, compact))
+
+
+# From here, there are only private methods
+class _RequestStream:
+    """
+    The streamed response of a REST request: the request cancelled while streaming (the status is already sent)
+     aborts the connection (the exception is passed to the WSGI server, which does not terminate the chunked response,
+     so the cut output can not look complete), the stream closed before its end means that the client has gone away.
+     The cancelled requests are counted in the metrics and the slot of the admission queue is freed at the end
+    """
+    def __init__(self, chunks, cancel, metrics=None, admission_queue=None):
+        self._chunks = chunks
+        self._cancel = cancel
+        self._metrics = metrics
+        self._admission_queue = admission_queue
+        self._finished = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        try:
+            return next(self._chunks)
+        except StopIteration:
+            self._finished = True
+            self.close()
+            raise
+        except RequestCancelled as e:
+            logger.warning('Request cancelled while streaming, the connection is aborted: {0}'.format(e))
+            self._cancelled(e.reason)
+            self.close()
+            raise
+        except BaseException:
+            self._finished = True
+            self.close()
+            raise
+
+    def close(self):
+        if not self._finished:  # Closed by the server before the end
+            self._cancel.cancel('disconnect')
+            self._cancelled(self._cancel.reason)
+        close = getattr(self._chunks, 'close', None)
+        if close is not None:
+            close()
+        if self._admission_queue is not None:
+            self._admission_queue.release()
+            self._admission_queue = None
+
+    def _cancelled(self, reason):
+        self._finished = True
+        if self._metrics is not None:
+            self._metrics.cancel(reason)
+
+
+def _batch_document(item):
+    """ The text of a document of a batch request: a string or an object with text field (ValueError otherwise) """
+    if isinstance(item, dict):
+        item = item.get('text')
+    if not isinstance(item, str):
+        return ValueError('ERROR: the document should be a string or an object with text field!')
+    return item
+
+
+def _batch_result_line(index, item, output, error):
+    """ One line of the NDJSON response: the output or the error of the document with its index (and id if any) """
+    result = {'index': index}
+    if isinstance(item, dict) and 'id' in item:
+        result['id'] = item['id']
+    if error is not None:
+        result['error'] = error
+    else:
+        result['output'] = output
+    return '{0}\n'.format(json_dumps(result, ensure_ascii=False))
@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8, vim: expandtab:ts=4 -*-
+
+"""
+Bounded latency of the requests of the REST API under bursts: every request has a time budget (CancelToken) which is
+ checked cooperatively between the sentences (see process()) and cancels the pipeline when the deadline has passed or
+ the client has gone away, and an AdmissionQueue bounds the number of the running pipelines and of the requests
+ waiting for them, so the requests over the queue are rejected with 503 quickly instead of queuing without limit
+"""
+
+import asyncio
+import logging
+import threading
+from time import monotonic
+from collections import deque
+
+logger = logging.getLogger('xtsv')
+
+RETRY_AFTER = 5  # Seconds, suggested to the clients rejected with 503 (overload or memory usage)
+
+
+class RequestCancelled(Exception):
+    """ The pipeline was stopped between two sentences (the reason is 'deadline' or 'disconnect') """
+    def __init__(self, message, reason='cancelled'):
+        super().__init__(message)
+        self.reason = reason
+
+
+class CancelToken:
+    """ The deadline of a request and the cancellation of its pipeline (checked by the pipeline between sentences) """
+    def __init__(self, timeout=None, disconnected=None):
+        """
+        :param timeout: the time budget of the request in seconds from now (None: no deadline)
+        :param disconnected: threading.Event set when the client has gone away (optional)
+        """
+        self._start = monotonic()
+        self._deadline = self._start + timeout if timeout is not None else None
+        self._disconnected = disconnected
+        self._reason = None
+
+    def shorten(self, timeout):
+        """ Move the deadline to timeout seconds after the creation of the token if it is earlier than the current """
+        if timeout is not None:
+            deadline = self._start + timeout
+            if self._deadline is None or deadline < self._deadline:
+                self._deadline = deadline
+
+    def cancel(self, reason='cancelled'):
+        if self._reason is None:
+            self._reason = reason
+
+    def remaining(self):
+        """ The seconds left until the deadline (None: no deadline) """
+        if self._deadline is None:
+            return None
+        return max(0.0, self._deadline - monotonic())
+
+    @property
+    def reason(self):
+        """ Why the request is cancelled ('deadline', 'disconnect' or the reason given to cancel()), else None """
+        if self._reason is None:
+            if self._disconnected is not None and self._disconnected.is_set():
+                self._reason = 'disconnect'
+            elif self._deadline is not None and monotonic() > self._deadline:
+                self._reason = 'deadline'
+        return self._reason
+
+    @property
+    def cancelled(self):
+        return self.reason is not None
+
+    def check(self):
+        """ Raise RequestCancelled if the request is cancelled """
+        reason = self.reason
+        if reason is not None:
+            if reason == 'deadline':
+                message = 'ERROR: the request could not be processed within {0:.3g} seconds!'.\
+                    format(self._deadline - self._start)
+            else:
+                message = 'ERROR: the request is cancelled ({0})!'.format(reason)
+            raise RequestCancelled(message, reason)
+
+
+def cancellable(items, cancel):
+    """
+    Check the CancelToken before every item (e.g. sentence or line)
+    :param items: iterator
+    :param cancel: CancelToken (None: the items are returned unchanged)
+    :return: iterator over the items
+    """
+    if cancel is None:
+        return items
+    return _checked_items(items, cancel)
+
+
+class AdmissionQueue:
+    """
+    Admission control: at most max_active requests are processed at once and at most max_queued requests wait
+     for them (at most max_wait seconds), the others are rejected immediately (load shedding)
+    """
+    def __init__(self, max_active, max_queued=0, max_wait=None):
+        """
+        :param max_active: the number of the requests processed at once
+        :param max_queued: the number of the requests waiting for processing
+        :param max_wait: the maximal seconds of waiting in the queue (None: until the deadline of the request)
+        """
+        if max_active < 1 or max_queued < 0:
+            raise ValueError('max_active must be positive and max_queued must not be negative!')
+        self.max_active = max_active
+        self.max_queued = max_queued
+        self.max_wait = max_wait
+        self._active = 0
+        self._queued = 0
+        self._cond = threading.Condition()
+        self._async_waiters = deque()  # The requests waiting in event loops (woken one by one by release())
+
+    def acquire(self, timeout=None):
+        """
+        Wait for a free slot (in a thread, e.g. Flask)
+        :param timeout: the seconds of waiting (min. max_wait, None: max_wait)
+        :return: True if the request is admitted (release() must be called at its end), False if it is rejected
+        """
+        timeout = self._wait_time(timeout)
+        with self._cond:
+            if self._active < self.max_active:
+                self._active += 1
+                return True
+            if self._queued >= self.max_queued:
+                return False
+            self._queued += 1
+            try:
+                admitted = self._cond.wait_for(lambda: self._active < self.max_active, timeout)
+                if admitted:
+                    self._active += 1
+                return admitted
+            finally:
+                self._queued -= 1
+
+    async def acquire_async(self, timeout=None):
+        """ Wait for a free slot in the event loop without blocking it (e.g. ASGI, see acquire()) """
+        timeout = self._wait_time(timeout)
+        with self._cond:
+            if self._active < self.max_active:
+                self._active += 1
+                return True
+            if self._queued >= self.max_queued:
+                return False
+            self._queued += 1
+        deadline = monotonic() + timeout if timeout is not None else None
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                waiter = _AsyncWaiter(loop)
+                with self._cond:
+                    if self._active < self.max_active:
+                        self._active += 1
+                        return True
+                    self._async_waiters.append(waiter)
+                remaining = deadline - monotonic() if deadline is not None else None
+                woken_in_time = False
+                try:
+                    if remaining is None or remaining > 0:
+                        await asyncio.wait_for(waiter.future, remaining)
+                        woken_in_time = True
+                except asyncio.TimeoutError:
+                    pass
+                finally:
+                    with self._cond:
+                        if not waiter.woken:
+                            self._async_waiters.remove(waiter)
+                        elif not woken_in_time:  # Timed out or cancelled: the freed slot goes to the next waiter
+                            self._wake_async_waiter()
+                if not woken_in_time:
+                    return False
+                # Woken: try to take the slot (a thread waiting in acquire() may have taken it meanwhile)
+        finally:
+            with self._cond:
+                self._queued -= 1
+
+    def release(self):
+        with self._cond:
+            self._active -= 1
+            self._wake_async_waiter()
+            self._cond.notify()
+
+    def stats(self):
+        with self._cond:
+            return {'active': self._active, 'queued': self._queued, 'max_active': self.max_active,
+                    'max_queued': self.max_queued}
+
+    def _wake_async_waiter(self):
+        """ Wake the first request waiting in an event loop (called with the lock held) """
+        if len(self._async_waiters) > 0:
+            waiter = self._async_waiters.popleft()
+            waiter.woken = True
+            waiter.loop.call_soon_threadsafe(_set_done, waiter.future)
+
+    def _wait_time(self, timeout):
+        if timeout is None:
+            return self.max_wait
+        if self.max_wait is None:
+            return timeout
+        return min(timeout, self.max_wait)
+
+
+def reject_overload(metrics=None):
+    """
+    Reject a request not admitted by the AdmissionQueue (like check_admission())
+    :param metrics: PipelineMetrics to count the rejected requests by reason
+    :return: the (HTTP status, error message) pair
+    """
+    message = 'ERROR: the service is overloaded, try again later!'
+    logger.warning('Request rejected: {0}'.format(message))
+    if metrics is not None:
+        metrics.reject('overload')
+    return 503, message
+
+
+# From here, there are only private methods
+class _AsyncWaiter:
+    """ A request waiting in the event loop for a free slot (see AdmissionQueue.acquire_async()) """
+    def __init__(self, loop):
+        self.loop = loop
+        self.future = loop.create_future()
+        self.woken = False
+
+
+def _set_done(future):
+    if not future.done():  # Not timed out or cancelled meanwhile
+        future.set_result(None)
+
+
+def _checked_items(items, cancel):
+    for item in items:
+        cancel.check()
+        yield item
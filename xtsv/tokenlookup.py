@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8, vim: expandtab:ts=4 -*-
+
+"""
+The fast path of the token endpoints of the REST API (GET /<tool>/<token> and /tokens/<tool>): the results of
+ process_token() are memoised per tool in an LRU cache, and the tokens of the concurrent requests for the same tool
+ are processed together in one call (process_tokens() if the tool has it), so the tool is accessed only once
+ for a burst of short lookups (e.g. autocomplete) instead of once per request
+"""
+
+import threading
+from json import dumps as json_dumps
+from time import sleep
+from weakref import WeakKeyDictionary
+from contextlib import nullcontext
+from collections import OrderedDict
+
+
+class TokenLookup:
+    """ Thread-safe memo and micro-batching of process_token() shared by the requests (see lookup()) """
+    def __init__(self, max_entries=10000, max_delay=0.0, max_batch=256):
+        """
+        :param max_entries: the maximal number of the memoised tokens per tool (0: no memo)
+        :param max_delay: the seconds to wait for other requests before calling the tool (0: only the requests
+         arriving while the tool is busy are batched, the lone requests are not delayed)
+        :param max_batch: the maximal number of tokens in one call of process_tokens()
+        """
+        if max_entries < 0 or max_delay < 0 or max_batch < 1:
+            raise ValueError('max_entries and max_delay must not be negative and max_batch must be positive!')
+        self._max_entries = max_entries
+        self._max_delay = max_delay
+        self._max_batch = max_batch
+        self._lock = threading.Lock()
+        self._memos = {}  # Tool name -> OrderedDict of token -> result (LRU order)
+        self._pending = {}  # Tool name -> the list of the _TokenRequests waiting for the tool
+        self._busy = set()  # The tools which have a request processing the pending ones (the leader)
+        # Tool instance -> lock: the leaders of the names of the same instance (e.g. aliases) take turns
+        self._tool_locks = WeakKeyDictionary()
+        self._shared_tool_lock = threading.Lock()  # For the instances which can not be weak referenced
+        self._counters = {'hits': 0, 'misses': 0, 'calls': 0, 'batched_requests': 0}
+
+    def lookup(self, tool_name, tokens, run_with_tool):
+        """
+        Process the tokens with the tool (the memoised ones are not processed again)
+        :param tool_name: the name of the tool (the key of its memo)
+        :param tokens: the list of the tokens
+        :param run_with_tool: function(fun) which calls fun(initialised tool) and returns its result (the tool is
+         None if it is not available). The calls of process_token() on the same instance are serialised here
+         (unless the tool is thread_safe), the other users of the instance (e.g. pipelines) must be excluded by
+         run_with_tool (e.g. by checking it out from a ToolPool)
+        :return: dict of the tokens and their results in the order of the tokens, or None if the tool does not
+         support process_token()
+        """
+        with self._lock:
+            results, missing = self._from_memo(tool_name, tokens)
+            self._counters['hits'] += len(tokens) - len(missing)
+            self._counters['misses'] += len(missing)
+
+        if len(missing) > 0:
+            processed = self._batched(tool_name, missing, run_with_tool)
+            if processed is None:
+                return None
+            results.update(processed)
+        return {token: results[token] for token in tokens}
+
+    def memoised(self, tool_name, tokens):
+        """ The results of the tokens if all of them are memoised (without accessing the tool), else None """
+        with self._lock:
+            results, missing = self._from_memo(tool_name, tokens)
+            if len(missing) > 0:
+                return None
+            self._counters['hits'] += len(tokens)
+        return {token: results[token] for token in tokens}
+
+    def stats(self):
+        """ The hit and miss counters of the memo, the calls of the tools and the requests served by an other one """
+        with self._lock:
+            stats = dict(self._counters)
+            stats['entries'] = sum(len(memo) for memo in self._memos.values())
+            return stats
+
+    def clear(self):
+        """ Forget the memoised results (e.g. after a model is reloaded) """
+        with self._lock:
+            self._memos.clear()
+
+    def _from_memo(self, tool_name, tokens):
+        """ The memoised results and the missing tokens (without duplicates, the lock must be held) """
+        results = {}
+        memo = self._memos.get(tool_name)
+        if memo is not None:
+            for token in tokens:
+                if token in memo:
+                    memo.move_to_end(token)
+                    results[token] = memo[token]
+        return results, [token for token in dict.fromkeys(tokens) if token not in results]
+
+    def _batched(self, tool_name, tokens, run_with_tool):
+        """
+        The first request for an idle tool becomes the leader: it processes the tokens of every request waiting
+         for the tool in one call. The requests arriving meanwhile wait, and the next leader is chosen from them
+        """
+        req = _TokenRequest(tokens)
+        with self._lock:
+            self._pending.setdefault(tool_name, []).append(req)
+            leader = tool_name not in self._busy
+            self._busy.add(tool_name)
+        if not leader:
+            req.done.wait()
+            if not req.lead:  # Served by the leader
+                if req.error is not None:
+                    raise req.error
+                return req.results
+
+        if self._max_delay > 0:
+            sleep(self._max_delay)  # Let the concurrent requests join the batch
+        with self._lock:
+            batch = self._pending.pop(tool_name)
+            self._counters['calls'] += 1
+            self._counters['batched_requests'] += len(batch) - 1
+        try:
+            batch_tokens = list(dict.fromkeys(token for batch_req in batch for token in batch_req.tokens))
+            results = run_with_tool(lambda tool: self._process_tokens(tool, batch_tokens))
+            if results is not None:
+                self._memoise(tool_name, results)
+            for batch_req in batch:
+                batch_req.results = results
+        except Exception as e:  # Reported to every request of the batch
+            for batch_req in batch:
+                batch_req.error = e
+        finally:
+            with self._lock:
+                waiting = self._pending.get(tool_name)
+                if waiting:  # Hand over the leadership to the first waiting request
+                    waiting[0].lead = True
+                    waiting[0].done.set()
+                else:
+                    self._busy.discard(tool_name)
+            for batch_req in batch:
+                batch_req.lead = False
+                batch_req.done.set()
+        if req.error is not None:
+            raise req.error
+        return req.results
+
+    def _process_tokens(self, tool, tokens):
+        process_token = getattr(tool, 'process_token', None)
+        if process_token is None:
+            return None
+        process_tokens = getattr(tool, 'process_tokens', None)
+        with self._tool_lock(tool):
+            if process_tokens is not None:  # One call for each max_batch tokens
+                results = {}
+                for start in range(0, len(tokens), self._max_batch):
+                    batch = tokens[start:start + self._max_batch]
+                    results.update(zip(batch, process_tokens(batch)))
+            else:
+                results = {token: process_token(token) for token in tokens}
+        if not getattr(tool, 'cacheable', True):  # The results must not be reused
+            results = _Uncacheable(results)
+        return results
+
+    def _tool_lock(self, tool):
+        if getattr(tool, 'thread_safe', False):
+            return nullcontext()
+        with self._lock:
+            try:
+                lock = self._tool_locks.get(tool)
+                if lock is None:
+                    lock = self._tool_locks[tool] = threading.Lock()
+            except TypeError:  # Not weak referenceable
+                lock = self._shared_tool_lock
+        return lock
+
+    def _memoise(self, tool_name, results):
+        if self._max_entries == 0 or isinstance(results, _Uncacheable):
+            return
+        with self._lock:
+            memo = self._memos.setdefault(tool_name, OrderedDict())
+            memo.update(results)
+            while len(memo) > self._max_entries:
+                memo.popitem(last=False)
+
+
+def checked_tokens(tokens):
+    """
+    Check the tokens of a request
+    :param tokens: the list of the tokens (e.g. the parsed JSON body)
+    :return: the list of the tokens or raise ValueError with the error message
+    """
+    if not isinstance(tokens, list) or not all(isinstance(token, str) and len(token) > 0 for token in tokens):
+        raise ValueError('ERROR: the tokens should be a JSON array of non-empty strings!')
+    if len(tokens) == 0:
+        raise ValueError('ERROR: no token is given!')
+    return tokens
+
+
+def token_json(results, compact=False):
+    """
+    Format the results of the token endpoints
+    :param results: dict of the tokens and their results (see TokenLookup.lookup())
+    :param compact: JSON without whitespace in the order of the tokens, indented and sorted by the tokens otherwise
+    :return: the JSON text
+    """
+    if compact:
+        return json_dumps(results, ensure_ascii=False, separators=(',', ':'))
+    return json_dumps(results, indent=2, sort_keys=True, ensure_ascii=False)
+
+
+# From here, there are only private methods
+class _TokenRequest:
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.results = None
+        self.error = None
+        self.lead = False  # Set when the request is woken up to become the next leader
+        self.done = threading.Event()
+
+
+class _Uncacheable(dict):
+    """ The results of a tool with cacheable = False """
@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8, vim: expandtab:ts=4 -*-
+
+"""
+Pooled store of initialised tools for the concurrent pipeline runs (an alternative of the singleton store)
+"""
+
+import time
+import threading
+from contextlib import contextmanager
+
+from .memusage import current_rss
+
+
+class ToolPool:
+    """
+    Pooled store of initialised tools for concurrent use (an alternative of singleton_store_factory()): every tool can
+     have several instances which are checked out exclusively for a pipeline run and checked in afterwards.
+     The instances are created lazily when all of them are busy, the idle ones can be evicted and the growth of the pool
+     can be limited by the estimated memory of the instances. The aliases of a tool (same params) share the instances.
+    """
+    def __init__(self, max_instances=1, idle_timeout=None, max_memory=None, min_instances=1):
+        """
+        :param max_instances: the maximal number of instances per tool (int) or dict of tool name -> int
+         (the tools not in the dict can have only one instance), e.g. {'tok': 4, 'parse': 1}
+        :param idle_timeout: evict the instances idle for more than this many seconds (keeping min_instances per tool)
+        :param max_memory: do not create new instances when the estimated memory of all instances (measured as the
+         growth of the RSS during initialisation) would exceed this many bytes (the first instance is always created)
+        :param min_instances: the number of instances kept per tool by idle eviction
+        """
+        self._max_instances = max_instances
+        self._idle_timeout = idle_timeout
+        self._max_memory = max_memory
+        self._min_instances = min_instances
+        self._cond = threading.Condition()
+        self._slots = []  # List of (prog_params, slot) pairs: aliases have the same prog_params
+        self._slot_of_instance = {}
+
+    def checkout(self, used_tools, available_tools, presets, timeout=None):
+        """
+        Check out one instance of every needed tool (initialise a new one if all are busy and the limits allow it,
+         else wait for an instance to be checked in)
+        :param timeout: raise TimeoutError after waiting this many seconds for a busy tool (default: wait forever)
+        :return: dict of tool names (with aliases) -> instances, which must be passed to checkin()
+        """
+        from .pipeline import select_tools  # Circular import...
+        return self.checkout_selected(select_tools(used_tools, available_tools, presets), timeout)
+
+    def checkout_selected(self, selected_tools, timeout=None):
+        """ Like checkout() with the (prog_params, prog_names) pairs of the tools (see select_tools()) """
+        # The aliases (same params) share one slot: they get one instance, as a second one could wait for the first
+        #  forever (e.g. max_instances=1)
+        merged_tools = []  # The params are not hashable (kwargs)
+        for prog_params, prog_names in selected_tools:
+            for curr_prog_params, curr_prog_names in merged_tools:
+                if curr_prog_params == prog_params:
+                    curr_prog_names.extend(prog_names)
+                    break
+            else:
+                merged_tools.append((prog_params, list(prog_names)))
+        checked_out = {}
+        try:
+            # The order of the available tools is fixed which prevents deadlocks between concurrent checkouts
+            for prog_params, prog_names in merged_tools:
+                inst = self._acquire(self._get_slot(prog_params, prog_names), prog_params, prog_names, timeout)
+                for prog_name in prog_names:
+                    checked_out[prog_name] = inst
+        except BaseException:
+            self.checkin(checked_out)
+            raise
+        return checked_out
+
+    def checkin(self, checked_out):
+        """ Return the instances got from checkout() to the pool """
+        now = time.monotonic()
+        with self._cond:
+            for inst in {id(inst): inst for inst in checked_out.values()}.values():
+                slot = self._slot_of_instance[id(inst)]
+                slot['busy'] -= 1
+                slot['idle'].append((inst, now))
+            self._evict_idle(now)
+            self._cond.notify_all()
+
+    @contextmanager
+    def tools(self, used_tools, available_tools, presets, timeout=None):
+        """ Context manager for checkout() and checkin() """
+        checked_out = self.checkout(used_tools, available_tools, presets, timeout)
+        try:
+            yield checked_out
+        finally:
+            self.checkin(checked_out)
+
+    def stats(self):
+        """ The number of all, idle and busy instances and the estimated memory of an instance by the tool names """
+        with self._cond:
+            self._evict_idle(time.monotonic())
+            return {','.join(sorted(slot['names'])): {'instances': slot['total'], 'idle': len(slot['idle']),
+                                                      'busy': slot['busy'], 'estimated_memory': slot['memory']}
+                    for _, slot in self._slots}
+
+    def preload(self, prog_params, prog_names):
+        """ Initialise the first instance of the tool (if there is none) and keep it idle in the pool """
+        slot = self._get_slot(prog_params, prog_names)
+        with self._cond:
+            if slot['total'] > 0:
+                return
+        inst = self._acquire(slot, prog_params, prog_names, None)
+        self.checkin({prog_name: inst for prog_name in prog_names})
+
+    def _get_slot(self, prog_params, prog_names):
+        with self._cond:
+            for curr_prog_params, slot in self._slots:
+                if curr_prog_params == prog_params:  # Alias
+                    slot['names'].update(prog_names)
+                    return slot
+            if isinstance(self._max_instances, int):
+                max_instances = self._max_instances
+            else:
+                max_instances = max(self._max_instances.get(name, 1) for name in prog_names)
+            slot = {'names': set(prog_names), 'max_instances': max(max_instances, 1), 'total': 0, 'busy': 0,
+                    'idle': [], 'memory': None}
+            self._slots.append((prog_params, slot))
+            return slot
+
+    def _acquire(self, slot, prog_params, prog_names, timeout):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while True:
+                if len(slot['idle']) > 0:
+                    inst, _ = slot['idle'].pop()  # The most recently used one
+                    slot['busy'] += 1
+                    return inst
+                if slot['total'] < slot['max_instances'] and self._memory_allows(slot):
+                    slot['total'] += 1  # Reserve place for the new instance and initialise it without the lock
+                    slot['busy'] += 1
+                    break
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    raise TimeoutError('No instance of {0} became available in {1} seconds!'.
+                                       format(','.join(prog_names), timeout))
+                self._cond.wait(remaining)
+
+        from .pipeline import init_tool  # Circular import...
+        try:
+            rss_before = current_rss()
+            inst = init_tool(prog_params, prog_names)
+            memory = max(current_rss() - rss_before, 0)
+        except BaseException:
+            with self._cond:
+                slot['total'] -= 1
+                slot['busy'] -= 1
+                self._cond.notify_all()
+            raise
+        with self._cond:
+            if slot['memory'] is None:
+                slot['memory'] = memory
+            self._slot_of_instance[id(inst)] = slot
+        return inst
+
+    def _memory_allows(self, slot):
+        if self._max_memory is None or slot['total'] == 0:
+            return True
+        used_memory = sum(curr_slot['total'] * (curr_slot['memory'] or 0) for _, curr_slot in self._slots)
+        return used_memory + (slot['memory'] or 0) <= self._max_memory
+
+    def _evict_idle(self, now):
+        if self._idle_timeout is None:
+            return
+        for _, slot in self._slots:
+            # The oldest idle instance is the first
+            while len(slot['idle']) > 0 and slot['total'] > self._min_instances and \
+                    now - slot['idle'][0][1] > self._idle_timeout:
+                inst, _ = slot['idle'].pop(0)
+                del self._slot_of_instance[id(inst)]
+                slot['total'] -= 1
@@ -2,6 +2,12 @@
 # -*- coding: utf-8, vim: expandtab:ts=4 -*-
 
 import logging
+from collections import deque
+
+from .cache import is_cacheable
+from .moduletypes import has_plain_output, is_internal_module
+from .slo import cancellable
+
 logger = logging.getLogger('xtsv')
 
 
@@ -9,6 +15,10 @@ class HeaderError(ValueError):
     pass
 
 
+class InputLimitError(ValueError):
+    pass
+
+
 def process_header(fields, source_fields, target_fields, track_stream):
     if not source_fields.issubset(set(fields)):
         raise HeaderError('Input ({0}) does not have the required field names ({1}). '
@@ -22,7 +32,8 @@ def process_header(fields, source_fields, target_fields, track_stream):
 
 
 # Only This method is public...
-def process(stream, internal_app, conll_comments=False, default_pass_header=True):
+def process(stream, internal_app, conll_comments=False, default_pass_header=True, batch_size=None, batch_tokens=None,
+            result_cache=None, field_cache=None, cancel=None):
     """
     Process the input stream and check the header for the next module in the pipeline (internal_app).
      Five types of internal app is allowed:
@@ -40,6 +51,16 @@ def process(stream, internal_app, conll_comments=False, default_pass_header=True
      (this allows #tags at the beginning of the sentence commonly used in social mediat) (default: false)
     :param default_pass_header: Default in passing header
      can be used to tell the last module to omit header (chunked input)
+    :param batch_size: The maximal number of sentences passed at once to internal_app.process_sentences(batch,
+     field_values) if the module has such method, else process_sentence(sen, field_values) is called for every
+     sentence (default: the batch_size attribute of the module or 64)
+    :param batch_tokens: The maximal number of tokens in a batch (default: the batch_tokens attribute of the module
+     or unlimited)
+    :param result_cache: ResultCache to look up the processed sentences before processing them (see cache.py)
+    :param field_cache: WeakKeyDictionary to reuse the field bindings of the same module for the same header
+     (see bind_fields())
+    :param cancel: CancelToken checked before every sentence (every input line for tokenisers), the processing
+     is stopped with RequestCancelled when the request is cancelled or its deadline has passed (see slo.py)
     :return: Iterator over the processed tokens (iterator of lists of features)
     """
     track_stream = {'file_name': getattr(stream, 'name', 'no filename for stream'), 'curr_line_number': 0}
@@ -50,40 +71,22 @@ def process(stream, internal_app, conll_comments=False, default_pass_header=True
             track_stream['curr_line_number'] += 1
         else:
             fields = []
-        header, field_names = process_header(fields, internal_app.source_fields, internal_app.target_fields,
-                                             track_stream)
+        input_header = '\t'.join(fields)
+        # Like binding names to indices...
+        header, field_values = bind_fields(fields, internal_app, track_stream, field_cache)
         # Pass or hold back the header
         if getattr(internal_app, 'pass_header', default_pass_header) and default_pass_header:
             yield header
 
-        # Like binding names to indices...
-        field_values = internal_app.prepare_fields(field_names)
-
         logger.info('processing sentences...')
-        sen_count = 0
-        for sen_count, (sen, comment) in enumerate(sentence_iterator(stream, conll_comments, track_stream)):
-            sen_count += 1
-            if len(comment) > 0:
-                yield comment
-            curr_line = track_stream['curr_line_number']
-            try:
-                yield from ('{0}\n'.format('\t'.join(tok)) for tok in internal_app.process_sentence(sen, field_values))
-            except Exception as e:  # Catch every exception to add the file name and line number before reraise
-                import sys
-                raise type(e)('In "{0}" at {1}: {2}'.format(track_stream['file_name'], curr_line, str(e))).\
-                    with_traceback(sys.exc_info()[2])
-            
-            # Finalizers can suppress sentence-final newlines in their output.
-            if getattr(internal_app, 'add_newline_after_sentence', True):
-                yield '\n'
-
-            if sen_count % 1000 == 0:
-                logger.info('{0}...'.format(sen_count))
-        logger.info('{0}...done\n'.format(sen_count))
+        sentences = cancellable(sentence_iterator(stream, conll_comments, track_stream), cancel)
+        processed_sentences = _process_sentences(sentences, internal_app, field_values, track_stream, batch_size,
+                                                 batch_tokens, result_cache=result_cache, input_header=input_header)
+        yield from _format_sentences(processed_sentences, internal_app, track_stream)
     else:
         # This is intended to be used by the first module in the pipeline which deals with raw text (eg. tokeniser) only
         yield '{0}\n'.format('\t'.join(internal_app.target_fields))
-        yield from internal_app.process_sentence(stream)
+        yield from internal_app.process_sentence(cancellable(stream, cancel))
 
     # For finalisers, to be able to generate a summary
     final_output = getattr(internal_app, 'final_output', None)  # TODO document!
@@ -91,7 +94,297 @@ def process(stream, internal_app, conll_comments=False, default_pass_header=True
         yield from final_output()
 
 
+def process_chain(stream, internal_apps, conll_comments=False, default_pass_header=True, result_cache=None,
+                  field_cache=None, parsed_output=False, cancel=None):
+    """
+    Process the input stream with the modules in order (like chaining process() calls). The consecutive
+     "Internal modules" pass the parsed sentences (lists of tokens which are lists of fields) directly to each other,
+     so the stream is split into fields and joined again only at the boundaries of such runs (see process_segment())
+    :param stream: Line chunked input stream
+    :param internal_apps: the list of the initialised xtsv modules in order
+    :param conll_comments: Allow conll style comments (lines starting with '# ') before sentences
+    :param default_pass_header: Default in passing header for the last module
+    :param result_cache: ResultCache to look up the processed sentences before processing them (see cache.py)
+    :param field_cache: WeakKeyDictionary to reuse the field bindings of the modules (see bind_fields())
+    :param parsed_output: Return the parsed sentences of the last module as SentenceStream without serialising them
+     if the last module is an "Internal module" passing TSV+header (e.g. for the binary format)
+    :param cancel: CancelToken checked between the sentences (see process())
+    :return: Iterator over the output lines
+    """
+    last_app_nr = len(internal_apps) - 1
+    begin = 0
+    while begin <= last_app_nr:
+        end = begin
+        while end < last_app_nr and has_plain_output(internal_apps[end]) and \
+                is_internal_module(internal_apps[end + 1]):
+            end += 1
+        pass_header = end != last_app_nr or default_pass_header
+        if parsed_output and end == last_app_nr and is_internal_module(internal_apps[begin]) and \
+                has_plain_output(internal_apps[end]):
+            header, processed_sentences, _ = _process_segment_sentences(stream, internal_apps[begin:], conll_comments,
+                                                                        result_cache, field_cache, True, cancel)
+            return SentenceStream(header if pass_header else None, processed_sentences,
+                                  getattr(stream, 'name', 'no filename for stream'))
+        if begin < end:
+            stream = process_segment(stream, internal_apps[begin:end + 1], conll_comments, pass_header,
+                                     result_cache, field_cache, cancel)
+        else:
+            stream = process(stream, internal_apps[begin], conll_comments, pass_header, result_cache=result_cache,
+                             field_cache=field_cache, cancel=cancel)
+        begin = end + 1
+    return stream
+
+
+def process_segment(stream, internal_apps, conll_comments=False, default_pass_header=True, result_cache=None,
+                    field_cache=None, cancel=None):
+    """
+    Process the input stream with consecutive "Internal modules" (all but the last must pass the header,
+     add newline after sentences and have no final_output). The input is split into fields only once and the parsed
+     sentences are passed between the modules directly, the output is serialised only after the last one
+    :param stream: Line chunked input stream (TSV+header)
+    :param internal_apps: the list of the initialised xtsv modules in order
+    :param conll_comments: Allow conll style comments (lines starting with '# ') before sentences
+    :param default_pass_header: Default in passing header for the last module
+    :param result_cache: ResultCache to look up the processed sentences before processing them (see cache.py)
+    :param field_cache: WeakKeyDictionary to reuse the field bindings of the modules (see bind_fields())
+    :param cancel: CancelToken checked between the sentences (see process())
+    :return: Iterator over the output lines
+    """
+    header, processed_sentences, track_stream = _process_segment_sentences(stream, internal_apps, conll_comments,
+                                                                           result_cache, field_cache, cancel=cancel)
+    last_app = internal_apps[-1]
+    if getattr(last_app, 'pass_header', default_pass_header) and default_pass_header:
+        yield header
+
+    logger.info('processing sentences...')
+    yield from _format_sentences(processed_sentences, last_app, track_stream)
+
+    # For finalisers, to be able to generate a summary
+    final_output = getattr(last_app, 'final_output', None)
+    if final_output is not None:
+        yield from final_output()
+
+
+class SentenceStream:
+    """
+    Parsed sentences ((sentence, comment) pairs) with their header line (None if there is no header) which can be
+     iterated as TSV lines as well. The modules read the parsed sentences directly without splitting the lines again
+     (see sentence_iterator()). Used for the binary format (see binformat.py) and the parsed output of process_chain()
+    """
+    def __init__(self, header, sentences, name='no filename for stream'):
+        self.header = header
+        self.name = name
+        self._sentences = iter(sentences)
+        self._lines = deque()  # The lines of the current sentence not yet iterated
+        self._header_pending = header is not None
+        if self._header_pending:
+            self._lines.append(header)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if len(self._lines) == 0:
+            sen, comment = next(self._sentences)
+            self._lines.extend(comment.splitlines(keepends=True))
+            self._lines.extend('{0}\n'.format('\t'.join(tok)) for tok in sen)
+            self._lines.append('\n')
+        self._header_pending = False
+        return self._lines.popleft()
+
+    def parsed_sentences(self, track_stream=None):
+        """ The sentences from the current position (the header is skipped if it is not read yet) """
+        if self._header_pending:
+            self._lines.popleft()
+            self._header_pending = False
+        if len(self._lines) > 0:
+            raise ValueError('The lines of a sentence are partially read from {0}!'.format(self.name))
+        for sen, comment in self._sentences:
+            if track_stream is not None:  # The line number of the sentence end as in TSV
+                track_stream['curr_line_number'] += comment.count('\n') + len(sen) + 1
+            yield sen, comment
+
+
+def bind_fields(fields, internal_app, track_stream, field_cache=None):
+    """
+    Check the header and bind the field names to indices with internal_app.prepare_fields(). The fields are extended
+     in place with the target fields of the module. If the same module instance was bound to the same fields before
+     (recorded in field_cache by instance), the previous header and field values are reused without calling
+     process_header() and prepare_fields() again (the field values must not be modified by the module).
+     Proxies (e.g. of the profiler) share the bindings of the tool they wrap (wrapped_app)
+    :return: the output header line and the field values
+    """
+    input_fields = tuple(fields)
+    bound = None
+    cache_key = getattr(internal_app, 'wrapped_app', internal_app)
+    if field_cache is not None:
+        try:
+            bound = field_cache.get(cache_key)
+        except TypeError:  # Not weak referenceable or not hashable: no caching
+            field_cache = None
+    if bound is not None and bound[0] == input_fields:
+        _, output_fields, header, field_values = bound
+        fields[:] = output_fields
+        return header, field_values
+
+    header, field_names = process_header(fields, internal_app.source_fields, internal_app.target_fields,
+                                         track_stream)
+    field_values = internal_app.prepare_fields(field_names)
+    if field_cache is not None:
+        field_cache[cache_key] = (input_fields, tuple(fields), header, field_values)
+    return header, field_values
+
+
+def _process_segment_sentences(stream, internal_apps, conll_comments, result_cache, field_cache,
+                               materialise_last=False, cancel=None):
+    """ Read the header and chain the modules of the segment (see process_segment()) """
+    track_stream = {'file_name': getattr(stream, 'name', 'no filename for stream'), 'curr_line_number': 0}
+    fields = next(stream).strip().split('\t')  # Read header to fields
+    track_stream['curr_line_number'] += 1
+
+    processed_sentences = cancellable(sentence_iterator(stream, conll_comments, track_stream), cancel)
+    last_app_nr = len(internal_apps) - 1
+    header = None
+    for i, internal_app in enumerate(internal_apps):
+        input_header = '\t'.join(fields)
+        header, field_values = bind_fields(fields, internal_app, track_stream, field_cache)
+        # The next module expects lists of tokens, lazy outputs (e.g. generators) must be materialised
+        processed_sentences = _process_sentences(processed_sentences, internal_app, field_values, track_stream,
+                                                 materialise=i != last_app_nr or materialise_last,
+                                                 result_cache=result_cache, input_header=input_header)
+    return header, processed_sentences, track_stream
+
+
+def _process_sentences(sentences, internal_app, field_values, track_stream, batch_size=None, batch_tokens=None,
+                       materialise=False, result_cache=None, input_header=''):
+    if result_cache is not None and is_cacheable(internal_app):
+        # The key depends on the header as the fields are bound to the column indices
+        cache_prefix = '{0}\n{1}'.format(result_cache.tool_key(internal_app), input_header)
+        return _process_cached(sentences, internal_app, field_values, track_stream, batch_size, batch_tokens,
+                               result_cache, cache_prefix)
+    return _process_uncached(sentences, internal_app, field_values, track_stream, batch_size, batch_tokens,
+                             materialise)
+
+
+def _process_uncached(sentences, internal_app, field_values, track_stream, batch_size=None, batch_tokens=None,
+                      materialise=False):
+    if getattr(internal_app, 'process_sentences', None) is not None:
+        if batch_size is None:
+            batch_size = getattr(internal_app, 'batch_size', 64)
+        if batch_tokens is None:
+            batch_tokens = getattr(internal_app, 'batch_tokens', None)
+        return _process_batches(sentences, internal_app, field_values, batch_size, batch_tokens, track_stream,
+                                materialise)
+    return _process_one_by_one(sentences, internal_app, field_values, track_stream, materialise)
+
+
+def _process_cached(sentences, internal_app, field_values, track_stream, batch_size, batch_tokens, result_cache,
+                    cache_prefix):
+    """ Look up the sentences in chunks and process only the missing ones (the order is kept) """
+    if batch_size is None:
+        batch_size = getattr(internal_app, 'batch_size', 64)
+    chunk = []
+    for sen_and_comment in sentences:
+        chunk.append(sen_and_comment)
+        if len(chunk) >= batch_size:
+            yield from _process_cached_chunk(chunk, internal_app, field_values, track_stream, batch_size,
+                                             batch_tokens, result_cache, cache_prefix)
+            chunk = []
+    if len(chunk) > 0:
+        yield from _process_cached_chunk(chunk, internal_app, field_values, track_stream, batch_size, batch_tokens,
+                                         result_cache, cache_prefix)
+
+
+def _process_cached_chunk(chunk, internal_app, field_values, track_stream, batch_size, batch_tokens, result_cache,
+                          cache_prefix):
+    # The keys are computed before processing as the modules may modify the input sentences in place
+    keys = [result_cache.make_key(cache_prefix, sen) for sen, _ in chunk]
+    cached_sentences = [result_cache.get(key) for key in keys]
+    misses = [sen_and_comment for sen_and_comment, cached_sen in zip(chunk, cached_sentences) if cached_sen is None]
+    # The cached values must be lists (not lazy outputs)
+    processed_misses = _process_uncached(iter(misses), internal_app, field_values, track_stream, batch_size,
+                                         batch_tokens, materialise=True)
+    for key, cached_sen, (_, comment) in zip(keys, cached_sentences, chunk):
+        if cached_sen is None:
+            cached_sen, _ = next(processed_misses)
+            result_cache.put(key, cached_sen)
+        yield cached_sen, comment
+
+
+def _format_sentences(processed_sentences, internal_app, track_stream):
+    sen_count = 0
+    for sen_count, (sen, comment) in enumerate(processed_sentences, start=1):
+        if len(comment) > 0:
+            yield comment
+        curr_line = track_stream['curr_line_number']
+        try:
+            yield from ('{0}\n'.format('\t'.join(tok)) for tok in sen)
+        except Exception as e:  # Catch every exception to add the file name and line number before reraise
+            _reraise_with_location(e, track_stream, curr_line)
+
+        # Finalizers can suppress sentence-final newlines in their output.
+        if getattr(internal_app, 'add_newline_after_sentence', True):
+            yield '\n'
+
+        if sen_count % 1000 == 0:
+            logger.info('{0}...'.format(sen_count))
+    logger.info('{0}...done\n'.format(sen_count))
+
+
+def _reraise_with_location(e, track_stream, curr_line):
+    import sys
+    raise type(e)('In "{0}" at {1}: {2}'.format(track_stream['file_name'], curr_line, str(e))).\
+        with_traceback(sys.exc_info()[2])
+
+
+def _process_one_by_one(sentences, internal_app, field_values, track_stream, materialise=False):
+    for sen, comment in sentences:
+        try:
+            processed_sen = internal_app.process_sentence(sen, field_values)
+            if materialise and not isinstance(processed_sen, list):
+                processed_sen = list(processed_sen)
+            yield processed_sen, comment
+        except Exception as e:  # Catch every exception to add the file name and line number before reraise
+            _reraise_with_location(e, track_stream, track_stream['curr_line_number'])
+
+
+def _process_batches(sentences, internal_app, field_values, batch_size, batch_tokens, track_stream,
+                     materialise=False):
+    """ Collect the sentences into batches (by sentence and token count) and process them at once """
+    batch, comments = [], []
+    token_count = 0
+    for sen, comment in sentences:
+        batch.append(sen)
+        comments.append(comment)
+        token_count += len(sen)
+        if len(batch) >= batch_size or (batch_tokens is not None and token_count >= batch_tokens):
+            yield from _process_batch(batch, comments, internal_app, field_values, track_stream, materialise)
+            batch, comments = [], []
+            token_count = 0
+    if len(batch) > 0:
+        yield from _process_batch(batch, comments, internal_app, field_values, track_stream, materialise)
+
+
+def _process_batch(batch, comments, internal_app, field_values, track_stream, materialise=False):
+    curr_line = track_stream['curr_line_number']  # The end of the batch
+    try:
+        processed_batch = list(internal_app.process_sentences(batch, field_values))
+        if materialise:
+            processed_batch = [sen if isinstance(sen, list) else list(sen) for sen in processed_batch]
+    except Exception as e:  # Catch every exception to add the file name and line number before reraise
+        _reraise_with_location(e, track_stream, curr_line)
+    if len(processed_batch) != len(batch):
+        raise ValueError('In "{0}" at {1}: process_sentences() returned {2} sentences instead of {3}!'.
+                         format(track_stream['file_name'], curr_line, len(processed_batch), len(batch)))
+    yield from zip(processed_batch, comments)
+
+
 def sentence_iterator(input_stream, conll_comments=False, track_stream=None):
+    parsed_sentences = getattr(input_stream, 'parsed_sentences', None)
+    if parsed_sentences is not None:  # Already parsed (e.g. SentenceStream), no need to split the lines again
+        yield from parsed_sentences(track_stream)
+        return
+
     curr_sen = []
     curr_comment = ''
     for line in input_stream:
@@ -115,3 +408,31 @@ def sentence_iterator(input_stream, conll_comments=False, track_stream=None):
     if curr_sen:
         logger.warning('No blank line before EOF ({0})!'.format(track_stream['file_name']))
         yield curr_sen, curr_comment
+
+
+def sentence_batch_iterator(input_stream, batch_size, conll_comments=False):
+    """
+    Group the raw lines of a TSV stream (without header) into batches of batch_size sentences without parsing them.
+     The comments preceding a sentence are kept in the same batch with the sentence.
+    :param input_stream: Line chunked input stream, one token per line (TSV) and emtpy lines as sentence separator
+    :param batch_size: the number of sentences in a batch (the last batch can be shorter)
+    :param conll_comments: Allow conll style comments (lines starting with '# ') before sentences
+    :return: Iterator over the batches (lists of lines)
+    """
+    batch = []
+    sen_count = 0
+    in_sentence = False
+    for line in input_stream:
+        batch.append(line)
+        if len(line.rstrip('\n')) == 0:
+            if in_sentence:  # End of sentence
+                in_sentence = False
+                sen_count += 1
+                if sen_count == batch_size:
+                    yield batch
+                    batch = []
+                    sen_count = 0
+        elif not in_sentence and not (conll_comments and line.startswith('# ')):  # Comments do not start sentences
+            in_sentence = True
+    if len(batch) > 0:
+        yield batch